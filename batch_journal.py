@@ -0,0 +1,138 @@
+# batch_journal.py
+import os
+import json
+import time
+import threading
+from logger import info, warning
+
+JOURNAL_NAME = ".audiobook_journal.json"
+JOURNAL_VERSION = 1
+
+# Book states
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# First retry waits this many seconds; each further retry waits twice as long
+RETRY_BACKOFF = 5.0
+
+
+def partial_output_path(output_file: str) -> str:
+    """
+    Temporary name a book is encoded to before it is renamed into place,
+    e.g. 'Book.m4b' -> '.Book.partial.m4b'. The extension is kept so FFmpeg
+    still picks the right container.
+    """
+    folder, name = os.path.split(output_file)
+    stem, ext = os.path.splitext(name)
+    return os.path.join(folder, f".{stem}.partial{ext}")
+
+
+def retry_delay(attempt: int, base: float = RETRY_BACKOFF) -> float:
+    """Seconds to wait before retry number `attempt` (1-based)."""
+    return base * 2 ** (attempt - 1)
+
+
+class BatchJournal:
+    """
+    Per-book state of a batch run (pending, running, done, failed), stored
+    as JSON in the library root and rewritten atomically on every change.
+
+    A book left 'running' means the previous run was interrupted while
+    encoding it; resuming treats it as pending again. Books are keyed by
+    their folder path relative to the root. Safe to use from several
+    worker threads.
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        self.path = os.path.join(root_dir, JOURNAL_NAME)
+        self._lock = threading.Lock()
+        self.run = {}
+        self.books = {}
+
+    def _key(self, folder: str) -> str:
+        return os.path.relpath(folder, self.root_dir).replace("\\", "/")
+
+    def _load(self) -> dict:
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != JOURNAL_VERSION:
+                warning(f"Ignoring batch journal with unknown version: {self.path}")
+                return {}
+            return data
+        except (OSError, ValueError) as e:
+            warning(f"Could not read batch journal {self.path}: {e}")
+            return {}
+
+    def save(self):
+        """Write the journal atomically."""
+        with self._lock:
+            data = {"version": JOURNAL_VERSION, "run": self.run, "books": self.books}
+            tmp_path = self.path + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, indent=2, sort_keys=True)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                warning(f"Could not write batch journal {self.path}: {e}")
+
+    def start(self, folders: list, preset_name: str, resume: bool = False) -> list:
+        """
+        Begin a run over `folders` and return the folders still to process.
+
+        Without `resume`, every book starts as pending. With `resume`, the
+        previous journal is kept: finished books are skipped, and books that
+        were running or failed are processed again. A journal written for a
+        different preset is not resumed.
+        """
+        previous = self._load() if resume else {}
+        if previous and previous.get("run", {}).get("preset") != preset_name:
+            warning(f"Batch journal was written for preset '{previous['run'].get('preset')}'. "
+                    f"Starting a new run.")
+            previous = {}
+
+        old_books = previous.get("books", {})
+        books = {}
+        remaining = []
+        for folder in folders:
+            key = self._key(folder)
+            entry = dict(old_books.get(key) or {"state": PENDING, "attempts": 0})
+            if entry["state"] == RUNNING:
+                info(f"Resuming interrupted book: {key}")
+                entry["state"] = PENDING
+            if entry["state"] != DONE:
+                remaining.append(folder)
+            books[key] = entry
+
+        with self._lock:
+            self.run = previous.get("run") or {
+                "preset": preset_name,
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+            self.run["resumed_at"] = time.strftime("%Y-%m-%dT%H:%M:%S") if previous else None
+            self.books = books
+        self.save()
+
+        if previous:
+            info(f"Resuming batch: {len(folders) - len(remaining)} of {len(folders)} book(s) already done.")
+        return remaining
+
+    def state(self, folder: str) -> dict:
+        with self._lock:
+            return dict(self.books.get(self._key(folder), {}))
+
+    def mark(self, folder: str, state: str, **fields):
+        """Set a book's state (and any extra fields, e.g. output or error) and persist."""
+        with self._lock:
+            entry = self.books.setdefault(self._key(folder), {"state": PENDING, "attempts": 0})
+            entry["state"] = state
+            entry["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            if state == RUNNING:
+                entry["attempts"] = entry.get("attempts", 0) + 1
+            entry.update(fields)
+        self.save()
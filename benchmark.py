@@ -0,0 +1,304 @@
+# benchmark.py
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from presets import PRESETS, get_preset_by_name, load_user_presets, PresetError
+from file_discovery import scan_library, get_mp3_files
+from chapter_handler import detect_chapters
+from metadata_manager import extract_metadata_from_mp3s as extract_metadata
+from cover_art import find_cover_art, prepare_cover
+from chapter_timeline import chapter_lengths, build_timeline, format_ffmetadata_chapters
+from conversion_planner import output_extension
+from converter import convert_to_audiobook
+import probe
+
+# name -> (file count, seconds per file, MP3 bitrate)
+DEFAULT_BOOKS = {
+    "small": (5, 60, "64k"),
+    "medium": (20, 300, "64k"),
+    "large": (40, 900, "128k"),
+}
+
+# Stages timed for every book and preset, in pipeline order
+STAGES = ["discovery", "probe", "chapters", "metadata", "cover", "ffmetadata", "convert"]
+
+RESULTS_VERSION = 1
+
+
+# -------------------------------
+# Synthetic books
+# -------------------------------
+
+def parse_book_spec(spec: str):
+    """Parse 'name:files:seconds:bitrate', e.g. 'tiny:3:30:32k'."""
+    try:
+        name, files, seconds, bitrate = spec.split(":")
+        return name, (int(files), int(seconds), bitrate)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid book spec '{spec}' (expected name:files:seconds:bitrate)")
+
+
+def generate_book(library_dir: str, name: str, files: int, seconds: int, bitrate: str,
+                  signal: str = "sine") -> str:
+    """
+    Create a synthetic book folder of MP3 files (plus a PNG cover) with FFmpeg.
+    Existing books with the same parameters are reused.
+    """
+    folder = os.path.join(library_dir, f"{name}_{files}x{seconds}s_{bitrate}_{signal}")
+    done_marker = os.path.join(folder, ".complete")
+    if os.path.exists(done_marker):
+        return folder
+
+    os.makedirs(folder, exist_ok=True)
+    print(f"Generating {name}: {files} x {seconds}s {signal} MP3 at {bitrate}...")
+    for idx in range(1, files + 1):
+        if signal == "noise":
+            source = f"anoisesrc=duration={seconds}:color=pink:amplitude=0.2:sample_rate=44100"
+        else:
+            source = f"sine=frequency={220 + 20 * idx}:duration={seconds}:sample_rate=44100"
+        target = os.path.join(folder, f"{idx:02d} - Chapter {idx}.mp3")
+        subprocess.run(
+            ["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", source,
+             "-ac", "2", "-c:a", "libmp3lame", "-b:a", bitrate,
+             "-metadata", f"title=Chapter {idx}", "-metadata", "artist=Benchmark Author",
+             "-metadata", f"album={name}", target],
+            check=True
+        )
+    subprocess.run(
+        ["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", "testsrc=size=1600x1600",
+         "-frames:v", "1", os.path.join(folder, "cover.png")],
+        check=True
+    )
+    open(done_marker, "w").close()
+    return folder
+
+
+# -------------------------------
+# Measurement
+# -------------------------------
+
+def peak_rss_mb(who) -> float:
+    """Peak resident set size in MB for RUSAGE_SELF or RUSAGE_CHILDREN (None if unavailable)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1_048_576 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_case(book_dir: str, preset_name: str, out_dir: str, queue, presets_file: str = None):
+    """
+    Run the whole pipeline for one book and preset, timing each stage.
+    Runs in its own process so peak RSS figures belong to this case only.
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    if presets_file:
+        load_user_presets(presets_file)
+    preset = get_preset_by_name(preset_name)
+    stages = {}
+
+    def timed(stage, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        stages[stage] = round(time.perf_counter() - start, 4)
+        return result
+
+    try:
+        library = timed("discovery", scan_library, os.path.dirname(book_dir))
+        listing = library.get(book_dir)
+        files = get_mp3_files(book_dir, listing)
+
+        probe._cache.clear()
+        probes = timed("probe", probe.probe_files, files)
+        chapters = timed("chapters", detect_chapters, files, probes)
+        metadata = timed("metadata", extract_metadata, files, probes)
+
+        cache_dir = os.path.join(out_dir, ".cover_cache")
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        cover = timed("cover", lambda: prepare_cover(find_cover_art(book_dir), cache_dir))
+
+        rate = probes[0].sample_rate or 1000
+        timed("ffmetadata", lambda: format_ffmetadata_chapters(
+            build_timeline(chapters, chapter_lengths(chapters, probes), rate), rate))
+
+        output_file = os.path.join(out_dir, os.path.basename(book_dir) + output_extension(preset, files))
+        ok = timed("convert", convert_to_audiobook, files, output_file, preset=preset,
+                   metadata=metadata, chapters=chapters, cover_art=cover, probes=probes)
+
+        audio_seconds = probe.total_duration(probes)
+        queue.put({
+            "ok": bool(ok),
+            "stages": stages,
+            "total": round(sum(stages.values()), 4),
+            "audio_seconds": round(audio_seconds, 3),
+            "realtime_factor": round(audio_seconds / stages["convert"], 1) if stages["convert"] else None,
+            "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+            "peak_child_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+            "output_bytes": os.path.getsize(output_file) if ok and os.path.exists(output_file) else None,
+        })
+        if ok:
+            os.remove(output_file)
+    except Exception as e:
+        queue.put({"ok": False, "error": str(e), "stages": stages})
+
+
+def run_benchmark(books: dict, preset_names: list, work_dir: str, signal: str, repeat: int,
+                  presets_file: str = None) -> dict:
+    """Generate the books and benchmark every preset on each; returns the results document."""
+    library_dir = os.path.join(work_dir, "library")
+    out_dir = os.path.join(work_dir, "output")
+    os.makedirs(out_dir, exist_ok=True)
+
+    results = []
+    for name, (files, seconds, bitrate) in books.items():
+        book_dir = generate_book(library_dir, name, files, seconds, bitrate, signal)
+        for preset_name in preset_names:
+            for run in range(1, repeat + 1):
+                queue = multiprocessing.Queue()
+                proc = multiprocessing.Process(target=run_case, args=(book_dir, preset_name, out_dir, queue,
+                                                                     presets_file))
+                proc.start()
+                case = queue.get()
+                proc.join()
+
+                case.update({"book": name, "files": files, "file_seconds": seconds,
+                             "bitrate": bitrate, "preset": preset_name, "run": run})
+                results.append(case)
+                if case["ok"]:
+                    print(f"{name:<8} {preset_name:<45} run {run}: convert {case['stages']['convert']:8.2f}s  "
+                          f"{case['realtime_factor']:>7}x  {case['peak_child_rss_mb']} MB  "
+                          f"{(case['output_bytes'] or 0) / 1_048_576:.1f} MB out")
+                else:
+                    print(f"{name:<8} {preset_name:<45} run {run}: FAILED {case.get('error', '')}")
+
+    return {
+        "version": RESULTS_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "ffmpeg": ffmpeg_version(),
+        "signal": signal,
+        "results": results,
+    }
+
+
+def ffmpeg_version() -> str:
+    try:
+        out = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True, check=True).stdout
+        return out.splitlines()[0]
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        return None
+
+
+# -------------------------------
+# Reporting
+# -------------------------------
+
+def _best_runs(document: dict) -> dict:
+    """(book, preset) -> fastest successful run."""
+    best = {}
+    for case in document.get("results", []):
+        if not case.get("ok"):
+            continue
+        key = (case["book"], case["preset"])
+        if key not in best or case["total"] < best[key]["total"]:
+            best[key] = case
+    return best
+
+
+def print_report(document: dict):
+    """Print per-stage timings of the fastest run of every book and preset."""
+    header = f"{'Book':<8} {'Preset':<45} " + " ".join(f"{s[:10]:>10}" for s in STAGES) + f" {'x RT':>8}"
+    print("\n" + header)
+    print("-" * len(header))
+    for (book, preset_name), case in sorted(_best_runs(document).items()):
+        cells = " ".join(f"{case['stages'].get(s, 0):10.3f}" for s in STAGES)
+        print(f"{book:<8} {preset_name:<45} {cells} {case['realtime_factor']:>8}")
+
+
+def compare(old_path: str, new_path: str):
+    """Print stage timings of two result files side by side with the relative change."""
+    with open(old_path, "r", encoding="utf-8") as f:
+        old = _best_runs(json.load(f))
+    with open(new_path, "r", encoding="utf-8") as f:
+        new = _best_runs(json.load(f))
+
+    for key in sorted(set(old) & set(new)):
+        book, preset_name = key
+        print(f"\n{book} / {preset_name}")
+        for stage in STAGES + ["total"]:
+            a = old[key]["stages"].get(stage) if stage != "total" else old[key]["total"]
+            b = new[key]["stages"].get(stage) if stage != "total" else new[key]["total"]
+            if a is None or b is None:
+                continue
+            change = f"{100 * (b - a) / a:+7.1f}%" if a else "    n/a"
+            print(f"  {stage:<12} {a:10.3f}s -> {b:10.3f}s  {change}")
+        for field in ("realtime_factor", "peak_child_rss_mb", "output_bytes"):
+            print(f"  {field:<18} {old[key].get(field)} -> {new[key].get(field)}")
+
+    for key in sorted(set(old) ^ set(new)):
+        print(f"\nOnly in {'old' if key in old else 'new'}: {key[0]} / {key[1]}")
+
+
+# -------------------------------
+# Main
+# -------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the audiobook pipeline on synthetic books.")
+    parser.add_argument("--book", action="append", type=parse_book_spec, default=[],
+                        help="Book to generate as name:files:seconds:bitrate (repeatable; default: small, medium, large)")
+    parser.add_argument("-p", "--preset", action="append", default=[],
+                        help="Preset to benchmark (repeatable; default: all presets)")
+    parser.add_argument("--presets-file", metavar="PATH",
+                        help="Load extra presets from a TOML or JSON file (see main.py --presets-file)")
+    parser.add_argument("--signal", choices=["sine", "noise"], default="sine",
+                        help="Synthetic audio content (noise is harder to encode)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Runs per book and preset; the fastest is reported")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "audiobook_benchmark"),
+                        help="Where synthetic books are generated and kept between runs")
+    parser.add_argument("-o", "--output", default="benchmark_results.json",
+                        help="JSON file to write the results to")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="Compare two result files instead of running the benchmark")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    if args.presets_file:
+        try:
+            load_user_presets(args.presets_file)
+        except PresetError as e:
+            parser.error(str(e))
+
+    preset_names = args.preset or list(PRESETS)
+    unknown = [p for p in preset_names if p not in PRESETS]
+    if unknown:
+        parser.error(f"Unknown preset(s): {', '.join(unknown)}")
+
+    books = dict(args.book) if args.book else DEFAULT_BOOKS
+    document = run_benchmark(books, preset_names, args.work_dir, args.signal, max(1, args.repeat),
+                             args.presets_file)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(document, f, indent=2)
+    print_report(document)
+    print(f"\nResults written to {args.output}")
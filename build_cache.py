@@ -0,0 +1,165 @@
+# build_cache.py
+import os
+import json
+import time
+import hashlib
+import threading
+from logger import info, warning
+
+MANIFEST_NAME = ".audiobook_manifest.json"
+MANIFEST_VERSION = 1
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path: str) -> str:
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint_file(path: str, previous: dict = None) -> dict:
+    """
+    Return {'size', 'mtime_ns', 'sha256'} for a file.
+    The content hash is only recomputed when size or mtime changed since
+    `previous`, so unchanged files cost a single stat() call.
+    """
+    st = os.stat(path)
+    if previous and previous.get("size") == st.st_size and previous.get("mtime_ns") == st.st_mtime_ns:
+        return dict(previous)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": hash_file(path)}
+
+
+def _same_content(a: dict, b: dict) -> bool:
+    if a is None or b is None:
+        return a is b
+    return a.get("size") == b.get("size") and a.get("sha256") == b.get("sha256")
+
+
+class BuildManifest:
+    """
+    Persistent per-book build record stored as JSON in the library root.
+    Books are keyed by their folder path relative to the root; further
+    editions of a book (multi-target mode) add a `target` name to the key.
+    Safe to use from several worker threads.
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        self.path = os.path.join(root_dir, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self.books = self._load()
+
+    def _load(self) -> dict:
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != MANIFEST_VERSION:
+                warning(f"Ignoring build manifest with unknown version: {self.path}")
+                return {}
+            return data.get("books", {})
+        except (OSError, ValueError) as e:
+            warning(f"Could not read build manifest {self.path}: {e}")
+            return {}
+
+    def save(self):
+        """Write the manifest atomically."""
+        with self._lock:
+            data = {"version": MANIFEST_VERSION, "books": self.books}
+            tmp_path = self.path + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, indent=2, sort_keys=True)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                warning(f"Could not write build manifest {self.path}: {e}")
+
+    def _key(self, folder: str, target: str = None) -> str:
+        key = os.path.relpath(folder, self.root_dir).replace("\\", "/")
+        return f"{key}#{target}" if target else key
+
+    def fingerprint(self, folder: str, audio_files: list, cover_path: str, preset: dict,
+                    target: str = None, options: dict = None) -> dict:
+        """
+        Build the current fingerprint of a book, reusing stored hashes for
+        files whose size and mtime are unchanged. `options` are the run
+        settings besides the preset that change the output file.
+        """
+        with self._lock:
+            previous = self.books.get(self._key(folder, target), {})
+        old_files = previous.get("files", {})
+
+        files = {}
+        for path in audio_files:
+            name = os.path.basename(path)
+            files[name] = fingerprint_file(path, old_files.get(name))
+
+        cover = None
+        if cover_path:
+            old_cover = previous.get("cover")
+            if old_cover and old_cover.get("name") != os.path.basename(cover_path):
+                old_cover = None
+            cover = fingerprint_file(cover_path, old_cover)
+            cover["name"] = os.path.basename(cover_path)
+
+        return {"files": files, "cover": cover, "preset": preset, "options": options or {}}
+
+    def is_up_to_date(self, folder: str, fingerprint: dict, output_file: str, target: str = None) -> bool:
+        """
+        Return True if the book was built from identical inputs and its
+        output (or every volume of it) still exists.
+        """
+        with self._lock:
+            entry = self.books.get(self._key(folder, target))
+        if not entry or entry.get("output") != output_file:
+            return False
+        outputs = entry.get("volumes") or [{"output": output_file, "output_size": entry.get("output_size")}]
+        for volume in outputs:
+            if not os.path.isfile(volume["output"]) or os.path.getsize(volume["output"]) != volume["output_size"]:
+                return False
+        if entry.get("preset") != fingerprint["preset"] or entry.get("options") != fingerprint["options"]:
+            return False
+        if not _same_content(entry.get("cover"), fingerprint["cover"]):
+            return False
+
+        old_files = entry.get("files", {})
+        new_files = fingerprint["files"]
+        if list(old_files) != list(new_files):
+            return False
+        return all(_same_content(old_files[name], new_files[name]) for name in new_files)
+
+    def refresh(self, folder: str, fingerprint: dict, target: str = None):
+        """
+        Store new size/mtime values for an up-to-date book whose files were
+        touched but not changed, so the next run does not hash them again.
+        """
+        key = self._key(folder, target)
+        with self._lock:
+            entry = self.books.get(key)
+            if not entry or (entry.get("files") == fingerprint["files"]
+                             and entry.get("cover") == fingerprint["cover"]):
+                return
+            entry["files"] = fingerprint["files"]
+            entry["cover"] = fingerprint["cover"]
+        self.save()
+
+    def record(self, folder: str, fingerprint: dict, output_file: str, target: str = None, volumes: list = None):
+        """
+        Store a successful build and persist the manifest. A book split
+        into `volumes` (their paths) is still keyed by its `output_file`.
+        """
+        entry = dict(fingerprint)
+        entry["output"] = output_file
+        if volumes:
+            entry["volumes"] = [{"output": path, "output_size": os.path.getsize(path)} for path in volumes]
+        else:
+            entry["output_size"] = os.path.getsize(output_file)
+        entry["built_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        with self._lock:
+            self.books[self._key(folder, target)] = entry
+        self.save()
+        info(f"Recorded build of {folder} in {MANIFEST_NAME}")
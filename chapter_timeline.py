@@ -0,0 +1,218 @@
+# chapter_timeline.py
+import re
+import subprocess
+from fractions import Fraction
+from logger import info, warning, error
+from probe import probe_file
+from mp3_remux import scan_mp3, MP3RemuxError
+from input_formats import mp4_frames, opus_frames
+
+# Worst-case chapter drift (seconds) tolerated by verify_timeline
+DRIFT_TOLERANCE = 0.05
+
+OPUS_SAMPLE_RATE = 48000
+
+
+def length_from_samples(samples: int, sample_rate: int) -> Fraction:
+    """Exact length in seconds of `samples` samples at `sample_rate`."""
+    return Fraction(samples, sample_rate)
+
+
+def mp3_samples(path: str) -> int:
+    """
+    Samples FFmpeg decodes from an MP3 file: its frame count times the
+    samples per frame, minus the LAME encoder delay and padding (which the
+    demuxer trims). Frames are counted from the headers, without decoding.
+    """
+    scan = scan_mp3(path)
+    return scan["frames"] * scan["frame"]["samples"] - scan["delay"] - scan["padding"]
+
+
+def frame_layout(path: str, codec: str) -> dict:
+    """
+    {'frames', 'frame_samples', 'delay'} of an MP3, AAC (MP4) or Opus file,
+    counted from its headers (MP3 adds the LAME 'padding'); None for other
+    codecs.
+    """
+    if codec == "mp3":
+        scan = scan_mp3(path)
+        return {"frames": scan["frames"], "frame_samples": scan["frame"]["samples"],
+                "delay": scan["delay"], "padding": scan["padding"]}
+    if codec == "aac" and path.lower().endswith((".m4a", ".m4b", ".mp4")):
+        return mp4_frames(path)
+    if codec == "opus":
+        return opus_frames(path)
+    return None
+
+
+def file_samples(path: str, probe, copy: bool = False) -> int:
+    """
+    Samples one input file adds to the joined stream, at its own rate.
+
+    A decode yields what FFmpeg decodes from the file: MP3 frames minus the
+    LAME delay and padding (see mp3_samples), MP4 frames minus the priming
+    the edit list skips (FFmpeg keeps the last frame whole), and the count
+    the header records for other formats (FLAC STREAMINFO, the last Ogg
+    granule position minus the Opus pre-skip). A stream copy (`copy`) keeps
+    every frame, so MP3, AAC and Opus files count whole frames there.
+    """
+    samples = round(probe.duration * probe.sample_rate)
+    if not copy and probe.codec not in ("mp3", "aac"):
+        return samples
+    try:
+        layout = frame_layout(path, probe.codec)
+    except (OSError, ValueError, KeyError, MP3RemuxError) as e:
+        warning(f"Could not count the frames of {path} ({e}). Using its header length.")
+        return samples
+    if layout is None:
+        return samples
+    frames = layout["frames"] * layout["frame_samples"]
+    if copy:
+        return frames
+    return frames - layout["delay"] - layout.get("padding", 0)
+
+
+def file_lengths(paths: list, probes: list = None, copy: bool = False) -> list:
+    """
+    Return the length of every file in the joined stream as a Fraction of
+    seconds, in whole samples at each file's own rate (see file_samples).
+    Files without a probe record are probed.
+    """
+    lengths = []
+    for idx, path in enumerate(paths):
+        probe = probes[idx] if probes and idx < len(probes) else probe_file(path)
+        if not probe.ok or not probe.sample_rate:
+            raise ValueError(f"Cannot determine the length of {path}: {probe.error}")
+        lengths.append(length_from_samples(file_samples(path, probe, copy), probe.sample_rate))
+    return lengths
+
+
+def chapter_lengths(chapters: list, probes: list = None, copy: bool = False) -> list:
+    """Length of every chapter (one input file each) in the joined stream; see file_lengths."""
+    return file_lengths([chapter["file"] for chapter in chapters], probes, copy)
+
+
+def build_timeline(chapters: list, lengths: list, rate: int) -> list:
+    """
+    Lay chapters end to end on an integer timeline with timebase 1/`rate`.
+    Offsets are accumulated exactly and rounded once per boundary, so
+    rounding errors never build up over many chapters.
+    Returns [{'title', 'start', 'end'}, ...] with start/end in 1/`rate` units.
+    """
+    timeline = []
+    position = Fraction(0)
+    for chapter, length in zip(chapters, lengths):
+        start = round(position * rate)
+        position += length
+        end = round(position * rate)
+        timeline.append({"title": chapter["title"], "start": start, "end": end})
+    return timeline
+
+
+def escape_ffmetadata(value: str) -> str:
+    """Escape the characters FFMETADATA treats as special ('=', ';', '#', '\\', newline)."""
+    value = str(value)
+    for char in ("\\", "=", ";", "#", "\n"):
+        value = value.replace(char, "\\" + char)
+    return value
+
+
+def format_ffmetadata_chapters(timeline: list, rate: int) -> str:
+    """Return the [CHAPTER] sections of an FFMETADATA document."""
+    lines = []
+    for chapter in timeline:
+        lines.append("[CHAPTER]")
+        lines.append(f"TIMEBASE=1/{rate}")
+        lines.append(f"START={chapter['start']}")
+        lines.append(f"END={chapter['end']}")
+        lines.append(f"title={escape_ffmetadata(chapter['title'])}")
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def read_chapters(media_file: str) -> list:
+    """
+    Read the chapter table of a finished file through FFmpeg's ffmetadata
+    muxer (headers only, no decoding).
+    Returns [(start_seconds, end_seconds, title), ...].
+    """
+    # -copyts keeps chapter times relative to the file start instead of the
+    # first audio packet (which MP3 encoder delay would shift)
+    cmd = ["ffmpeg", "-v", "error", "-i", media_file, "-copyts", "-f", "ffmetadata", "-"]
+    proc = subprocess.run(cmd, check=True, capture_output=True, text=True, encoding="utf-8")
+
+    chapters = []
+    current = None
+    for line in proc.stdout.splitlines():
+        line = line.strip()
+        if line == "[CHAPTER]":
+            current = {"timebase": Fraction(1, 1000), "start": 0, "end": 0, "title": ""}
+            chapters.append(current)
+        elif line.startswith("[") and line.endswith("]"):
+            current = None
+        elif current is not None and "=" in line:
+            key, value = line.split("=", 1)
+            key = key.strip().upper()
+            if key == "TIMEBASE":
+                current["timebase"] = Fraction(value.strip())
+            elif key == "START":
+                current["start"] = int(value)
+            elif key == "END":
+                current["end"] = int(value)
+            elif key == "TITLE":
+                current["title"] = value
+
+    return [
+        (float(c["start"] * c["timebase"]), float(c["end"] * c["timebase"]), c["title"])
+        for c in chapters
+    ]
+
+
+def read_duration(media_file: str) -> float:
+    """
+    Duration of a finished file as FFmpeg's demuxer reports it (edit lists
+    and Ogg pre-skip applied), to 10 ms; None if it has none.
+    """
+    proc = subprocess.run(["ffmpeg", "-hide_banner", "-i", media_file],
+                          capture_output=True, text=True, encoding="utf-8", errors="replace")
+    match = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", proc.stderr)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def verify_timeline(media_file: str, timeline: list, rate: int,
+                    tolerance: float = DRIFT_TOLERANCE):
+    """
+    Compare the chapter table written to `media_file` with the expected
+    timeline and report the worst-case drift in seconds. The length of the
+    audio FFmpeg finds in the file is checked against the timeline's end,
+    so lengths that do not match the joined audio show up as drift.
+    Returns the drift, or None if the chapters could not be read.
+    """
+    try:
+        written = read_chapters(media_file)
+        duration = read_duration(media_file)
+    except (OSError, subprocess.CalledProcessError) as e:
+        error(f"Could not read chapters from {media_file}: {e}")
+        return None
+
+    if len(written) != len(timeline):
+        warning(f"Chapter count mismatch in {media_file}: expected {len(timeline)}, found {len(written)}")
+
+    drift = 0.0
+    worst = None
+    for expected, (start, _, title) in zip(timeline, written):
+        delta = abs(start - expected["start"] / rate)
+        if delta > drift:
+            drift, worst = delta, title
+    if timeline and duration is not None:
+        delta = abs(duration - timeline[-1]["end"] / rate)
+        if delta > drift:
+            drift, worst = delta, "end of audio"
+
+    if drift > tolerance:
+        warning(f"Chapter drift in {media_file}: {drift * 1000:.1f} ms at '{worst}'")
+    else:
+        info(f"Chapter timeline verified: worst-case drift {drift * 1000:.1f} ms")
+    return drift
@@ -0,0 +1,118 @@
+# concat_preflight.py
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from logger import info, warning, error
+from scheduler import run_child
+
+# Encoder and container used to conform an outlier to each codec
+CONFORM_ENCODERS = {
+    "mp3": ("libmp3lame", ".mp3"),
+    "aac": ("aac", ".m4a"),
+    "alac": ("alac", ".m4a"),
+    "opus": ("libopus", ".ogg"),
+    "vorbis": ("libvorbis", ".ogg"),
+    "flac": ("flac", ".flac"),
+    "wma": ("wmav2", ".wma"),
+}
+
+
+# Sample formats giving each bit depth, per lossless encoder
+LOSSLESS_SAMPLE_FORMATS = {"flac": ("s16", "s32"), "alac": ("s16p", "s32p")}
+
+
+def stream_key(probe) -> tuple:
+    """The stream parameters that must match for concat-demuxer stream copy."""
+    bits = probe.bits_per_sample if probe.codec in ("flac", "alac") else 0
+    return (probe.codec, probe.sample_rate, probe.channels, bits)
+
+
+def group_by_stream(probes: list) -> dict:
+    """Group file indices by (codec, sample_rate, channels, bits_per_sample)."""
+    groups = {}
+    for idx, probe in enumerate(probes):
+        groups.setdefault(stream_key(probe), []).append(idx)
+    return groups
+
+
+def mixed_codecs(probes: list) -> bool:
+    """
+    True if the files do not all share one codec. The concat demuxer
+    decodes every file with the first file's decoder, so even an encode
+    needs the outliers conformed then.
+    """
+    return len({p.codec for p in probes}) > 1
+
+
+def main_group(probes: list):
+    """
+    Return (key, indices) of the group holding most of the book's audio.
+    Files outside it are the outliers that need conforming.
+    """
+    groups = group_by_stream(probes)
+    key = max(groups, key=lambda k: sum(probes[i].duration for i in groups[k]))
+    return key, groups[key]
+
+
+def conform_file(src: str, dst: str, key: tuple, bitrate: int) -> bool:
+    """Re-encode one file to the main group's codec, sample rate, channels and bit depth."""
+    codec, sample_rate, channels, bits = key
+    encoder, _ = CONFORM_ENCODERS[codec]
+    cmd = ["ffmpeg", "-y", "-v", "error", "-i", src, "-vn", "-map_metadata", "-1",
+           "-c:a", encoder, "-ar", str(sample_rate), "-ac", str(channels)]
+    if bits and encoder in LOSSLESS_SAMPLE_FORMATS:
+        # FLAC cannot switch bit depth mid-stream
+        short, wide = LOSSLESS_SAMPLE_FORMATS[encoder]
+        cmd.extend(["-sample_fmt", short if bits <= 16 else wide, "-bits_per_raw_sample", str(bits)])
+    if bitrate:
+        cmd.extend(["-b:a", f"{max(8, bitrate // 1000)}k"])
+    cmd.append(dst)
+    try:
+        run_child(cmd, threads=1, check=True)
+        return True
+    except subprocess.CalledProcessError as e:
+        error(f"Failed to conform {src}: {e}")
+        return False
+
+
+def conform_outliers(input_files: list, probes: list, scratch_dir: str, jobs: int = None):
+    """
+    Make a stream-copy concat safe for books with mixed stream parameters.
+
+    Files whose codec, sample rate, channel count or (lossless) bit depth
+    differ from the main group are re-encoded in parallel into
+    `scratch_dir`; every other file is used as is, so the bulk of the book
+    is still stream-copied.
+
+    Returns the list of files to concatenate (same order and length as
+    `input_files`), or None if an outlier could not be conformed.
+    """
+    if not probes or len(probes) != len(input_files):
+        return list(input_files)
+
+    key, indices = main_group(probes)
+    main = set(indices)
+    outliers = [i for i in range(len(probes)) if i not in main]
+    if not outliers:
+        return list(input_files)
+
+    if key[0] not in CONFORM_ENCODERS:
+        warning(f"Cannot conform files to codec '{key[0]}'. Concat may fail.")
+        return list(input_files)
+
+    _, ext = CONFORM_ENCODERS[key[0]]
+    bitrate = max(probes[i].bitrate for i in indices)
+    info(f"Conforming {len(outliers)} of {len(probes)} file(s) to "
+         f"{key[0]} {key[1]} Hz {key[2]}ch before the concat.")
+
+    targets = {i: os.path.join(scratch_dir, f"conformed_{i:04d}{ext}") for i in outliers}
+    jobs = jobs or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        ok = list(pool.map(
+            lambda i: conform_file(input_files[i], targets[i], key, bitrate),
+            outliers
+        ))
+    if not all(ok):
+        return None
+
+    return [targets.get(i, path) for i, path in enumerate(input_files)]
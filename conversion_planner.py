@@ -0,0 +1,141 @@
+# conversion_planner.py
+import os
+from logger import info
+from concat_preflight import main_group
+
+# FFmpeg encoder name -> codec name reported by the probe stage
+ENCODER_CODECS = {
+    "aac": "aac",
+    "libfdk_aac": "aac",
+    "libopus": "opus",
+    "libmp3lame": "mp3",
+    "flac": "flac",
+}
+
+# Native audiobook container for each codec
+CODEC_CONTAINERS = {
+    "mp3": ".mp3",
+    "aac": ".m4b",
+    "alac": ".m4b",
+    "opus": ".ogg",
+    "vorbis": ".ogg",
+    "flac": ".flac",
+    "wma": ".wma",
+}
+
+# Inputs up to this much above the target bitrate still count as "at" it
+BITRATE_TOLERANCE = 0.05
+
+COPY_PRESET = {"codec": "copy", "bitrate": None, "channels": None}
+
+# Codecs whose files cannot be joined by stream copy, with the lossless
+# encode used instead: FLAC frames carry their own sample numbers and the
+# joined file would keep the first file's STREAMINFO (length and MD5)
+LOSSLESS_REENCODE = {"flac": {"codec": "flac", "bitrate": None, "channels": None}}
+
+
+def parse_bitrate(value) -> int:
+    """Convert a preset bitrate such as '64k' or '1.5M' to bits per second."""
+    if value is None:
+        return None
+    text = str(value).strip().lower()
+    scale = 1
+    if text.endswith("k"):
+        scale, text = 1000, text[:-1]
+    elif text.endswith("m"):
+        scale, text = 1_000_000, text[:-1]
+    return int(float(text) * scale)
+
+
+def output_extension(preset: dict, input_files: list) -> str:
+    """Container extension for a preset (the input's own for 'copy')."""
+    codec = preset.get("codec")
+    if codec == "copy":
+        return os.path.splitext(input_files[0])[1].lower()
+    return CODEC_CONTAINERS.get(ENCODER_CODECS.get(codec), ".m4b")
+
+
+def plan_conversion(probes: list, preset: dict, input_files: list) -> dict:
+    """
+    Pick the cheapest correct way to produce a book with `preset`:
+
+      copy      - stream copy into the inputs' own container; used when the
+                  inputs are already at or below the target bitrate and
+                  channel count, so a re-encode could only lose quality
+      remux     - the inputs already use the target codec and fit the
+                  target; stream copy into the target container
+      transcode - full decode and encode with the preset; several FLAC
+                  files that would be copied get a lossless FLAC encode
+                  instead (see LOSSLESS_REENCODE)
+
+    The decision is made on the main group of files (see concat_preflight);
+    outliers with other stream parameters are conformed before the copy.
+    Returns {'mode', 'preset', 'ext', 'reason'}.
+    """
+    def plan(mode, plan_preset, reason):
+        return {
+            "mode": mode,
+            "preset": plan_preset,
+            "ext": output_extension(plan_preset, input_files),
+            "reason": reason,
+        }
+
+    if not probes or not all(p.ok for p in probes):
+        if preset.get("codec") == "copy":
+            return plan("copy", preset, "copy preset selected")
+        return plan("transcode", preset, "some inputs could not be probed")
+
+    if preset.get("codec") == "copy":
+        # Keep the container of the main group, which the outliers are conformed to
+        (source_codec, _, _, _), indices = main_group(probes)
+        if source_codec in LOSSLESS_REENCODE and len(input_files) > 1:
+            return _lossless_plan(plan, source_codec)
+        return plan("copy", preset, "copy preset selected") | {
+            "ext": os.path.splitext(input_files[indices[0]])[1].lower()
+        }
+
+    if preset.get("loudness"):
+        return plan("transcode", preset, "loudness normalization needs a re-encode")
+    if preset.get("trim_silence") or preset.get("speech"):
+        return plan("transcode", preset, "silence trimming and the speech profile need a re-encode")
+    if preset.get("encoder_options"):
+        return plan("transcode", preset, "the preset sets encoder options")
+
+    (source_codec, _, channels, _), indices = main_group(probes)
+    if source_codec not in CODEC_CONTAINERS:
+        return plan("transcode", preset, f"no copy container for {source_codec}")
+
+    target_bitrate = parse_bitrate(preset.get("bitrate"))
+    target_channels = preset.get("channels")
+    max_bitrate = max(probes[i].bitrate for i in indices)
+
+    if target_bitrate and max_bitrate > target_bitrate * (1 + BITRATE_TOLERANCE):
+        return plan("transcode", preset, f"inputs are {max_bitrate // 1000}k, above the target {target_bitrate // 1000}k")
+    if target_channels and channels > target_channels:
+        return plan("transcode", preset, f"inputs have {channels} channels, target has {target_channels}")
+    target_rate = preset.get("sample_rate")
+    if target_rate and any(probes[i].sample_rate != target_rate for i in indices):
+        return plan("transcode", preset, f"inputs are not at the target sample rate {target_rate} Hz")
+
+    if source_codec in LOSSLESS_REENCODE and len(input_files) > 1:
+        return _lossless_plan(plan, source_codec)
+    reason = f"inputs ({source_codec}, {max_bitrate // 1000}k, {channels}ch) already fit the target"
+    if ENCODER_CODECS.get(preset.get("codec")) == source_codec:
+        target_ext = output_extension(preset, input_files)
+        if target_ext != os.path.splitext(input_files[0])[1].lower():
+            remux = plan("remux", COPY_PRESET, reason)
+            remux["ext"] = target_ext
+            return remux
+    return plan("copy", COPY_PRESET, reason)
+
+
+def _lossless_plan(plan, source_codec: str) -> dict:
+    """Transcode plan for inputs that would be stream-copied but cannot be joined that way."""
+    return plan("transcode", LOSSLESS_REENCODE[source_codec],
+                f"{source_codec} files cannot be joined by stream copy; re-encoding losslessly")
+
+
+def log_plan(folder: str, plan: dict):
+    """Log the chosen conversion path for a book."""
+    info(f"Conversion plan for {os.path.basename(os.path.normpath(folder))}: "
+         f"{plan['mode']} ({plan['reason']})")
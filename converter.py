@@ -1,10 +1,25 @@
 # converter.py
 import os
+import shutil
 import subprocess
+import tempfile
+from itertools import accumulate
 from logger import info, warning, error
-from cover_art import find_cover_art, generate_vorbis_picture_tag
-from mutagen import File
-from mutagen.mp3 import MP3
+from cover_art import find_cover_art
+from ffmpeg_runner import run_ffmpeg, pipes_supported, PipeInput
+from concat_preflight import conform_outliers, mixed_codecs
+from split_encoder import supports_split_encode, split_encode
+from chapter_timeline import (
+    OPUS_SAMPLE_RATE, file_lengths, frame_layout, build_timeline,
+    format_ffmetadata_chapters, verify_timeline
+)
+from probe import probe_file
+from mp3_remux import MP3RemuxError, remux_mp3
+from instrumentation import span
+from loudness import gain_filter
+from silence_trim import speech_filters, trimmed_lengths
+from presets import encoder_args
+from patcher import patch_book, timeline_chapters
 
 def convert_to_audiobook(
     mp3_files: list,
@@ -12,19 +27,78 @@ def convert_to_audiobook(
     preset: dict,
     metadata: dict = None,
     chapters: list = None,
-    folder: str = None
+    folder: str = None,
+    work_dir: str = None,
+    threads: int = None,
+    split: bool = False,
+    probes: list = None,
+    verify_chapters: bool = False,
+    progress=None,
+    label: str = None,
+    cover_art: str = None,
+    use_pipes: bool = False,
+    native_mp3: bool = True,
+    gains: list = None,
+    trims: list = None
 ):
     """
-    Convert MP3 files into an audiobook with chapters, metadata, and cover art.
+    Convert audio files (MP3, M4A, FLAC, Ogg, WMA; see input_formats) into an
+    audiobook with chapters, metadata, and cover art.
     Supports M4B/AAC, MP3, and OGG/Opus containers.
+
+    Temporary files go into a private scratch directory (created inside
+    `work_dir` if given), so several conversions can run at the same time.
+    `threads` caps the number of threads FFmpeg may use.
+
+    With `split`, AAC output is encoded one input file at a time in parallel
+    (up to `threads` encoders) and stitched losslessly into the same audio
+    and chapter offsets as a single encode (see split_encoder.split_encode).
+
+    `probes` are the AudioProbe records for `mp3_files`; when given, no file
+    is parsed again here.
+
+    Chapter offsets are kept as exact sample counts and written with a
+    sample-rate timebase. They follow the joined stream: an encode declares
+    every file's decoded length in the concat list and retimes the audio
+    onto it, a stream copy counts whole frames (see
+    chapter_timeline.file_lengths). With `verify_chapters`, the chapter
+    table and length of the finished file are read back and the worst-case
+    drift is reported.
+
+    FFmpeg progress is logged as it runs; pass a BatchProgress as `progress`
+    to aggregate speed and ETA over a whole batch under the name `label`.
+
+    `cover_art` is the (already prepared) cover image; if not given, one is
+    looked up in `folder`. A JPEG cover is embedded without re-encoding.
+
+    With `use_pipes` (POSIX only), the concat list and the FFMETADATA
+    document are streamed to FFmpeg over inherited pipes instead of being
+    written to the scratch directory.
+
+    With `native_mp3`, a stream copy of MP3 inputs into an MP3 file is done
+    in-process by mp3_remux (no FFmpeg); FFmpeg is used if the inputs do
+    not share their stream parameters.
+
+    `gains` are loudness corrections in dB, one per input file (see
+    loudness.compute_gains). They are applied as an audio filter in the
+    encode itself; stream copies cannot be corrected.
+
+    `trims` are (inpoint, outpoint) pairs in seconds, one per input file
+    (see silence_trim.find_book_edges); each file is cut to its range and
+    the chapter offsets are rebased to the trimmed lengths. A preset with
+    "speech" adds a voice-band filter (and Opus' voip mode) to the encode.
+
+    Returns False on failure, otherwise what was written: {'duration' (the
+    joined audio in seconds), 'timeline', 'rate'} with the chapter timeline
+    the output got (None without chapters) on its 1/`rate` clock.
     """
     if not mp3_files:
-        warning("No MP3 files provided for conversion.")
+        warning("No audio files provided for conversion.")
         return False
 
-    temp_list_file = "temp_file_list.txt"
-    metadata_file = "ffmetadata.txt"
-    vorbis_picture_tag = None
+    scratch_dir = tempfile.mkdtemp(prefix="audiobook_", dir=work_dir)
+    temp_list_file = os.path.join(scratch_dir, "temp_file_list.txt")
+    metadata_file = os.path.join(scratch_dir, "ffmetadata.txt")
 
     # Determine container type
     _, ext = os.path.splitext(output_file)
@@ -33,88 +107,132 @@ def convert_to_audiobook(
     is_opus = ext in [".ogg", ".opus"] or (preset.get("codec") == "libopus")
     is_mp3 = ext == ".mp3"
 
-    # Write MP3 file list for FFmpeg concat
-    try:
-        with open(temp_list_file, "w", encoding="utf-8") as f:
-            for mp3 in mp3_files:
-                path = os.path.abspath(mp3).replace("\\", "/").replace("'", "'\\''")
-                f.write(f"file '{path}'\n")
-    except Exception as e:
-        error(f"Failed to write temp file list: {e}")
-        return False
+    # Stream copy needs identical stream parameters, an encode at least one
+    # codec: conform the outliers only
+    concat_files = mp3_files
+    if probes and (preset.get("codec") == "copy" or mixed_codecs(probes)):
+        with span("conform", files=len(mp3_files)):
+            concat_files = conform_outliers(mp3_files, probes, scratch_dir, jobs=threads)
+        if concat_files is None:
+            error("Could not conform mismatched input files for concat.")
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+            return False
+
+    # MP3 -> MP3 stream copy: join the frames in-process
+    if native_mp3 and is_mp3 and preset.get("codec") == "copy" and \
+            all(f.lower().endswith(".mp3") for f in concat_files):
+        done = _native_mp3_remux(concat_files, output_file, metadata, chapters,
+                                 cover_art or (find_cover_art(folder) if folder else None),
+                                 verify_chapters)
+        if done is not None:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+            return done
+
+    if gains and preset.get("codec") == "copy":
+        warning("Loudness normalization needs a re-encode. Skipped for stream copy.")
+        gains = None
+    if trims and preset.get("codec") == "copy":
+        warning("Silence trimming needs a re-encode. Skipped for stream copy.")
+        trims = None
+
+    # Length of every file in the joined stream: the chapter timeline is
+    # laid out from them, and an encode declares them in the concat list
+    copy = preset.get("codec") == "copy"
+    concat_probes = probes if concat_files == mp3_files else None
+    lengths = _joined_lengths(concat_files, concat_probes, trims, copy)
+
+    # Audio file list for FFmpeg concat
+    # Over a pipe, entries need an explicit file: protocol (they would
+    # otherwise be resolved relative to the pipe: URL)
+    piped = use_pipes and pipes_supported()
+    concat_text = _concat_list(concat_files, trims, piped, None if copy else lengths)
+
+    # Split-encode: encode segments in parallel, stitch, then only remux below
+    stitched_file = None
+    stitched_timestamps = None
+    if split:
+        if is_m4b and supports_split_encode(preset) and lengths:
+            first = probes[0] if probes else probe_file(mp3_files[0])
+            sample_rate = preset.get("sample_rate") or first.sample_rate
+            with span("split_encode", files=len(mp3_files), jobs=threads):
+                stitched_file, stitched_timestamps = split_encode(
+                    lengths, _segment_input(concat_files, trims, lengths, preset, gains),
+                    preset, scratch_dir, jobs=threads, sample_rate=sample_rate
+                )
+            if not stitched_file:
+                warning("Split-encode failed. Falling back to a single FFmpeg encode.")
+        elif is_m4b and supports_split_encode(preset):
+            warning("Split-encode needs the input lengths. Using a single FFmpeg encode.")
+        else:
+            warning("Split-encode is only supported for AAC/M4B presets. Using a single FFmpeg encode.")
 
     # Cover art
-    cover_art_path = find_cover_art(folder) if folder else None
+    cover_art_path = cover_art or (find_cover_art(folder) if folder else None)
     if cover_art_path:
-        info(f"Found cover art: {cover_art_path}")
-        if is_opus:
-            vorbis_picture_tag = generate_vorbis_picture_tag(cover_art_path)
-            if vorbis_picture_tag:
-                info(f"Added Vorbis picture tag to metadata for {cover_art_path}")
-            else:
-                warning("Failed to generate Vorbis picture tag. Cover art will be skipped.")
+        info(f"Using cover art: {cover_art_path}")
+
+    # Chapter timeline: exact lengths on the output stream's sample clock
+    timeline = None
+    timeline_rate = None
+    if chapters:
+        timeline_rate = _timeline_rate(preset, is_opus, probes)
+        timeline = _chapter_timeline(chapters, lengths, timeline_rate)
 
         # Chapters and metadata
+    metadata_text = None
     if chapters:
-        metadata_file = "ffmetadata.txt"
-        try:
-            with open(metadata_file, "w", encoding="utf-8") as f:
-                # Always start with FFmetadata header
-                f.write(";FFMETADATA1\n")
-
-                if metadata.get("title"):
-                    f.write(f"title={metadata['title']}\n")
-                if metadata.get("author"):
-                    f.write(f"artist={metadata['author']}\n")  # AAC players use 'artist'
-                if metadata.get("album"):
-                    f.write(f"album={metadata['album']}\n")
-                if metadata.get("genre"):
-                    f.write(f"genre={metadata['genre']}\n")
-                if metadata.get("year"):
-                    f.write(f"date={metadata['year']}\n")
-                if metadata.get("comment"):
-                    f.write(f"comment={metadata['comment']}\n")
-
-                # For OGG/Opus: put the Vorbis picture tag *first*
-                if is_opus and vorbis_picture_tag:
-                    f.write(f"METADATA_BLOCK_PICTURE={vorbis_picture_tag}\n")
-
-                start_time = 0.0
-                for idx, chapter in enumerate(chapters, start=1):
-                    audio = MP3(chapter['file'])
-                    duration = audio.info.length
-
-                    if is_opus:
-                        # ms precision
-                        start_ms = int(start_time * 1000)
-                        end_ms = int((start_time + duration) * 1000)
-
-                        f.write("[CHAPTER]\nTIMEBASE=1/1000\n")
-                        f.write(f"START={start_ms}\nEND={end_ms}\n")
-                        f.write(f"title={chapter['title']}\n")
-                    else:
-                        # whole seconds
-                        start_sec = int(start_time)
-                        end_sec = int(start_time + duration)
-
-                        f.write("[CHAPTER]\nTIMEBASE=1/1\n")
-                        f.write(f"START={start_sec}\nEND={end_sec}\n")
-                        f.write(f"title={chapter['title']}\n")
-
-                    start_time += duration
+        metadata_text = _ffmetadata_text(metadata, timeline, timeline_rate)
 
+    # Hand the concat list and metadata to FFmpeg: over pipes, or as temp files
+    pipes = []
+    list_input = temp_list_file
+    if use_pipes and not piped:
+        warning("Pipe inputs are not supported on this platform. Using temporary files.")
+    if piped:
+        list_pipe = PipeInput(concat_text)
+        pipes.append(list_pipe)
+        list_input = list_pipe.url
+        if metadata_text:
+            metadata_pipe = PipeInput(metadata_text)
+            pipes.append(metadata_pipe)
+            metadata_file = metadata_pipe.url
+        else:
+            metadata_file = None
+        temp_list_file = None
+    else:
+        try:
+            with open(temp_list_file, "w", encoding="utf-8") as f:
+                f.write(concat_text)
         except Exception as e:
-            error(f"Failed to create chapter metadata: {e}")
+            error(f"Failed to write temp file list: {e}")
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+            return False
+
+        if metadata_text:
+            try:
+                with open(metadata_file, "w", encoding="utf-8") as f:
+                    f.write(metadata_text)
+            except Exception as e:
+                error(f"Failed to create chapter metadata: {e}")
+                metadata_file = None
+        else:
             metadata_file = None
 
 
     # Build FFmpeg command
-    cmd = ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", temp_list_file]
+    if stitched_file:
+        cmd = ["ffmpeg", "-y", "-f", "aac", "-i", stitched_file]
+    else:
+        cmd = ["ffmpeg", "-y", "-f", "concat", "-safe", "0"]
+        if pipes:
+            # The list arrives over a pipe but names regular files
+            cmd.extend(["-protocol_whitelist", "file,pipe"])
+        cmd.extend(["-i", list_input])
 
     input_idx = 1  # tracks next input index
 
     if metadata_file:
-        cmd.extend(["-i", metadata_file])
+        cmd.extend(["-f", "ffmetadata", "-i", metadata_file])
         metadata_input_idx = input_idx
         input_idx += 1
     else:
@@ -126,15 +244,20 @@ def convert_to_audiobook(
         cover_art_idx = input_idx
         input_idx += 1
 
+    if threads:
+        cmd.extend(["-threads", str(threads)])
+
     # Audio codec
-    if preset.get("codec") != "copy":
-        cmd.extend(["-c:a", preset["codec"]])
-        if preset.get("bitrate"):
-            cmd.extend(["-b:a", preset["bitrate"]])
-        if preset.get("channels"):
-            cmd.extend(["-ac", str(preset["channels"])])
+    if preset.get("codec") != "copy" and not stitched_file:
+        cmd.extend(_audio_codec_args(preset))
+        audio_filters = _retime_filters(lengths) + _audio_filters(preset, gains, lengths)
+        cmd.extend(["-af", ",".join(audio_filters)])
     else:
         cmd.extend(["-c:a", "copy"])
+        if stitched_file:
+            cmd.extend(["-bsf:a", stitched_timestamps])
+        else:
+            cmd.extend(_copy_retime_args(concat_files, concat_probes))
 
     # Map audio
     cmd.extend(["-map", "0:a"])
@@ -142,26 +265,12 @@ def convert_to_audiobook(
     # Map metadata and cover
     if metadata_input_idx is not None and not is_opus:
         # Add metadata
-        if metadata.get("title"):
-            cmd.extend(["-metadata", f"title={metadata['title']}"])
-        if metadata.get("author"):
-            cmd.extend(["-metadata", f"artist={metadata['author']}"])  # AAC players use 'artist'
-        if metadata.get("album"):
-            cmd.extend(["-metadata", f"album={metadata['album']}"])
-        if metadata.get("genre"):
-            cmd.extend(["-metadata", f"genre={metadata['genre']}"])
-        if metadata.get("year"):
-            cmd.extend(["-metadata", f"date={metadata['year']}"])
-        if metadata.get("comment"):
-            cmd.extend(["-metadata", f"comment={metadata['comment']}"])
+        cmd.extend(_tag_args(metadata))
     else:
         cmd.extend(['-map_metadata', '1'])
 
     if cover_art_idx is not None:
-        cmd.extend(["-map", f"{cover_art_idx}:v"])
-        cmd.extend(["-c:v", "mjpeg", "-disposition:v", "attached_pic"])
-        if is_mp3:
-            cmd.extend(["-id3v2_version", "3"])
+        cmd.extend(_cover_args(cover_art_idx, cover_art_path, is_mp3))
     
 
     # Output
@@ -169,9 +278,23 @@ def convert_to_audiobook(
 
     try:
         info(f"Running FFmpeg: {' '.join(cmd)}")
-        subprocess.run(cmd, check=True)
+        if probes:
+            total_duration = sum(p.duration for p in probes)
+        elif timeline:
+            total_duration = timeline[-1]["end"] / timeline_rate
+        else:
+            total_duration = None
+        with span("ffmpeg", output=os.path.basename(output_file), threads=threads):
+            run_ffmpeg(cmd, total_duration, label or os.path.basename(output_file), progress, pipes, threads)
+        if is_opus and not _finish_ogg(output_file, timeline, timeline_rate, cover_art_path):
+            return False
+        if ext == ".flac" and timeline and not _finish_flac(output_file, timeline, timeline_rate):
+            return False
         info(f"Audiobook created successfully: {output_file}")
-        return True
+        if verify_chapters and timeline:
+            with span("verify_chapters", output=os.path.basename(output_file)):
+                verify_timeline(output_file, timeline, timeline_rate)
+        return _written(timeline, timeline_rate, lengths)
     except subprocess.CalledProcessError as e:
         error(f"FFmpeg failed: {e}")
         return False
@@ -181,3 +304,374 @@ def convert_to_audiobook(
             if f and os.path.exists(f):
                 os.remove(f)
                 info(f"Removed temporary file: {f}")
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def convert_to_targets(
+    mp3_files: list,
+    targets: list,
+    metadata: dict,
+    chapters: list = None,
+    cover_art: str = None,
+    work_dir: str = None,
+    threads: int = None,
+    probes: list = None,
+    verify_chapters: bool = False,
+    progress=None,
+    label: str = None,
+    use_pipes: bool = False,
+    trims: list = None
+):
+    """
+    Write several editions of a book from a single decode. `targets` is a
+    list of {'output_file', 'preset', 'gains'} with encoding (non-copy)
+    presets; `gains` is optional (see convert_to_audiobook).
+
+    One FFmpeg process reads the inputs once, splits the decoded audio with
+    asplit and feeds one encoder per target. Every output gets its own
+    chapter table (on its own sample clock), tags and cover: attached
+    picture for M4B/MP3, METADATA_BLOCK_PICTURE for Ogg. All targets share
+    the same `trims`. Returns False on failure, otherwise one record of
+    what was written per target (see convert_to_audiobook).
+    """
+    if not mp3_files or not targets:
+        warning("Nothing to convert.")
+        return False
+    if any(t["preset"].get("codec") == "copy" for t in targets):
+        error("Stream-copy presets cannot share a decode with other targets.")
+        return False
+
+    scratch_dir = tempfile.mkdtemp(prefix="audiobook_", dir=work_dir)
+    piped = use_pipes and pipes_supported()
+    if use_pipes and not piped:
+        warning("Pipe inputs are not supported on this platform. Using temporary files.")
+    pipes = []
+
+    concat_files = mp3_files
+    if probes and mixed_codecs(probes):
+        with span("conform", files=len(mp3_files)):
+            concat_files = conform_outliers(mp3_files, probes, scratch_dir, jobs=threads)
+        if concat_files is None:
+            error("Could not conform mismatched input files for concat.")
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+            return False
+
+    lengths = _joined_lengths(concat_files, probes if concat_files == mp3_files else None, trims)
+
+    def feed(text, name):
+        """Hand a text input to FFmpeg over a pipe or as a scratch file."""
+        if piped:
+            pipe = PipeInput(text)
+            pipes.append(pipe)
+            return pipe.url
+        path = os.path.join(scratch_dir, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return path
+
+    try:
+        cmd = ["ffmpeg", "-y", "-f", "concat", "-safe", "0"]
+        if piped:
+            cmd.extend(["-protocol_whitelist", "file,pipe"])
+        cmd.extend(["-i", feed(_concat_list(concat_files, trims, piped, lengths), "temp_file_list.txt")])
+
+        # Per target: chapter timeline on its own clock and an FFMETADATA input
+        plans = []
+        for idx, target in enumerate(targets):
+            preset = target["preset"]
+            is_opus = _is_opus_target(target)
+            rate = _timeline_rate(preset, is_opus, probes)
+            timeline = _chapter_timeline(chapters, lengths, rate) if chapters else None
+            text = _ffmetadata_text(metadata, timeline, rate)
+            cmd.extend(["-f", "ffmetadata", "-i", feed(text, f"ffmetadata_{idx}.txt")])
+            plans.append({"target": target, "is_opus": is_opus, "rate": rate, "timeline": timeline,
+                          "metadata_idx": idx + 1})
+
+        cover_idx = None
+        if cover_art and any(not p["is_opus"] for p in plans):
+            cmd.extend(["-i", cover_art])
+            cover_idx = len(targets) + 1
+
+        # Decode once onto the chapter clock, then one filter chain per output
+        graph = [f"[0:a]{','.join(_retime_filters(lengths))},asplit={len(plans)}" +
+                 "".join(f"[s{i}]" for i in range(len(plans)))]
+        for i, plan in enumerate(plans):
+            filters = _audio_filters(plan["target"]["preset"], plan["target"].get("gains"), lengths,
+                                     f"loudness{i}")
+            graph.append(f"[s{i}]{','.join(filters) or 'anull'}[a{i}]")
+        cmd.extend(["-filter_complex", ";".join(graph)])
+        if threads:
+            cmd.extend(["-threads", str(threads)])
+
+        for i, plan in enumerate(plans):
+            output_file = plan["target"]["output_file"]
+            cmd.extend(["-map", f"[a{i}]"])
+            cmd.extend(_audio_codec_args(plan["target"]["preset"]))
+            cmd.extend(["-map_metadata", str(plan["metadata_idx"]), "-map_chapters", str(plan["metadata_idx"])])
+            if not plan["is_opus"]:
+                cmd.extend(_tag_args(metadata))
+                if cover_idx is not None:
+                    cmd.extend(_cover_args(cover_idx, cover_art, output_file.lower().endswith(".mp3")))
+            cmd.append(output_file)
+
+        names = ", ".join(os.path.basename(p["target"]["output_file"]) for p in plans)
+        info(f"Running FFmpeg: {' '.join(cmd)}")
+        total_duration = sum(p.duration for p in probes) if probes else None
+        with span("ffmpeg", output=names, targets=len(plans), threads=threads):
+            run_ffmpeg(cmd, total_duration, label or names, progress, pipes, threads)
+        for plan in plans:
+            if plan["is_opus"] and not _finish_ogg(plan["target"]["output_file"], plan["timeline"], plan["rate"],
+                                                   cover_art):
+                return False
+            if plan["target"]["output_file"].lower().endswith(".flac") and plan["timeline"] \
+                    and not _finish_flac(plan["target"]["output_file"], plan["timeline"], plan["rate"]):
+                return False
+            info(f"Audiobook created successfully: {plan['target']['output_file']}")
+            if verify_chapters and plan["timeline"]:
+                with span("verify_chapters", output=os.path.basename(plan["target"]["output_file"])):
+                    verify_timeline(plan["target"]["output_file"], plan["timeline"], plan["rate"])
+        return [_written(plan["timeline"], plan["rate"], lengths) for plan in plans]
+    except (OSError, subprocess.CalledProcessError) as e:
+        error(f"FFmpeg failed: {e}")
+        return False
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def _finish_ogg(output_file, timeline, timeline_rate, cover_art):
+    """
+    Write the chapters and cover of an Ogg output with mutagen after FFmpeg:
+    the Ogg muxer rounds the CHAPTERxxx times it writes, and a cover only
+    fits in a Vorbis comment as a METADATA_BLOCK_PICTURE.
+    """
+    if not timeline and not cover_art:
+        return True
+    chapters = timeline_chapters(timeline, timeline_rate) if timeline else None
+    with span("patch", output=os.path.basename(output_file)):
+        return patch_book(output_file, chapters=chapters, cover_art=cover_art)
+
+
+def _finish_flac(output_file, timeline, timeline_rate):
+    """FFmpeg's FLAC muxer drops chapters: write them as CHAPTERxxx comments with mutagen."""
+    with span("patch", output=os.path.basename(output_file)):
+        return patch_book(output_file, chapters=timeline_chapters(timeline, timeline_rate))
+
+
+def _is_opus_target(target):
+    ext = os.path.splitext(target["output_file"])[1].lower()
+    return ext in [".ogg", ".opus"] or target["preset"].get("codec") == "libopus"
+
+
+def _concat_list(files, trims=None, piped=False, lengths=None):
+    """
+    Concat demuxer list of `files`, with inpoint/outpoint lines for `trims`
+    and each file's entry in `lengths` (seconds) as its duration.
+    """
+    lines = []
+    for idx, path in enumerate(files):
+        path = os.path.abspath(path).replace("\\", "/").replace("'", "'\\''")
+        lines.append(f"file '{'file:' if piped else ''}{path}'\n")
+        if trims:
+            inpoint, outpoint = trims[idx]
+            if inpoint:
+                lines.append(f"inpoint {float(inpoint):.6f}\n")
+            if outpoint is not None:
+                lines.append(f"outpoint {float(outpoint):.6f}\n")
+        if lengths:
+            lines.append(f"duration {float(lengths[idx]):.6f}\n")
+    return "".join(lines)
+
+
+def _joined_lengths(files, probes=None, trims=None, copy=False):
+    """
+    Length of every file in the joined stream (see chapter_timeline.file_lengths),
+    cut to `trims`; None if it cannot be determined.
+    """
+    try:
+        lengths = file_lengths(files, probes, copy)
+    except ValueError as e:
+        error(f"Cannot determine the input lengths: {e}")
+        return None
+    return trimmed_lengths(lengths, trims) if trims else lengths
+
+
+def _retime_filters(lengths):
+    """
+    Filters putting the decoded inputs on the clock of the concat list,
+    which declares every file's length: gaps and overlaps at the seams
+    (encoder delay and padding, inpoints between packets) are cut or
+    filled, so the audio runs on the chapter timeline. Without lengths the
+    decoded samples are simply counted.
+    """
+    if lengths:
+        return ["aresample=async=1:min_hard_comp=0.001", "asetpts=PTS-STARTPTS"]
+    return ["asetpts=N/SR/TB"]
+
+
+def _copy_retime_args(files, probes=None):
+    """
+    Bitstream filter numbering copied AAC and Opus packets frame by frame.
+    Every copied frame is played, priming and padding included, while the
+    concat demuxer places each file at its trimmed length; without this
+    the container clock falls behind the audio at every seam.
+    """
+    probe = probes[0] if probes else probe_file(files[0])
+    if probe.codec not in ("aac", "opus"):
+        return []
+    try:
+        layouts = [frame_layout(path, probe.codec) for path in files]
+    except (OSError, ValueError, KeyError) as e:
+        warning(f"Could not read the frame layout of the inputs ({e}). Copied timestamps are kept.")
+        return []
+    sizes = {layout["frame_samples"] for layout in layouts if layout}
+    if len(sizes) != 1 or None in layouts:
+        warning("The inputs differ in frame size. Copied timestamps are kept.")
+        return []
+    return ["-bsf:a", f"setts=ts=N*{sizes.pop()}"]
+
+
+def _timeline_rate(preset, is_opus, probes):
+    """Sample clock of the output stream that chapter offsets are counted on."""
+    if is_opus:
+        return OPUS_SAMPLE_RATE
+    if preset.get("sample_rate"):
+        return preset["sample_rate"]
+    if probes and probes[0].sample_rate:
+        return probes[0].sample_rate
+    return 1000
+
+
+def _chapter_timeline(chapters, lengths, rate):
+    """Chapter timeline on `rate`'s clock, or None without `lengths`."""
+    if not lengths:
+        error("Failed to build chapter timeline: the input lengths are unknown.")
+        return None
+    return build_timeline(chapters, lengths, rate)
+
+
+def _ffmetadata_text(metadata, timeline, timeline_rate):
+    """FFMETADATA document with the book's tags and the chapters."""
+    # Always start with FFmetadata header
+    lines = [";FFMETADATA1\n"]
+
+    if metadata.get("title"):
+        lines.append(f"title={metadata['title']}\n")
+    if metadata.get("author"):
+        lines.append(f"artist={metadata['author']}\n")  # AAC players use 'artist'
+    if metadata.get("album"):
+        lines.append(f"album={metadata['album']}\n")
+    if metadata.get("genre"):
+        lines.append(f"genre={metadata['genre']}\n")
+    if metadata.get("year"):
+        lines.append(f"date={metadata['year']}\n")
+    if metadata.get("comment"):
+        lines.append(f"comment={metadata['comment']}\n")
+
+    if timeline:
+        lines.append(format_ffmetadata_chapters(timeline, timeline_rate))
+    return "".join(lines)
+
+
+def _tag_args(metadata):
+    """-metadata options for the book's tags."""
+    args = []
+    if metadata.get("title"):
+        args.extend(["-metadata", f"title={metadata['title']}"])
+    if metadata.get("author"):
+        args.extend(["-metadata", f"artist={metadata['author']}"])  # AAC players use 'artist'
+    if metadata.get("album"):
+        args.extend(["-metadata", f"album={metadata['album']}"])
+    if metadata.get("genre"):
+        args.extend(["-metadata", f"genre={metadata['genre']}"])
+    if metadata.get("year"):
+        args.extend(["-metadata", f"date={metadata['year']}"])
+    if metadata.get("comment"):
+        args.extend(["-metadata", f"comment={metadata['comment']}"])
+    return args
+
+
+def _cover_args(cover_idx, cover_path, is_mp3):
+    """Map the cover input as an attached picture (JPEG is copied, anything else re-encoded)."""
+    cover_codec = "copy" if cover_path.lower().endswith((".jpg", ".jpeg")) else "mjpeg"
+    args = ["-map", f"{cover_idx}:v", "-c:v", cover_codec, "-disposition:v", "attached_pic"]
+    if is_mp3:
+        args.extend(["-id3v2_version", "3"])
+    return args
+
+
+def _audio_codec_args(preset):
+    """Encoder options of a (non-copy) preset."""
+    args = ["-c:a", preset["codec"]]
+    if preset.get("bitrate"):
+        args.extend(["-b:a", preset["bitrate"]])
+    if preset.get("channels"):
+        args.extend(["-ac", str(preset["channels"])])
+    if preset.get("sample_rate"):
+        args.extend(["-ar", str(preset["sample_rate"])])
+    if preset.get("speech") and preset["codec"] == "libopus" \
+            and "application" not in (preset.get("encoder_options") or {}):
+        args.extend(["-application", "voip"])
+    args.extend(encoder_args(preset))
+    return args
+
+
+def _audio_filters(preset, gains, lengths, instance="loudness"):
+    """
+    Audio filters of the encode: the speech profile and the loudness gains.
+    Per-chapter gains switch where each file starts on the retimed stream,
+    taken from the exact `lengths` rather than the timeline rounded to the
+    output clock (a rounded start can fall after the chapter's first frame).
+    """
+    filters = speech_filters(preset)
+    if gains:
+        starts = list(accumulate([0] + lengths[:-1])) if lengths else None
+        filters.append(gain_filter(gains, starts, instance))
+    return filters
+
+
+def _segment_input(files, trims, lengths, preset, gains):
+    """
+    Input of split-encode segments: segment_input(first, end) gives the concat
+    list and filters decoding files[first:end] as a single encode would, with
+    the retimed stream and the gains started from zero.
+    """
+    def segment_input(first, end):
+        part = lengths[first:end]
+        concat_text = _concat_list(files[first:end], trims[first:end] if trims else None, False, part)
+        filters = _retime_filters(part) + _audio_filters(preset, gains[first:end] if gains else None, part)
+        return concat_text, filters
+    return segment_input
+
+
+def _native_mp3_remux(mp3_files, output_file, metadata, chapters, cover_art_path, verify_chapters):
+    """
+    Join MP3 files with mp3_remux. Returns what was written (see
+    convert_to_audiobook) or False, or None if the inputs need FFmpeg
+    instead.
+    """
+    try:
+        with span("mp3_remux", files=len(mp3_files)):
+            lengths = remux_mp3(mp3_files, output_file, metadata, chapters, cover_art_path)
+    except MP3RemuxError as e:
+        info(f"Native MP3 remux not possible ({e}). Using FFmpeg.")
+        return None
+    except Exception as e:
+        error(f"Native MP3 remux failed: {e}")
+        return False
+
+    info(f"Audiobook created successfully: {output_file}")
+    # ID3 CHAP frames store milliseconds
+    timeline = build_timeline(chapters, lengths, 1000) if chapters else None
+    if verify_chapters and timeline:
+        with span("verify_chapters", output=os.path.basename(output_file)):
+            verify_timeline(output_file, timeline, 1000)
+    return _written(timeline, 1000, lengths)
+
+
+def _written(timeline, rate, lengths):
+    """Record of a written output: {'duration', 'timeline', 'rate'} (see convert_to_audiobook)."""
+    if timeline:
+        duration = timeline[-1]["end"] / rate
+    else:
+        duration = float(sum(lengths)) if lengths else None
+    return {"duration": duration, "timeline": timeline, "rate": rate}
@@ -1,6 +1,8 @@
 # cover_art.py
 import os
 import base64
+import hashlib
+import tempfile
 from PIL import Image
 from logger import info, warning, error
 
@@ -11,12 +13,29 @@ PREFERRED_NAMES = [
     "cover", "album_art", "albumart", "folder", "front"
 ]
 
-def find_cover_art(folder: str) -> str:
+# Defaults for the embedded cover (longest side in pixels, JPEG quality)
+COVER_MAX_SIZE = 1400
+COVER_JPEG_QUALITY = 90
+
+def find_cover_art(folder: str, images: list = None) -> str:
     """
     Search for cover art in the folder.
     Prefer common names (cover.jpg, album_art.png, folder.jpg, etc.),
     otherwise return the first supported image found.
+    `images` is an already collected list of image paths in the folder
+    (see file_discovery.scan_library); if given, the folder is not listed.
     """
+    if images is not None:
+        by_name = {os.path.basename(p).lower(): p for p in images}
+        for name in PREFERRED_NAMES:
+            for ext in SUPPORTED_FORMATS:
+                if f"{name}{ext}" in by_name:
+                    return by_name[f"{name}{ext}"]
+        if images:
+            return sorted(images)[0]
+        warning(f"No cover art found in '{folder}'.")
+        return None
+
     if not folder or not os.path.isdir(folder):
         return None
 
@@ -101,6 +120,64 @@ def generate_vorbis_picture_tag(image_path: str) -> str:
         return None
 
 
-def get_cover_art_for_audiobook(folder: str) -> str:
-    """Wrapper to return the chosen cover art path or None."""
-    return find_cover_art(folder)
+def prepare_cover(image_path: str, cache_dir: str, max_size: int = COVER_MAX_SIZE,
+                  quality: int = COVER_JPEG_QUALITY) -> str:
+    """
+    Return a JPEG version of the cover no larger than `max_size` pixels on
+    its longest side, suitable for embedding in every container.
+
+    The result is cached in `cache_dir` as '<hash>_resized.jpg', keyed by
+    the source image's content and the size/quality settings, so each cover
+    is only decoded and resized once. A JPEG that is already small enough
+    is used as is. Falls back to the original image on failure.
+    """
+    if not image_path:
+        return None
+
+    try:
+        with open(image_path, "rb") as f:
+            source = f.read()
+        key = hashlib.sha256(source + f"|{max_size}|{quality}".encode("ascii")).hexdigest()[:32]
+        cached = os.path.join(cache_dir, f"{key}_resized.jpg")
+        if os.path.isfile(cached):
+            return cached
+
+        with Image.open(image_path) as img:
+            if img.format == "JPEG" and max(img.size) <= max_size and img.mode in ("RGB", "L"):
+                return image_path
+
+            img = img.convert("RGB")
+            img.thumbnail((max_size, max_size), Image.LANCZOS)
+
+            # A private temporary name: parallel books may resize the same cover
+            os.makedirs(cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=cache_dir, prefix=f"{key}_", suffix=".tmp",
+                                             delete=False) as tmp:
+                tmp_path = tmp.name
+            try:
+                img.save(tmp_path, format="JPEG", quality=quality, optimize=True)
+                os.replace(tmp_path, cached)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        info(f"Resized cover {image_path} -> {cached} ({os.path.getsize(cached) // 1024} KB)")
+        return cached
+
+    except Exception as e:
+        warning(f"Failed to prepare cover art {image_path}: {e}. Using original image.")
+        return image_path
+
+
+def get_cover_art_for_audiobook(folder: str, cache_dir: str = None,
+                                max_size: int = COVER_MAX_SIZE,
+                                quality: int = COVER_JPEG_QUALITY,
+                                images: list = None) -> str:
+    """
+    Wrapper to return the chosen cover art path or None.
+    If `cache_dir` is given, the path of the resized cached JPEG is returned.
+    """
+    cover = find_cover_art(folder, images)
+    if cover and cache_dir:
+        return prepare_cover(cover, cache_dir, max_size, quality)
+    return cover
@@ -0,0 +1,257 @@
+# ffmpeg_runner.py
+import os
+import json
+import time
+import threading
+import subprocess
+from collections import deque
+from logger import info, error
+from scheduler import get_scheduler
+
+# Seconds between progress lines written to the console
+REPORT_INTERVAL = 5.0
+
+# Lines of FFmpeg stderr kept for error reports
+STDERR_TAIL = 40
+
+
+def format_eta(seconds) -> str:
+    """Format seconds as H:MM:SS, or '--:--' if unknown."""
+    if seconds is None or seconds < 0:
+        return "--:--"
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+class BatchProgress:
+    """
+    Aggregates progress over all books of a batch (thread-safe) and
+    optionally appends every progress sample to a JSON-lines log.
+
+    `book_weights` maps each book to its input size in bytes; it is used
+    to estimate the audio length of books that have not started yet.
+    """
+
+    def __init__(self, book_weights: dict = None, log_path: str = None, preset_name: str = None):
+        self._lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.pending = dict(book_weights or {})
+        self.totals = {}       # book -> audio seconds
+        self.weights = {}      # book -> bytes
+        self.processed = {}    # book -> audio seconds encoded so far
+        self.log_path = log_path
+        self.preset_name = preset_name
+
+    def start_book(self, book: str, total_seconds: float):
+        with self._lock:
+            self.weights[book] = self.pending.pop(book, 0)
+            self.totals[book] = total_seconds or 0.0
+            self.processed[book] = 0.0
+
+    def skip_book(self, book: str):
+        with self._lock:
+            self.pending.pop(book, None)
+
+    def update(self, book: str, processed_seconds: float):
+        """Record progress of one book and return (batch_speed, batch_eta)."""
+        with self._lock:
+            self.processed[book] = processed_seconds
+            elapsed = time.monotonic() - self.start_time
+            done = sum(self.processed.values())
+            speed = done / elapsed if elapsed > 0 else 0.0
+
+            known_weight = sum(self.weights.values())
+            known_total = sum(self.totals.values())
+            per_byte = known_total / known_weight if known_weight else 0.0
+            remaining = known_total - done + sum(self.pending.values()) * per_byte
+
+        eta = remaining / speed if speed > 0 else None
+        return speed, eta
+
+    def log(self, record: dict):
+        """Append one record to the JSON-lines log, if enabled."""
+        if not self.log_path:
+            return
+        line = json.dumps(record, sort_keys=True)
+        with self._lock:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+def pipes_supported() -> bool:
+    """FFmpeg can read inherited pipe descriptors (pipe:N) on POSIX systems only."""
+    return os.name == "posix"
+
+
+class PipeInput:
+    """
+    An in-memory document handed to FFmpeg through an inherited pipe instead
+    of a temporary file. Use `url` as the FFmpeg input and pass the object to
+    run_ffmpeg(pipes=[...]), which feeds the data while FFmpeg runs.
+    """
+
+    def __init__(self, data):
+        self.data = data.encode("utf-8") if isinstance(data, str) else data
+        self.read_fd, self.write_fd = os.pipe()
+
+    @property
+    def url(self) -> str:
+        return f"pipe:{self.read_fd}"
+
+    def feed(self):
+        """Write all data and close the pipe (runs in a writer thread)."""
+        try:
+            with os.fdopen(self.write_fd, "wb") as f:
+                f.write(self.data)
+        except (BrokenPipeError, OSError):
+            pass  # FFmpeg exited early; its exit status reports the error
+
+    def close_read_end(self):
+        try:
+            os.close(self.read_fd)
+        except OSError:
+            pass
+
+    def close(self):
+        """Close both ends (used if FFmpeg could not be started)."""
+        self.close_read_end()
+        try:
+            os.close(self.write_fd)
+        except OSError:
+            pass
+
+
+def _parse_out_time(block: dict):
+    # out_time_us is authoritative; old FFmpeg versions misname it out_time_ms
+    for key in ("out_time_us", "out_time_ms"):
+        value = block.get(key)
+        if value and value != "N/A":
+            try:
+                return int(value) / 1_000_000
+            except ValueError:
+                pass
+    return None
+
+
+def run_ffmpeg(cmd: list, total_duration: float = None, label: str = None,
+               batch: BatchProgress = None, pipes: list = None, threads: int = None):
+    """
+    Run an FFmpeg command, reading its -progress stream as it runs.
+
+    Speed (x realtime), bytes written and ETA are logged every few seconds,
+    for the book and for the whole batch. FFmpeg's stderr is captured, and
+    its tail is logged if the command fails.
+
+    `pipes` are PipeInput objects referenced in `cmd`; their read ends are
+    inherited by FFmpeg and their data is written from background threads.
+
+    The process runs inside the library-wide scheduler's budget, holding
+    `threads` slots (see scheduler.ChildScheduler).
+
+    Raises subprocess.CalledProcessError on a non-zero exit, like
+    subprocess.run(cmd, check=True).
+    """
+    with get_scheduler().slot(threads or 1):
+        return _run_ffmpeg(cmd, total_duration, label, batch, pipes)
+
+
+def _run_ffmpeg(cmd, total_duration, label, batch, pipes):
+    cmd = [cmd[0], "-progress", "pipe:1", "-nostats"] + list(cmd[1:])
+    label = label or "ffmpeg"
+
+    pipes = pipes or []
+    scheduler = get_scheduler()
+    try:
+        proc = subprocess.Popen(
+            scheduler.command(cmd),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            encoding="utf-8",
+            errors="replace",
+            pass_fds=[p.read_fd for p in pipes],
+            **scheduler.popen_kwargs()
+        )
+    except OSError:
+        for p in pipes:
+            p.close()
+        raise
+
+    writers = []
+    for p in pipes:
+        p.close_read_end()
+        writer = threading.Thread(target=p.feed, daemon=True)
+        writer.start()
+        writers.append(writer)
+
+    stderr_tail = deque(maxlen=STDERR_TAIL)
+    stderr_thread = threading.Thread(
+        target=lambda: stderr_tail.extend(line.rstrip() for line in proc.stderr),
+        daemon=True,
+    )
+    stderr_thread.start()
+
+    start = time.monotonic()
+    last_report = 0.0
+    processed = 0.0
+    written = 0
+    block = {}
+
+    for line in proc.stdout:
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            continue
+        block[key] = value
+        if key != "progress":
+            continue
+
+        out_time = _parse_out_time(block)
+        if out_time is not None:
+            processed = out_time
+        try:
+            written = int(block.get("total_size", written))
+        except ValueError:
+            pass
+        block = {}
+
+        now = time.monotonic()
+        elapsed = now - start
+        speed = processed / elapsed if elapsed > 0 else 0.0
+        eta = (total_duration - processed) / speed if total_duration and speed > 0 else None
+        batch_speed, batch_eta = batch.update(label, processed) if batch else (None, None)
+        finished = value == "end"
+
+        if batch:
+            batch.log({
+                "time": time.time(),
+                "book": label,
+                "preset": batch.preset_name,
+                "event": "end" if finished else "progress",
+                "processed": round(processed, 3),
+                "total": total_duration,
+                "elapsed": round(elapsed, 3),
+                "speed": round(speed, 3),
+                "bytes": written,
+                "eta": round(eta, 1) if eta is not None else None,
+                "batch_speed": round(batch_speed, 3),
+                "batch_eta": round(batch_eta, 1) if batch_eta is not None else None,
+            })
+
+        if finished or now - last_report >= REPORT_INTERVAL:
+            last_report = now
+            percent = f"{100 * processed / total_duration:5.1f}%" if total_duration else "  ?  "
+            message = (f"[{label}] {percent}  {speed:.1f}x realtime  "
+                       f"{written / 1_048_576:.1f} MB  ETA {format_eta(eta)}")
+            if batch:
+                message += f"  | batch {batch_speed:.1f}x, ETA {format_eta(batch_eta)}"
+            info(message)
+
+    returncode = proc.wait()
+    stderr_thread.join()
+    for writer in writers:
+        writer.join()
+    if returncode != 0:
+        error(f"FFmpeg output for {label}:\n" + "\n".join(stderr_tail))
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return returncode
@@ -1,32 +1,152 @@
 # file_discovery.py
 import os
+import json
+import fnmatch
 from logger import info, warning, error
+from cover_art import SUPPORTED_FORMATS as IMAGE_EXTENSIONS
+from input_formats import supported_extensions
 
-SUPPORTED_EXTENSIONS = [".mp3"]
+SUPPORTED_EXTENSIONS = supported_extensions()
 
-def find_subfolders(base_folder: str):
+# Directory names skipped during discovery (fnmatch patterns)
+DEFAULT_IGNORE = [".*", "@eaDir", "#recycle", "$RECYCLE.BIN", "System Volume Information"]
+
+DISCOVERY_INDEX_NAME = ".audiobook_discovery.json"
+# Version 2: subfolders are stored unfiltered (ignore patterns apply per scan)
+DISCOVERY_INDEX_VERSION = 2
+
+
+def _load_index(index_path: str) -> dict:
+    if not index_path or not os.path.isfile(index_path):
+        return {}
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") == DISCOVERY_INDEX_VERSION:
+            return data.get("dirs", {})
+    except (OSError, ValueError) as e:
+        warning(f"Could not read discovery index {index_path}: {e}")
+    return {}
+
+
+def _save_index(index_path: str, dirs: dict):
+    tmp_path = index_path + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": DISCOVERY_INDEX_VERSION, "dirs": dirs}, f)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        warning(f"Could not write discovery index {index_path}: {e}")
+
+
+def _scan_dir(path: str, mtime_ns: int) -> dict:
+    """
+    List one directory with os.scandir, keeping subfolders, audio and images.
+    Subfolders are kept unfiltered, so the record stays valid for any ignore patterns.
+    """
+    record = {"mtime_ns": mtime_ns, "subdirs": [], "files": {}}
+    wanted = tuple(SUPPORTED_EXTENSIONS) + tuple(IMAGE_EXTENSIONS)
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    record["subdirs"].append(entry.name)
+                elif entry.name.lower().endswith(wanted) and entry.is_file():
+                    st = entry.stat()
+                    record["files"][entry.name] = [st.st_size, st.st_mtime_ns]
+            except OSError as e:
+                warning(f"Skipping unreadable entry {entry.path}: {e}")
+    record["subdirs"].sort()
+    return record
+
+
+def scan_library(root_dir: str, max_depth: int = None, ignore: list = None,
+                 index_path: str = None) -> dict:
+    """
+    Walk the library once with os.scandir and collect, per folder, its audio
+    files, images and their (size, mtime_ns).
+
+    Folders matching an `ignore` pattern and folders deeper than `max_depth`
+    (the root is depth 0) are pruned. If `index_path` is given, a
+    directory-mtime index is kept there: a directory whose mtime is unchanged
+    since the last scan is not listed again. The cached sizes of such files
+    may be stale if a file was rewritten in place, so callers that need exact
+    values must stat again.
+
+    Returns {folder: {'audio': [paths], 'images': [paths], 'stats': {path: (size, mtime_ns)}}}
+    for every subfolder that contains at least one audio file. The root
+    itself is never a book: finished audiobooks are written there.
+    """
+    ignore = DEFAULT_IGNORE if ignore is None else ignore
+    old_index = _load_index(index_path)
+    new_index = {}
+    library = {}
+    rescanned = 0
+
+    stack = [(root_dir, 0)]
+    while stack:
+        path, depth = stack.pop()
+        key = os.path.relpath(path, root_dir).replace("\\", "/")
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            record = old_index.get(key)
+            if not record or record.get("mtime_ns") != mtime_ns:
+                record = _scan_dir(path, mtime_ns)
+                rescanned += 1
+        except OSError as e:
+            warning(f"Cannot read folder '{path}': {e}")
+            continue
+        new_index[key] = record
+
+        names = sorted(record["files"])
+        audio = [n for n in names if n.lower().endswith(tuple(SUPPORTED_EXTENSIONS))]
+        if audio and depth > 0:
+            images = [n for n in names if n.lower().endswith(tuple(IMAGE_EXTENSIONS))]
+            library[path] = {
+                "audio": [os.path.join(path, n) for n in audio],
+                "images": [os.path.join(path, n) for n in images],
+                "stats": {os.path.join(path, n): tuple(record["files"][n]) for n in names},
+            }
+
+        if max_depth is None or depth < max_depth:
+            for name in reversed(record["subdirs"]):
+                if not any(fnmatch.fnmatch(name, pattern) for pattern in ignore):
+                    stack.append((os.path.join(path, name), depth + 1))
+
+    if index_path:
+        _save_index(index_path, new_index)
+    info(f"Scanned {len(new_index)} folder(s), listed {rescanned}, "
+         f"{len(library)} with audio files.")
+    return library
+
+
+def find_subfolders(base_folder: str, library: dict = None):
     """
-    Return a list of all subfolders in the base folder that contain MP3 files.
+    Return a list of all subfolders in the base folder that contain audio files
+    (any extension in SUPPORTED_EXTENSIONS).
+    Pass the result of scan_library as `library` to avoid walking again.
     """
-    subfolders = []
-    for root, dirs, files in os.walk(base_folder):
-        if any(f.lower().endswith(".mp3") for f in files):
-            subfolders.append(root)
+    if library is None:
+        library = scan_library(base_folder)
+    subfolders = list(library)
     if not subfolders:
-        warning(f"No MP3 files found in '{base_folder}'.")
+        warning(f"No audio files found in '{base_folder}'.")
     else:
-        info(f"Found {len(subfolders)} subfolder(s) with MP3 files.")
+        info(f"Found {len(subfolders)} subfolder(s) with audio files.")
     return subfolders
 
-def get_mp3_files(folder: str):
+def get_mp3_files(folder: str, listing: dict = None):
     """
-    Return a sorted list of MP3 files in a folder.
+    Return a sorted list of audio files (MP3, M4A, FLAC, Ogg, WMA) in a folder.
+    `listing` is the folder's scan_library entry; if given, the folder is not listed again.
     """
+    if listing is not None:
+        return list(listing["audio"])
     try:
-        files = [f for f in os.listdir(folder) if f.lower().endswith(".mp3")]
+        files = [f for f in os.listdir(folder) if f.lower().endswith(tuple(SUPPORTED_EXTENSIONS))]
         files.sort()  # Sorting ensures correct chapter order
         if not files:
-            warning(f"No MP3 files found in '{folder}'.")
+            warning(f"No audio files found in '{folder}'.")
         return [os.path.join(folder, f) for f in files]
     except Exception as e:
         error(f"Error reading folder '{folder}': {e}")
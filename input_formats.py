@@ -0,0 +1,223 @@
+# input_formats.py
+import os
+import struct
+import mutagen
+from mutagen.easyid3 import EasyID3
+from mutagen.mp3 import MP3
+from mutagen.mp4 import MP4, Atoms
+from mutagen.ogg import OggPage
+from mutagen.flac import FLAC
+from mutagen.asf import ASF
+
+# Tag keys every prober reports (EasyID3 naming, first value only)
+PROBE_TAGS = ["title", "artist", "albumartist", "album", "genre", "date", "comment"]
+
+# ASF (WMA) attribute names for PROBE_TAGS
+ASF_TAGS = {
+    "title": "Title",
+    "artist": "Author",
+    "albumartist": "WM/AlbumArtist",
+    "album": "WM/AlbumTitle",
+    "genre": "WM/Genre",
+    "date": "WM/Year",
+    "comment": "Description",
+}
+
+# MP4 (iTunes-style) atom names for PROBE_TAGS
+MP4_TAGS = {
+    "title": "\xa9nam",
+    "artist": "\xa9ART",
+    "albumartist": "aART",
+    "album": "\xa9alb",
+    "genre": "\xa9gen",
+    "date": "\xa9day",
+    "comment": "\xa9cmt",
+}
+
+# Opus frame length in 48 kHz samples for each TOC configuration (RFC 6716, 3.1)
+OPUS_FRAME_SAMPLES = [480, 960, 1920, 2880] * 3 + [480, 960] * 2 + [120, 240, 480, 960] * 4
+
+# ext -> {"name", "prober"}; filled by register_format below
+INPUT_FORMATS = {}
+
+
+def register_format(extensions: list, name: str, prober):
+    """
+    Register an input format.
+    `prober(path)` reads only the file header and returns a dict with
+    'codec', 'duration', 'sample_rate', 'channels', 'bitrate',
+    'bitrate_mode' and 'tags' (see PROBE_TAGS).
+    """
+    for ext in extensions:
+        INPUT_FORMATS[ext.lower()] = {"name": name, "prober": prober}
+
+
+def supported_extensions() -> list:
+    """All registered input file extensions."""
+    return list(INPUT_FORMATS)
+
+
+def get_format(path: str):
+    """Return the registered format for a file, or None."""
+    return INPUT_FORMATS.get(os.path.splitext(path)[1].lower())
+
+
+def _first_values(tags, keys=PROBE_TAGS) -> dict:
+    result = {}
+    if not tags:
+        return result
+    for key in keys:
+        try:
+            values = tags.get(key)
+        except Exception:
+            values = None
+        if values:
+            result[key] = str(values[0])
+    return result
+
+
+def _named_values(tags, names: dict) -> dict:
+    """First value of each PROBE_TAGS key from a tag object keyed by `names` (key -> native name)."""
+    result = {}
+    for key, name in names.items():
+        values = tags.get(name) if tags else None
+        if values:
+            result[key] = str(values[0])
+    return result
+
+
+def _stream_info(info, codec: str, bitrate_mode: str = "UNKNOWN") -> dict:
+    return {
+        "codec": codec,
+        "duration": info.length,
+        "sample_rate": getattr(info, "sample_rate", 0),
+        "channels": getattr(info, "channels", 0),
+        "bitrate": getattr(info, "bitrate", 0) or 0,
+        "bitrate_mode": bitrate_mode,
+        "bits_per_sample": getattr(info, "bits_per_sample", 0) or 0,
+    }
+
+
+def probe_mp3(path: str) -> dict:
+    audio = MP3(path, ID3=EasyID3)
+    mode = getattr(audio.info.bitrate_mode, "name", None) or "UNKNOWN"
+    result = _stream_info(audio.info, "mp3", mode)
+    result["tags"] = _first_values(audio.tags)
+    return result
+
+
+def probe_mp4(path: str) -> dict:
+    audio = MP4(path)
+    codec = audio.info.codec or ""
+    codec = "aac" if codec.startswith("mp4a.40") else codec
+    result = _stream_info(audio.info, codec)
+    result["tags"] = _named_values(audio.tags, MP4_TAGS)
+    return result
+
+
+def probe_flac(path: str) -> dict:
+    audio = FLAC(path)
+    result = _stream_info(audio.info, "flac", "VBR")
+    result["tags"] = _first_values(audio.tags)
+    return result
+
+
+def probe_ogg(path: str) -> dict:
+    audio = mutagen.File(path)
+    if audio is None:
+        raise ValueError("Unrecognised Ogg stream")
+    kind = type(audio).__name__
+    codec = {"OggOpus": "opus", "OggVorbis": "vorbis", "OggFLAC": "flac", "OggSpeex": "speex"}.get(kind, kind.lower())
+    result = _stream_info(audio.info, codec, "VBR")
+    if codec == "opus":
+        result["sample_rate"] = 48000  # Opus always decodes at 48 kHz
+    result["tags"] = _first_values(audio.tags)
+    return result
+
+
+def probe_wma(path: str) -> dict:
+    audio = ASF(path)
+    result = _stream_info(audio.info, "wma")
+    result["tags"] = _named_values(audio.tags, ASF_TAGS)
+    return result
+
+
+def mp4_frames(path: str) -> dict:
+    """
+    Frame layout of the audio track of an MP4 file, read from its sample
+    table: {'frames', 'frame_samples', 'delay'} - the number of frames, the
+    samples per frame (first stts entry) and the priming samples the edit
+    list skips, all in the track's timescale.
+    """
+    with open(path, "rb") as f:
+        atoms = Atoms(f)
+        for trak in atoms[b"moov"].findall(b"trak"):
+            _, hdlr = trak[b"mdia", b"hdlr"].read(f)
+            if hdlr[8:12] != b"soun":
+                continue
+            _, stts = trak[b"mdia", b"minf", b"stbl", b"stts"].read(f)
+            count = struct.unpack(">I", stts[4:8])[0]
+            entries = [struct.unpack(">II", stts[8 + 8 * i:16 + 8 * i]) for i in range(count)]
+            if not entries:
+                break
+            delay = 0
+            for edts in trak.findall(b"edts"):
+                delay = _edit_list_delay(edts.read(f)[1])
+            return {"frames": sum(n for n, _ in entries), "frame_samples": entries[0][1], "delay": delay}
+    raise ValueError(f"No audio track in {path}")
+
+
+def _edit_list_delay(edts: bytes) -> int:
+    """Media time of the first non-empty edit in an edts box (0 without one)."""
+    if edts[4:8] != b"elst":
+        return 0
+    version = edts[8]
+    pos = 16
+    for _ in range(struct.unpack(">I", edts[12:16])[0]):
+        if version == 1:
+            media_time = struct.unpack(">q", edts[pos + 8:pos + 16])[0]
+            pos += 20
+        else:
+            media_time = struct.unpack(">i", edts[pos + 4:pos + 8])[0]
+            pos += 12
+        if media_time >= 0:
+            return media_time
+    return 0
+
+
+def opus_frames(path: str) -> dict:
+    """
+    Frame layout of an Ogg Opus file: {'frames', 'frame_samples', 'delay'}
+    - the number of packets, their length in 48 kHz samples (taken from the
+    first audio packet; encoders keep one frame size per stream) and the
+    pre-skip. Only the header pages and the last page are read.
+    """
+    with open(path, "rb") as f:
+        page = OggPage(f)
+        while not page.packets[0].startswith(b"OpusHead"):
+            page = OggPage(f)
+        serial = page.serial
+        delay = struct.unpack("<H", page.packets[0][10:12])[0]
+        packets = list(page.packets)
+        while len(packets) < 3:
+            page = OggPage(f)
+            if page.serial != serial:
+                continue
+            data = list(page.packets)
+            if page.continued:
+                packets[-1] += data.pop(0)
+            packets.extend(data)
+        last = OggPage.find_last(f, serial, finishing=True)
+
+    toc = packets[2][0]
+    code = toc & 0x03
+    count = 1 if code == 0 else 2 if code < 3 else packets[2][1] & 0x3F
+    frame = OPUS_FRAME_SAMPLES[toc >> 3] * count
+    return {"frames": -(-last.position // frame), "frame_samples": frame, "delay": delay}
+
+
+register_format([".mp3"], "MPEG audio", probe_mp3)
+register_format([".m4a"], "MPEG-4 audio", probe_mp4)
+register_format([".flac"], "FLAC", probe_flac)
+register_format([".ogg", ".oga", ".opus"], "Ogg", probe_ogg)
+register_format([".wma"], "Windows Media Audio", probe_wma)
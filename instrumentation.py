@@ -0,0 +1,169 @@
+# instrumentation.py
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from logger import info, warning
+
+# Shared no-op context manager returned by span() while tracing is off
+_DISABLED = nullcontext()
+
+_tracer = None
+
+
+def _read_proc_io() -> dict:
+    """Bytes read/written by this process so far (Linux /proc/self/io; {} elsewhere)."""
+    try:
+        with open("/proc/self/io", "r", encoding="ascii") as f:
+            fields = dict(line.split(": ", 1) for line in f.read().splitlines())
+        return {"read": int(fields["rchar"]), "write": int(fields["wchar"])}
+    except (OSError, KeyError, ValueError):
+        return {}
+
+
+def _children_usage() -> dict:
+    """CPU seconds, peak RSS (MB) and block I/O of waited-for child processes (FFmpeg)."""
+    if resource is None:
+        return {}
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    scale = 1_048_576 if sys.platform == "darwin" else 1024  # ru_maxrss: bytes on macOS, KB on Linux
+    return {
+        "cpu": usage.ru_utime + usage.ru_stime,
+        "max_rss_mb": usage.ru_maxrss / scale,
+        "read": usage.ru_inblock * 512,
+        "write": usage.ru_oublock * 512,
+    }
+
+
+class Tracer:
+    """
+    Collects finished spans and exports them as JSON lines (one record per
+    span, appended as it ends) or as a Chrome trace (chrome://tracing,
+    Perfetto), written when the tracer is closed.
+
+    Child-process and I/O figures are process-wide counters, so spans that
+    overlap in time (parallel jobs) share them.
+    """
+
+    def __init__(self, path: str, fmt: str = "jsonl"):
+        self.path = path
+        self.fmt = fmt
+        self.origin = time.perf_counter()
+        self.events = []
+        self._lock = threading.Lock()
+        if fmt == "jsonl":
+            open(path, "w", encoding="utf-8").close()
+
+    def record(self, name: str, start: float, end: float, attrs: dict):
+        with self._lock:
+            if self.fmt == "chrome":
+                self.events.append({
+                    "name": name,
+                    "ph": "X",
+                    "ts": round((start - self.origin) * 1e6),
+                    "dur": round((end - start) * 1e6),
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": attrs,
+                })
+            else:
+                record = {"span": name, "start": round(start - self.origin, 6),
+                          "thread": threading.current_thread().name} | attrs
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, sort_keys=True, default=str) + "\n")
+
+    def close(self):
+        if self.fmt == "chrome":
+            with self._lock:
+                with open(self.path, "w", encoding="utf-8") as f:
+                    json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+        info(f"Trace written to {self.path}")
+
+
+def enable(path: str, fmt: str = None):
+    """
+    Turn on tracing to `path`. `fmt` is 'jsonl' or 'chrome'; by default a
+    '.json' path gets a Chrome trace and anything else JSON lines.
+    """
+    global _tracer
+    if fmt is None:
+        fmt = "chrome" if path.lower().endswith(".json") else "jsonl"
+    if fmt not in ("jsonl", "chrome"):
+        warning(f"Unknown trace format '{fmt}'. Using jsonl.")
+        fmt = "jsonl"
+    _tracer = Tracer(path, fmt)
+    atexit.register(disable)
+
+
+def disable():
+    """Stop tracing and write out the trace."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.close()
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+@contextmanager
+def _span(tracer: Tracer, name: str, attrs: dict):
+    io_before = _read_proc_io()
+    children_before = _children_usage()
+    cpu_before = time.thread_time()
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield attrs
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        end = time.perf_counter()
+        cpu = time.thread_time() - cpu_before
+        io_after = _read_proc_io()
+        children_after = _children_usage()
+
+        attrs = dict(attrs)
+        attrs.update({
+            "status": status,
+            "wall": round(end - start, 6),
+            "cpu": round(cpu, 6),
+        })
+        if io_after:
+            attrs["read_bytes"] = io_after["read"] - io_before["read"]
+            attrs["write_bytes"] = io_after["write"] - io_before["write"]
+        if children_after:
+            attrs["children_cpu"] = round(children_after["cpu"] - children_before["cpu"], 6)
+            attrs["children_max_rss_mb"] = round(children_after["max_rss_mb"], 1)
+            attrs["children_read_bytes"] = children_after["read"] - children_before["read"]
+            attrs["children_write_bytes"] = children_after["write"] - children_before["write"]
+        tracer.record(name, start, end, attrs)
+
+
+def span(name: str, **attrs):
+    """
+    Context manager timing one pipeline stage:
+
+        with span("probe", book=title):
+            probes = probe_files(files)
+
+    Records wall and CPU time, child-process CPU/peak RSS and bytes read and
+    written. The yielded dict (None when tracing is off) can be used to add
+    attributes inside the block. When tracing is off this is a shared no-op
+    context manager.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _DISABLED
+    return _span(tracer, name, attrs)
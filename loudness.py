@@ -0,0 +1,216 @@
+# loudness.py
+import os
+import json
+import math
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logger import info, warning, error
+from build_cache import fingerprint_file
+from scheduler import run_child
+
+LOUDNESS_CACHE_NAME = ".audiobook_loudness.json"
+LOUDNESS_CACHE_VERSION = 1
+
+# Defaults for a preset's "loudness" entry
+DEFAULT_TARGET = -18.0      # integrated loudness, LUFS (EBU R128 scale)
+DEFAULT_TRUE_PEAK = -1.5    # dBTP ceiling
+LOUDNESS_MODES = ["book", "chapter"]
+
+# Never boost or cut a file by more than this (near-silent intros, test tones)
+MAX_GAIN_DB = 20.0
+
+
+def loudness_settings(preset: dict):
+    """
+    Return the normalized "loudness" settings of a preset, or None.
+    A preset enables it with e.g. {"loudness": {"target": -18, "mode": "chapter"}}.
+    """
+    settings = preset.get("loudness")
+    if not settings:
+        return None
+    mode = settings.get("mode", "book")
+    if mode not in LOUDNESS_MODES:
+        warning(f"Unknown loudness mode '{mode}'. Using 'book'.")
+        mode = "book"
+    return {
+        "target": float(settings.get("target", DEFAULT_TARGET)),
+        "true_peak": float(settings.get("true_peak", DEFAULT_TRUE_PEAK)),
+        "mode": mode,
+    }
+
+
+def measure_file(path: str) -> dict:
+    """
+    Measure one file with FFmpeg's loudnorm filter (analysis only).
+    Returns {'i', 'tp', 'lra', 'thresh'} (LUFS / dBTP / LU), or None on failure.
+    """
+    cmd = ["ffmpeg", "-hide_banner", "-nostats", "-threads", "1", "-i", path, "-vn",
+           "-af", "loudnorm=print_format=json", "-f", "null", "-"]
+    try:
+        proc = run_child(cmd, threads=1, check=True, capture_output=True, text=True, encoding="utf-8",
+                         errors="replace")
+        report = proc.stderr[proc.stderr.rindex("{"):proc.stderr.rindex("}") + 1]
+        values = json.loads(report)
+        return {
+            "i": float(values["input_i"]),
+            "tp": float(values["input_tp"]),
+            "lra": float(values["input_lra"]),
+            "thresh": float(values["input_thresh"]),
+        }
+    except (subprocess.CalledProcessError, ValueError, KeyError) as e:
+        error(f"Loudness analysis failed for {path}: {e}")
+        return None
+
+
+class LoudnessCache:
+    """
+    Loudness measurements stored as JSON in the library root, keyed by the
+    SHA-256 of each file's content, so a file is analysed once no matter
+    how often the book is rebuilt or which preset is used. A path index of
+    (size, mtime) avoids re-hashing unchanged files. Thread-safe.
+    """
+
+    def __init__(self, root_dir: str):
+        self.path = os.path.join(root_dir, LOUDNESS_CACHE_NAME)
+        self._lock = threading.Lock()
+        self.measurements, self.paths = self._load()
+        self._dirty = False
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return {}, {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != LOUDNESS_CACHE_VERSION:
+                warning(f"Ignoring loudness cache with unknown version: {self.path}")
+                return {}, {}
+            return data.get("measurements", {}), data.get("paths", {})
+        except (OSError, ValueError) as e:
+            warning(f"Could not read loudness cache {self.path}: {e}")
+            return {}, {}
+
+    def save(self):
+        """Write the cache atomically if anything changed."""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {"version": LOUDNESS_CACHE_VERSION, "measurements": self.measurements, "paths": self.paths}
+            tmp_path = self.path + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, indent=2, sort_keys=True)
+                os.replace(tmp_path, self.path)
+                self._dirty = False
+            except OSError as e:
+                warning(f"Could not write loudness cache {self.path}: {e}")
+
+    def measure(self, path: str) -> dict:
+        """Return the measurement for a file, analysing it only on a cache miss."""
+        key = os.path.abspath(path)
+        with self._lock:
+            previous = self.paths.get(key)
+        fingerprint = fingerprint_file(path, previous)
+        digest = fingerprint["sha256"]
+
+        with self._lock:
+            if fingerprint != previous:
+                self.paths[key] = fingerprint
+                self._dirty = True
+            cached = self.measurements.get(digest)
+        if cached:
+            return cached
+
+        result = measure_file(path)
+        if result:
+            with self._lock:
+                self.measurements[digest] = result
+                self._dirty = True
+        return result
+
+
+def analyze_files(paths: list, cache: LoudnessCache, jobs: int = None) -> list:
+    """Measure files in parallel (cached ones are free). Returns one measurement (or None) per path."""
+    jobs = jobs or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(cache.measure, paths))
+    cache.save()
+    return results
+
+
+def _clamp_gain(gain: float, peak: float, ceiling: float) -> float:
+    if not math.isfinite(gain):
+        return 0.0
+    gain = max(-MAX_GAIN_DB, min(MAX_GAIN_DB, gain))
+    if math.isfinite(peak):
+        gain = min(gain, ceiling - peak)
+    return gain
+
+
+def book_gain(measurements: list, durations: list, target: float, true_peak: float) -> float:
+    """
+    One gain (dB) for the whole book. The book's loudness is the
+    duration-weighted energy mean of the files' integrated loudness (an
+    approximation of measuring the joined audio, which gating makes
+    slightly different).
+    """
+    energy = 0.0
+    total = 0.0
+    for m, duration in zip(measurements, durations):
+        if m and math.isfinite(m["i"]) and duration:
+            energy += duration * 10 ** (m["i"] / 10)
+            total += duration
+    if not total:
+        return 0.0
+    loudness = 10 * math.log10(energy / total)
+    peak = max((m["tp"] for m in measurements if m and math.isfinite(m["tp"])), default=float("-inf"))
+    return _clamp_gain(target - loudness, peak, true_peak)
+
+
+def chapter_gains(measurements: list, target: float, true_peak: float) -> list:
+    """One gain (dB) per file, each bringing its chapter to the target."""
+    return [
+        _clamp_gain(target - m["i"], m["tp"], true_peak) if m else 0.0
+        for m in measurements
+    ]
+
+
+def compute_gains(paths: list, durations: list, settings: dict, cache: LoudnessCache,
+                  jobs: int = None) -> list:
+    """
+    Analyse a book's files and return the gain in dB to apply to each file,
+    following the preset's loudness `settings` (see loudness_settings).
+    """
+    measurements = analyze_files(paths, cache, jobs)
+    if settings["mode"] == "chapter":
+        gains = chapter_gains(measurements, settings["target"], settings["true_peak"])
+        info(f"Loudness: per-chapter gains {min(gains):+.1f} to {max(gains):+.1f} dB "
+             f"(target {settings['target']} LUFS)")
+    else:
+        gain = book_gain(measurements, durations, settings["target"], settings["true_peak"])
+        gains = [gain] * len(paths)
+        info(f"Loudness: book gain {gain:+.1f} dB (target {settings['target']} LUFS)")
+    return gains
+
+
+def gain_filter(gains: list, starts: list = None, instance: str = "loudness") -> str:
+    """
+    FFmpeg audio filter applying `gains` (dB per input file) during the
+    encode. A single gain is a plain volume filter; differing per-chapter
+    gains switch the volume at each chapter start (`starts`, in seconds of
+    the joined stream) with asendcmd, so the audio is still decoded once.
+    A command applies from the first frame at or after its time, so times
+    are truncated to microseconds, never rounded up past that frame.
+    `instance` names the volume filter the commands go to; it must be
+    unique within one filter graph.
+    """
+    if not gains:
+        return None
+    if len(set(gains)) == 1:
+        return f"volume={gains[0]:.2f}dB"
+    if not starts:
+        return f"volume={sum(gains) / len(gains):.2f}dB"
+    commands = ";".join(f"{math.floor(start * 1_000_000) / 1_000_000:.6f} volume@{instance} volume {gain:.2f}dB"
+                        for start, gain in zip(starts, gains))
+    return f"asendcmd=c='{commands}',volume@{instance}={gains[0]:.2f}dB:eval=frame"
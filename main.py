@@ -1,14 +1,35 @@
 import os
 import glob
+import time
+import shutil
 import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
-from presets import get_preset_by_name, list_presets
-from file_discovery import get_mp3_files, find_subfolders
+from presets import get_preset_by_name, list_presets, load_user_presets, PresetError
+from file_discovery import get_mp3_files, find_subfolders, scan_library, DISCOVERY_INDEX_NAME, DEFAULT_IGNORE
 from chapter_handler import detect_chapters
+from probe import probe_files, total_duration
+from conversion_planner import plan_conversion, output_extension, log_plan
 from metadata_manager import extract_metadata_from_mp3s as extract_metadata
-from cover_art import get_cover_art_for_audiobook
-from converter import convert_to_audiobook
-from logger import info, warning
+from cover_art import get_cover_art_for_audiobook, prepare_cover, COVER_MAX_SIZE, COVER_JPEG_QUALITY
+from converter import convert_to_audiobook, convert_to_targets
+from concat_preflight import conform_outliers
+import scheduler
+from scheduler import run_jobs, print_summary, estimate_book_weight, threads_per_job, IONICE_CLASSES
+from ffmpeg_runner import BatchProgress
+from build_cache import BuildManifest
+from loudness import LoudnessCache, loudness_settings, compute_gains, LOUDNESS_MODES
+from silence_trim import trim_settings, find_book_edges
+from verifier import verify_output, VERIFY_MODES
+from volumes import volume_settings, plan_volumes, log_volumes, volume_path, volume_metadata, parse_size
+from batch_journal import BatchJournal, partial_output_path, retry_delay, RUNNING, DONE, FAILED
+from logger import info, warning, error
+import instrumentation
+from instrumentation import span
+
+# Resized covers are cached here, relative to the root folder
+COVER_CACHE_DIR = ".cover_cache"
 
 # -------------------------------
 # Helper functions
@@ -54,67 +75,551 @@ def cleanup_temp_files(folder):
                 warning(f"Could not delete temp file {temp_file}: {e}")
 
 
-def process_all_folders(root_dir, preset_name):
-    """Process all subfolders and convert MP3s to audiobooks."""
-    
-    preset = get_preset_by_name(preset_name)
-    if not preset:
-        warning(f"Preset '{preset_name}' not found. Falling back to interactive selection.")
-        preset_name = prompt_for_preset()
-        preset = get_preset_by_name(preset_name)
+def apply_preset_overrides(preset, options):
+    """Return the preset with the --loudness / --trim-silence / --max-volume-* options applied."""
+    # --loudness overrides (or adds) the preset's loudness normalization
+    if options.get("loudness") is not None:
+        preset = dict(preset, loudness={"target": options["loudness"],
+                                        "mode": options.get("loudness_mode") or "book"})
+    if options.get("trim_silence"):
+        preset = dict(preset, trim_silence=preset.get("trim_silence") or True)
+    if options.get("max_volume_size") or options.get("max_volume_hours"):
+        volumes = dict(preset.get("volumes") or {})
+        if options.get("max_volume_size"):
+            volumes["max_size"] = options["max_volume_size"]
+        if options.get("max_volume_hours"):
+            volumes["max_hours"] = options["max_volume_hours"]
+        preset = dict(preset, volumes=volumes)
+    return preset
 
-    subfolders = find_subfolders(root_dir)
-    if not subfolders:
-        warning("No MP3 subfolders found. Exiting.")
-        return
 
-    for folder in subfolders:
-        info(f"\nProcessing folder: {folder}")
+def process_folder(folder, root_dir, preset, threads=None, options=None, manifest=None, progress=None,
+                   listing=None, loudness_cache=None, targets=None):
+    """
+    Convert a single subfolder into an audiobook.
+    `options` holds optional batch settings from the command line
+    (e.g. {'split_encode': True}).
+    If a `BuildManifest` is given, books whose inputs are unchanged since
+    the last successful build are skipped.
+    `progress` is the batch-wide BatchProgress used for speed/ETA reporting.
+    `listing` is the folder's scan_library entry (audio files and images).
+    `loudness_cache` is the batch's shared LoudnessCache (for presets with
+    loudness normalization).
+    `targets` ({name: preset}) are further editions of the book to write in
+    the same run. Encoding editions that share their silence trim are
+    written by one FFmpeg process that decodes the book once (see
+    converter.convert_to_targets); stream copies, and every edition with
+    split-encode, are converted on their own. An edition whose file name
+    is already taken gets the preset name appended.
+    With options['verify'] ("headers" or "sample") every new output is
+    checked before it is moved into place (see verifier.verify_output); a
+    failed check counts as a failed attempt, so the book is rebuilt if
+    retries are enabled.
+    An edition whose preset has a volume limit (see volumes.py) and whose
+    estimated size or length exceeds it is split at chapter boundaries into
+    'Book - Part N' files, which are encoded concurrently.
+    Returns a result dict: {'folder', 'output', 'status', 'seconds'}, plus
+    'audio_seconds' once the files were probed, 'problems' if verification
+    failed, 'volumes' if the book was split and, with `targets`, 'outputs'
+    with one {'preset', 'output', 'status', 'volumes'} per edition.
+    """
+    options = options or {}
+    start = time.perf_counter()
+    result = {"folder": folder, "output": None, "status": "skipped", "seconds": 0.0}
 
-        mp3_files = get_mp3_files(folder)
-        if not mp3_files:
-            warning(f"No MP3 files found in {folder}. Skipping.\n")
-            continue
+    info(f"\nProcessing folder: {folder}")
 
-        chapters = detect_chapters(mp3_files)
-        info(f"Detected {len(chapters)} chapters.")
+    book_title = os.path.basename(os.path.normpath(folder))  # Keep full folder name
+    mp3_files = get_mp3_files(folder, listing)
+    if not mp3_files:
+        warning(f"No MP3 files found in {folder}. Skipping.\n")
+        return result
 
-        metadata = extract_metadata(mp3_files)
-        metadata["title"] = os.path.basename(os.path.normpath(folder))  # Keep full folder name
+    images = listing["images"] if listing else None
+    cover_art = get_cover_art_for_audiobook(folder, images=images)  # full-res source, resized below
+    if cover_art:
+        info(f"Found cover art: {cover_art}")
 
-        cover_art = get_cover_art_for_audiobook(folder)  # always full-res
-        if cover_art:
-            info(f"Found cover art: {cover_art}")
+    # Smart mode: pick copy / remux / transcode from the probed streams.
+    # The copy preset is planned too, so mixed-format books keep the main container.
+    presets = [(None, preset)] + list((targets or {}).items())
+    probes = None
+    if options.get("smart") or any(p.get("codec") == "copy" for _, p in presets):
+        with span("probe", book=book_title, files=len(mp3_files)):
+            probes = probe_files(mp3_files)
 
-        # Determine output file
-        book_title = metadata["title"]
-        if preset.get("codec") == "libopus":
-            output_file = os.path.join(root_dir, f"{book_title}.ogg")
-        elif preset.get("codec") == "copy":
-            input_ext = os.path.splitext(mp3_files[0])[1].lower()
-            output_file = os.path.join(root_dir, f"{book_title}{input_ext}")
+    editions = []
+    for name, edition_preset in presets:
+        conversion_preset = edition_preset
+        if options.get("smart") or edition_preset.get("codec") == "copy":
+            plan = plan_conversion(probes, edition_preset, mp3_files)
+            log_plan(folder, plan)
+            conversion_preset = plan["preset"]
+            output_ext = plan["ext"]
         else:
-            output_file = os.path.join(root_dir, f"{book_title}.m4b")
+            output_ext = output_extension(edition_preset, mp3_files)
+
+        # Determine output file
+        output_file = os.path.join(root_dir, f"{book_title}{output_ext}")
+        if any(e["output"] == output_file for e in editions):
+            output_file = os.path.join(root_dir, f"{book_title} - {_file_safe(name)}{output_ext}")
+        editions.append({
+            "name": name,
+            "preset": edition_preset,
+            "conversion_preset": conversion_preset,
+            "output": output_file,
+            # The first edition keeps the plain manifest key of single-preset runs
+            "target": os.path.basename(output_file) if editions else None,
+            "fingerprint": None,
+            "status": None,
+        })
+    result["output"] = editions[0]["output"]
+
+    # Skip editions whose inputs have not changed since the last build
+    if manifest is not None:
+        for edition in editions:
+            fingerprint = manifest.fingerprint(folder, mp3_files, cover_art, edition["preset"], edition["target"],
+                                               _output_options(options))
+            edition["fingerprint"] = fingerprint
+            up_to_date = not options.get("force") and manifest.is_up_to_date(
+                folder, fingerprint, edition["output"], edition["target"])
+            if up_to_date:
+                info(f"Up to date, skipping: {edition['output']}")
+                edition["status"] = "up-to-date"
+                if not options.get("dry_run"):
+                    manifest.refresh(folder, fingerprint, edition["target"])
+            elif options.get("dry_run"):
+                info(f"Would rebuild: {edition['output']}")
+                edition["status"] = "would rebuild"
+    if targets:
+        result["outputs"] = editions
+    todo = [e for e in editions if e["status"] is None]
+    if not todo:
+        if progress is not None:
+            progress.skip_book(book_title)
+        statuses = {e["status"] for e in editions}
+        result["status"] = "would rebuild" if "would rebuild" in statuses else "up-to-date"
+        result["seconds"] = time.perf_counter() - start
+        return _edition_summary(result)
+
+    if probes is None:
+        with span("probe", book=book_title, files=len(mp3_files)):
+            probes = probe_files(mp3_files)
+    result["audio_seconds"] = total_duration(probes)
+    if progress is not None:
+        progress.start_book(book_title, result["audio_seconds"])
+
+    with span("chapters", book=book_title):
+        chapters = detect_chapters(mp3_files, probes)
+    info(f"Detected {len(chapters)} chapters.")
+
+    with span("metadata", book=book_title):
+        metadata = extract_metadata(mp3_files, probes)
+    metadata["title"] = book_title
+
+    # Downsize the cover once per book; the cached JPEG is shared by every container
+    if cover_art:
+        with span("cover", book=book_title):
+            cover_art = prepare_cover(
+                cover_art,
+                os.path.join(root_dir, COVER_CACHE_DIR),
+                options.get("cover_max_size") or COVER_MAX_SIZE,
+                options.get("cover_quality") or COVER_JPEG_QUALITY
+            )
+
+    # Loudness correction per file, applied during the encode
+    # (measurements are cached, so editions share the analysis)
+    # and leading/trailing silence of each chapter file, cut during the encode
+    edges = {}
+    for edition in todo:
+        edition["gains"] = None
+        settings = loudness_settings(edition["conversion_preset"])
+        if settings:
+            with span("loudness", book=book_title, files=len(mp3_files)):
+                edition["gains"] = compute_gains(mp3_files, [p.duration for p in probes], settings,
+                                                 loudness_cache or LoudnessCache(root_dir), jobs=threads)
+
+        edition["trims"] = None
+        trim = trim_settings(edition["conversion_preset"])
+        if trim:
+            key = tuple(sorted(trim.items()))
+            if key not in edges:
+                with span("silence_scan", book=book_title, files=len(mp3_files)):
+                    edges[key] = find_book_edges(mp3_files, probes, trim, jobs=threads)
+            edition["trims"] = edges[key]
+
+    # Encode to a temporary name and rename into place only on success, so
+    # an interrupted run never leaves a truncated book under the final name
+    for edition in todo:
+        edition["partial"] = partial_output_path(edition["output"])
+
+    # Oversized books are written as several volumes, split at chapter boundaries
+    for edition in todo:
+        edition["volumes"] = None
+        # The limits come from the chosen preset; smart mode may plan another one
+        settings = volume_settings(edition["preset"])
+        if not settings:
+            continue
+        ranges = plan_volumes(probes, edition["conversion_preset"], settings,
+                              os.path.getsize(cover_art) if cover_art else 0)
+        if len(ranges) > 1:
+            log_volumes(os.path.basename(edition["output"]), ranges, probes, edition["conversion_preset"])
+            edition["volumes"] = []
+            for number, (first, end) in enumerate(ranges, start=1):
+                output = volume_path(edition["output"], number)
+                edition["volumes"].append({"number": number, "first": first, "end": end, "output": output,
+                                           "partial": partial_output_path(output)})
+    if editions[0].get("volumes"):
+        result["output"] = editions[0]["volumes"][0]["output"]
+        result["volumes"] = [v["output"] for v in editions[0]["volumes"]]
+
+    def convert(group):
+        """One attempt of a decode group; each output's record of what was written goes to its 'written'."""
+        if len(group) > 1:
+            written = _convert_targets(mp3_files, group, metadata, chapters, cover_art, options, threads,
+                                       probes, progress, book_title)
+            for edition, record in zip(group, written or []):
+                edition["written"] = record
+            return bool(written)
+        edition = group[0]
+        if edition["volumes"]:
+            written = _convert_volumes(mp3_files, edition, metadata, chapters, cover_art, options, threads,
+                                       probes, progress, book_title)
+            for volume, record in zip(edition["volumes"], written or []):
+                volume["written"] = record
+            return bool(written)
+        edition["written"] = _convert_book(mp3_files, edition["partial"], edition["conversion_preset"], metadata,
+                                           chapters, cover_art, options, threads, probes, progress, book_title,
+                                           edition["gains"], edition["trims"])
+        return bool(edition["written"])
+
+    retries = max(0, options.get("retries") or 0)
+    attempts = 0
+    for group in _decode_groups(todo, options):
+        success = False
+        for attempt in range(retries + 1):
+            if attempt:
+                delay = retry_delay(attempt)
+                warning(f"Retrying {book_title} in {delay:.0f}s (attempt {attempt + 1} of {retries + 1}).")
+                time.sleep(delay)
+            success = convert(group)
+            if success and options.get("verify"):
+                for edition in group:
+                    edition["problems"] = _verify_edition(edition, metadata, cover_art, options)
+                success = not any(e["problems"] for e in group)
+            if success:
+                break
+        attempts = max(attempts, attempt + 1)
+
+        for edition in group:
+            edition_ok = success
+            for part in _parts(edition):
+                if edition_ok:
+                    try:
+                        os.replace(part["partial"], part["output"])
+                    except OSError as e:
+                        error(f"Could not move {part['partial']} to {part['output']}: {e}")
+                        edition_ok = False
+                if not edition_ok and os.path.exists(part["partial"]):
+                    os.remove(part["partial"])
+            edition["status"] = "done" if edition_ok else "failed"
+    result["attempts"] = attempts
+    problems = [p for e in todo for p in e.get("problems") or []]
+    if problems:
+        result["problems"] = problems
+
+    # Clean up temp files
+    cleanup_temp_files(folder)
+
+    result["seconds"] = time.perf_counter() - start
+    for edition in todo:
+        if edition["status"] == "done":
+            volumes = [v["output"] for v in edition["volumes"]] if edition["volumes"] else None
+            for part in _parts(edition):
+                info(f"Successfully created audiobook: {part['output']}\n")
+            if volumes and os.path.exists(edition["output"]):
+                warning(f"{edition['output']} is left from a build without volumes; remove it if it is no longer needed.")
+            if manifest is not None:
+                manifest.record(folder, edition["fingerprint"], edition["output"], edition["target"], volumes)
+    if any(e["status"] == "failed" for e in todo):
+        warning(f"Failed to create audiobook for folder: {folder}")
+        result["status"] = "failed"
+    else:
+        result["status"] = "done"
+    return _edition_summary(result)
+
+
+def _output_options(options):
+    """The run options besides the preset that change the output file (stored in the build manifest)."""
+    return {
+        "smart": bool(options.get("smart")),
+        "split_encode": bool(options.get("split_encode")),
+        "native_mp3": options.get("native_mp3", True),
+        "cover_max_size": options.get("cover_max_size") or COVER_MAX_SIZE,
+        "cover_quality": options.get("cover_quality") or COVER_JPEG_QUALITY,
+    }
+
+
+def _file_safe(name):
+    """A preset name usable in a file name."""
+    return "".join("_" if c in '<>:"/\\|?*' else c for c in name).strip()
+
+
+def _decode_groups(editions, options):
+    """
+    Split the editions to build into conversion runs: encoding editions
+    with the same silence trim share one decode, stream copies,
+    split-encodes and editions split into volumes run alone.
+    """
+    groups = []
+    shared = {}
+    for edition in editions:
+        if edition["conversion_preset"].get("codec") == "copy" or options.get("split_encode") \
+                or edition["volumes"]:
+            groups.append([edition])
+            continue
+        key = id(edition["trims"])
+        if key not in shared:
+            shared[key] = []
+            groups.append(shared[key])
+        shared[key].append(edition)
+    return groups
+
+
+def _edition_summary(result):
+    """Reduce the per-edition records of a result to {'preset', 'output', 'status', 'volumes'}."""
+    if "outputs" in result:
+        result["outputs"] = [{"preset": e["name"], "output": e["output"], "status": e["status"],
+                              "volumes": [v["output"] for v in e["volumes"]] if e.get("volumes") else None}
+                             for e in result["outputs"]]
+    return result
+
+
+def _parts(edition):
+    """The files an edition is written to: its volumes, or the single output."""
+    return edition["volumes"] or [{"number": None, "first": 0, "end": None, "output": edition["output"],
+                                   "partial": edition["partial"], "written": edition.get("written")}]
+
+
+def _verify_edition(edition, metadata, cover_art, options):
+    """
+    Check a freshly built edition (every volume of it) against the duration
+    and chapter timeline its conversion reported writing; returns the
+    problems found.
+    """
+    problems = []
+    for part in _parts(edition):
+        written = part.get("written") or {}
+        tags = volume_metadata(metadata, part["number"]) if part["number"] else metadata
+        with span("verify", output=os.path.basename(part["output"])):
+            problems.extend(verify_output(part["partial"], written.get("duration"), written.get("timeline"),
+                                          written.get("rate"), tags, cover_art,
+                                          sample=options.get("verify") == "sample",
+                                          name=os.path.basename(part["output"])))
+    return problems
 
-        # pass cover_art to converter
-        success = convert_to_audiobook(
+
+def _convert_book(mp3_files, output_file, preset, metadata, chapters, cover_art, options, threads, probes,
+                  progress, book_title, gains=None, trims=None):
+    """One conversion attempt of a book (see process_folder)."""
+    with span("convert", book=book_title, codec=preset.get("codec")):
+        return convert_to_audiobook(
             mp3_files=mp3_files,
             output_file=output_file,
             preset=preset,
             metadata=metadata,
             chapters=chapters,
-            folder=folder   # 
+            cover_art=cover_art,
+            use_pipes=options.get("use_pipes", False),
+            native_mp3=options.get("native_mp3", True),
+            threads=threads,
+            split=options.get("split_encode", False),
+            probes=probes,
+            verify_chapters=options.get("verify_chapters", False),
+            progress=progress,
+            label=book_title,
+            gains=gains,
+            trims=trims
         )
 
-        # Clean up temp files
-        cleanup_temp_files(folder)
 
-        if not success:
-            warning(f"Failed to create audiobook for folder: {folder}")
-        else:
-            info(f"Successfully created audiobook: {output_file}\n")
+def _convert_volumes(mp3_files, edition, metadata, chapters, cover_art, options, threads, probes,
+                     progress, book_title):
+    """
+    One attempt of writing an edition split into volumes (see process_folder).
+    Every volume is its own FFmpeg run with its slice of the chapters (so
+    they start at zero again), 'Part N' tags and the shared cover; the runs
+    go in parallel and share the book's thread budget. Returns the record
+    of what was written for every volume, or False.
+    """
+    volumes = edition["volumes"]
+    budget = threads or os.cpu_count() or 1
+    volume_threads = max(1, budget // len(volumes))
+    preset = edition["conversion_preset"]
+
+    # A stream copy was planned for the whole book: conform its outliers
+    # up front, so no volume ends up with another stream format
+    files = mp3_files
+    scratch_dir = None
+    if preset.get("codec") == "copy":
+        scratch_dir = tempfile.mkdtemp(prefix="audiobook_")
+        with span("conform", files=len(mp3_files)):
+            files = conform_outliers(mp3_files, probes, scratch_dir, jobs=threads)
+        if files is None:
+            error("Could not conform mismatched input files for stream copy.")
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+            return False
+        if files != mp3_files:
+            probes = probe_files(files)
+
+    def convert(volume):
+        first, end = volume["first"], volume["end"]
+        gains = edition["gains"][first:end] if edition["gains"] else None
+        trims = edition["trims"][first:end] if edition["trims"] else None
+        return _convert_book(files[first:end], volume["partial"], preset,
+                             volume_metadata(metadata, volume["number"]), chapters[first:end], cover_art, options,
+                             volume_threads, probes[first:end], progress, f"{book_title} - Part {volume['number']}",
+                             gains, trims)
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(len(volumes), budget)) as pool:
+            written = list(pool.map(convert, volumes))
+        return written if all(written) else False
+    finally:
+        if scratch_dir:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def _convert_targets(mp3_files, editions, metadata, chapters, cover_art, options, threads, probes,
+                     progress, book_title):
+    """One attempt of writing several editions from a single decode (see process_folder)."""
+    codecs = ",".join(e["conversion_preset"].get("codec") for e in editions)
+    with span("convert", book=book_title, codec=codecs, targets=len(editions)):
+        return convert_to_targets(
+            mp3_files=mp3_files,
+            targets=[{"output_file": e["partial"], "preset": e["conversion_preset"], "gains": e["gains"]}
+                     for e in editions],
+            metadata=metadata,
+            chapters=chapters,
+            cover_art=cover_art,
+            use_pipes=options.get("use_pipes", False),
+            threads=threads,
+            probes=probes,
+            verify_chapters=options.get("verify_chapters", False),
+            progress=progress,
+            label=book_title,
+            trims=editions[0]["trims"]
+        )
+
+
+def process_all_folders(root_dir, preset_name, jobs=1, max_threads=None, options=None):
+    """
+    Process all subfolders and convert MP3s to audiobooks.
+    With `jobs` > 1 several books are converted at once; `max_threads`
+    caps the total number of FFmpeg threads across all jobs. All FFmpeg
+    processes share the budget of the library-wide scheduler, and books
+    are started largest first (by the scanned byte size of their audio
+    files, see scheduler.estimate_book_weight).
+
+    A build manifest in `root_dir` records what each book was built from;
+    unchanged books are skipped unless options['force'] is set, and
+    options['dry_run'] only lists the books that would be rebuilt.
+
+    Every book's state is kept in a batch journal in `root_dir`; with
+    options['resume'] the books a previous (interrupted) run finished are
+    skipped. Failed conversions are retried options['retries'] times.
+
+    options['targets'] names further presets to write every book with in
+    the same run (multi-target mode, see process_folder).
+    """
+    options = options or {}
+    root_dir = os.path.abspath(root_dir)
+    
+    preset = get_preset_by_name(preset_name)
+    if not preset:
+        warning(f"Preset '{preset_name}' not found. Falling back to interactive selection.")
+        preset_name = prompt_for_preset()
+        preset = get_preset_by_name(preset_name)
+
+    preset = apply_preset_overrides(preset, options)
+
+    # Multi-target mode: further editions of every book from the same decode
+    targets = {}
+    for name in options.get("targets") or []:
+        target = get_preset_by_name(name)
+        if not target:
+            warning(f"Target preset '{name}' not found. Skipping it.")
+        elif name != preset_name and name not in targets:
+            targets[name] = apply_preset_overrides(target, options)
+    run_name = " + ".join([preset_name] + list(targets))
+
+    index_path = None if options.get("rescan") else os.path.join(root_dir, DISCOVERY_INDEX_NAME)
+    with span("discovery", root=root_dir):
+        library = scan_library(
+            root_dir,
+            max_depth=options.get("max_depth"),
+            ignore=options.get("ignore"),
+            index_path=index_path
+        )
+    subfolders = sorted(find_subfolders(root_dir, library))
+    if not subfolders:
+        warning("No MP3 subfolders found. Exiting.")
+        return
+
+    manifest = BuildManifest(root_dir)
+    needs_loudness = any(loudness_settings(p) for p in [preset] + list(targets.values()))
+    loudness_cache = LoudnessCache(root_dir) if needs_loudness else None
+    weights = {f: estimate_book_weight(f, library[f]) for f in subfolders}
+    progress = BatchProgress(
+        {os.path.basename(os.path.normpath(f)): weights[f] for f in subfolders},
+        log_path=options.get("progress_log"),
+        preset_name=run_name
+    )
+
+    journal = None
+    remaining = subfolders
+    if not options.get("dry_run"):
+        journal = BatchJournal(root_dir)
+        remaining = journal.start(subfolders, run_name, resume=options.get("resume"))
+
+    def run_book(folder, threads):
+        if journal:
+            journal.mark(folder, RUNNING)
+        with span("book", book=os.path.basename(os.path.normpath(folder)), threads=threads) as attrs:
+            try:
+                result = process_folder(folder, root_dir, preset, threads, options, manifest, progress,
+                                        library[folder], loudness_cache, targets)
+            except Exception as e:
+                if journal:
+                    journal.mark(folder, FAILED, error=str(e))
+                raise
+            if attrs is not None:
+                attrs["result"] = result["status"]
+        if journal:
+            journal.mark(folder, FAILED if result["status"] == "failed" else DONE,
+                         result=result["status"], output=result["output"])
+        return result
+
+    if jobs > 1 and not options.get("dry_run"):
+        # Byte sizes from the library scan: probing every book first would delay the first job
+        finished = run_jobs(remaining, run_book, jobs=jobs, max_threads=max_threads, weights=weights)
+    else:
+        threads = threads_per_job(1, max_threads)
+        finished = [run_book(folder, threads) for folder in remaining]
+
+    # Books finished by an earlier run (--resume) still appear in the summary
+    by_folder = dict(zip(remaining, finished))
+    results = []
+    for folder in subfolders:
+        if folder not in by_folder:
+            progress.skip_book(os.path.basename(os.path.normpath(folder)))
+            by_folder[folder] = {"folder": folder, "output": journal.state(folder).get("output"),
+                                 "status": "done earlier", "seconds": 0.0}
+        results.append(by_folder[folder])
+
+    print_summary(results)
+    return results
 
-# need to fix metadata attachment to ogg files. 
 
 # -------------------------------
 # Main execution
@@ -125,6 +630,69 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Batch convert MP3 folders into audiobooks.")
     parser.add_argument("root_dir", nargs='?', help="Root folder containing MP3 subfolders")
     parser.add_argument("-p", "--preset", help="Preset name")
+    parser.add_argument("-t", "--target", action="append", metavar="PRESET", default=None,
+                        help="Also write every book with this preset, from the same decode (repeatable)")
+    parser.add_argument("--presets-file", metavar="PATH",
+                        help="Load extra presets (with encoder options) from a TOML or JSON file")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of books to convert in parallel (default: 1)")
+    parser.add_argument("--max-threads", type=int, default=None,
+                        help="Total FFmpeg threads shared by all jobs (default: CPU count)")
+    parser.add_argument("--load-target", type=float, default=1.0,
+                        help="Keep total FFmpeg load at this multiple of the CPU cores, counting other programs (default: 1.0)")
+    parser.add_argument("--nice", type=int, default=None, metavar="N",
+                        help="Run FFmpeg at this nice level (lower CPU priority)")
+    parser.add_argument("--ionice", choices=list(IONICE_CLASSES), default=None,
+                        help="Run FFmpeg in this I/O priority class (Linux)")
+    parser.add_argument("--split-encode", action="store_true",
+                        help="Encode AAC chapters in parallel and stitch them without re-encoding")
+    parser.add_argument("--pipes", action="store_true",
+                        help="Stream the concat list and metadata to FFmpeg over pipes instead of temp files (POSIX only)")
+    parser.add_argument("--no-native-mp3", action="store_true",
+                        help="Use FFmpeg instead of the built-in remuxer when stream-copying MP3 files into an MP3")
+    parser.add_argument("--smart", action="store_true",
+                        help="Stream-copy books whose inputs already fit the preset instead of re-encoding them")
+    parser.add_argument("--verify-chapters", action="store_true",
+                        help="Read back each output's chapter table and report the worst-case drift")
+    parser.add_argument("--verify", nargs="?", const="headers", choices=VERIFY_MODES, default=None,
+                        help="Check every new output's duration, chapters, tags and cover from its headers; "
+                             "'sample' also decodes a few seconds at each chapter boundary. "
+                             "Failed books are rebuilt with --retries")
+    parser.add_argument("--max-volume-size", metavar="SIZE", default=None,
+                        help="Split books whose estimated output is larger than this (e.g. 700M, 2G) "
+                             "into volumes at chapter boundaries")
+    parser.add_argument("--max-volume-hours", type=float, metavar="HOURS", default=None,
+                        help="Split books longer than this into volumes at chapter boundaries")
+    parser.add_argument("--progress-log", metavar="PATH",
+                        help="Append FFmpeg progress samples (speed, bytes, ETA) to a JSON-lines file")
+    parser.add_argument("--loudness", type=float, metavar="LUFS", default=None,
+                        help="Normalize every book to this integrated loudness (EBU R128, e.g. -18)")
+    parser.add_argument("--loudness-mode", choices=LOUDNESS_MODES, default=None,
+                        help="Apply one gain per book (default) or one per chapter")
+    parser.add_argument("--trim-silence", action="store_true",
+                        help="Cut long leading/trailing silence from every chapter file (requires re-encoding)")
+    parser.add_argument("--cover-max-size", type=int, default=COVER_MAX_SIZE,
+                        help=f"Longest side of the embedded cover in pixels (default: {COVER_MAX_SIZE})")
+    parser.add_argument("--cover-quality", type=int, default=COVER_JPEG_QUALITY,
+                        help=f"JPEG quality of the embedded cover (default: {COVER_JPEG_QUALITY})")
+    parser.add_argument("--max-depth", type=int, default=None,
+                        help="Only look this many folder levels below the root for books")
+    parser.add_argument("--ignore", action="append", metavar="PATTERN", default=None,
+                        help="Skip folders matching this name pattern (repeatable; hidden folders are skipped by default)")
+    parser.add_argument("--rescan", action="store_true",
+                        help="Ignore the saved folder index and list every folder again")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="Record per-stage timings and resource use; PATH.json gets a Chrome trace, anything else JSON lines")
+    parser.add_argument("--trace-format", choices=["jsonl", "chrome"], default=None,
+                        help="Trace file format (default: from the --trace file extension)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted batch: skip the books the last run finished")
+    parser.add_argument("--retries", type=int, default=0,
+                        help="Retry a failed conversion up to N times, waiting longer each time (default: 0)")
+    parser.add_argument("--force", action="store_true",
+                        help="Rebuild every book, even if its inputs are unchanged")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only list the books that would be rebuilt")
     args = parser.parse_args()
 
     # --- Root folder handling ---
@@ -136,8 +704,55 @@ if __name__ == "__main__":
             info(f"No folder entered, using current directory: {args.root_dir}")
 
     # --- Preset handling ---
+    if args.presets_file:
+        try:
+            load_user_presets(args.presets_file)
+        except PresetError as e:
+            parser.error(str(e))
     if not args.preset or not get_preset_by_name(args.preset):
         args.preset = prompt_for_preset()
+    unknown = [name for name in args.target or [] if not get_preset_by_name(name)]
+    if unknown:
+        parser.error(f"Unknown target preset(s): {', '.join(unknown)}")
+
+    if args.max_volume_size:
+        try:
+            parse_size(args.max_volume_size)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.max_volume_hours is not None and args.max_volume_hours <= 0:
+        parser.error("--max-volume-hours must be positive")
 
     # --- Start processing ---
-    process_all_folders(args.root_dir, args.preset)
+    options = {
+        "split_encode": args.split_encode,
+        "smart": args.smart,
+        "use_pipes": args.pipes,
+        "native_mp3": not args.no_native_mp3,
+        "verify_chapters": args.verify_chapters,
+        "verify": args.verify,
+        "max_volume_size": args.max_volume_size,
+        "max_volume_hours": args.max_volume_hours,
+        "progress_log": args.progress_log,
+        "loudness": args.loudness,
+        "loudness_mode": args.loudness_mode,
+        "trim_silence": args.trim_silence,
+        "cover_max_size": args.cover_max_size,
+        "cover_quality": args.cover_quality,
+        "max_depth": args.max_depth,
+        "ignore": DEFAULT_IGNORE + args.ignore if args.ignore else None,
+        "rescan": args.rescan,
+        "resume": args.resume,
+        "retries": args.retries,
+        "force": args.force,
+        "dry_run": args.dry_run,
+        "targets": args.target,
+    }
+
+    if args.trace:
+        instrumentation.enable(args.trace, args.trace_format)
+
+    scheduler.configure(load_target=args.load_target, niceness=args.nice, ionice=args.ionice)
+
+    process_all_folders(args.root_dir, args.preset, jobs=args.jobs, max_threads=args.max_threads,
+                        options=options)
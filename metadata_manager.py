@@ -1,7 +1,6 @@
 # metadata_manager.py
-from mutagen.easyid3 import EasyID3
-from mutagen.mp3 import MP3
 from logger import info, warning
+from probe import probe_file
 from typing import Dict, Optional
 import os
 
@@ -15,9 +14,11 @@ DEFAULT_METADATA: Dict[str, Optional[str]] = {
     "comment": None
 }
 
-def extract_metadata_from_mp3s(mp3_files: list) -> Dict[str, Optional[str]]:
+def extract_metadata_from_mp3s(mp3_files: list, probes: list = None) -> Dict[str, Optional[str]]:
     """
-    Extract metadata from the first MP3 file in the list.
+    Extract metadata from the first audio file in the list (any format
+    registered in input_formats). If `probes` is given, the tags already
+    read by the probe stage are used instead of parsing the file again.
     Fallback to defaults if tags are missing.
     """
     metadata = DEFAULT_METADATA.copy()
@@ -26,7 +27,10 @@ def extract_metadata_from_mp3s(mp3_files: list) -> Dict[str, Optional[str]]:
 
     first_file = mp3_files[0]
     try:
-        audio = MP3(first_file, ID3=EasyID3)
+        probe = probes[0] if probes else probe_file(first_file)
+        if not probe.ok:
+            raise ValueError(probe.error)
+        audio = {key: [value] for key, value in probe.tags.items()}
         metadata["title"] = audio.get("title", [None])[0]
         metadata["author"] = audio.get("artist", [None])[0]
         metadata["album"] = audio.get("album", [None])[0]
@@ -35,7 +39,7 @@ def extract_metadata_from_mp3s(mp3_files: list) -> Dict[str, Optional[str]]:
         metadata["comment"] = audio.get("comment", [None])[0]
         # Narrator is usually not stored, so default to Unknown
         metadata["narrator"] = "Unknown"
-        info(f"Extracted metadata from MP3: {first_file}")
+        info(f"Extracted metadata from: {first_file}")
     except Exception as e:
         warning(f"Failed to extract metadata from {first_file}: {e}")
 
@@ -0,0 +1,385 @@
+# mp3_remux.py
+import io
+import os
+import struct
+from fractions import Fraction
+from mutagen.id3 import ID3, TIT2, TPE1, TALB, TCON, TDRC, COMM, APIC, Encoding
+from logger import info
+from chapter_handler import add_mp3_chapters
+
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Free space left in the ID3v2 tag, so later tag edits (see patcher) fit without moving the audio
+TAG_PADDING = 16 * 1024
+
+# MPEG audio layer III tables, indexed by version bits (3 = MPEG1, 2 = MPEG2, 0 = MPEG2.5)
+BITRATES = {
+    3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    0: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+SAMPLE_RATES = {
+    3: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    0: [11025, 12000, 8000],
+}
+
+ENCODER_NAME = b"LAME3.100"
+
+
+class MP3RemuxError(Exception):
+    """Inputs cannot be joined without FFmpeg (e.g. mismatched stream parameters)."""
+
+
+def parse_frame_header(header: bytes):
+    """
+    Parse a 4-byte MPEG layer III frame header.
+    Returns a dict or None if the bytes are not a valid header.
+    """
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03
+    layer = (header[1] >> 1) & 0x03
+    bitrate_idx = (header[2] >> 4) & 0x0F
+    rate_idx = (header[2] >> 2) & 0x03
+    if version == 1 or layer != 1 or bitrate_idx in (0, 15) or rate_idx == 3:
+        return None
+
+    bitrate = BITRATES[version][bitrate_idx] * 1000
+    sample_rate = SAMPLE_RATES[version][rate_idx]
+    padding = (header[2] >> 1) & 0x01
+    channel_mode = (header[3] >> 6) & 0x03
+    coef = 144 if version == 3 else 72
+    return {
+        "version": version,
+        "sample_rate": sample_rate,
+        "channels": 1 if channel_mode == 3 else 2,
+        "channel_mode": channel_mode,
+        "length": coef * bitrate // sample_rate + padding,
+        "samples": 1152 if version == 3 else 576,
+    }
+
+
+def side_info_size(frame: dict) -> int:
+    if frame["version"] == 3:
+        return 17 if frame["channels"] == 1 else 32
+    return 9 if frame["channels"] == 1 else 17
+
+
+def _id3v2_size(data) -> int:
+    """Size of a leading ID3v2 tag (0 if none)."""
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _trailing_tags_size(f, file_size: int) -> int:
+    """Size of ID3v1 and APEv2 tags at the end of the file."""
+    trailing = 0
+    if file_size >= 128:
+        f.seek(file_size - 128)
+        if f.read(3) == b"TAG":
+            trailing = 128
+    if file_size - trailing >= 32:
+        f.seek(file_size - trailing - 32)
+        footer = f.read(32)
+        if footer[:8] == b"APETAGEX":
+            ape_size = struct.unpack("<I", footer[12:16])[0]
+            flags = struct.unpack("<I", footer[20:24])[0]
+            trailing += ape_size + (32 if flags & 0x80000000 else 0)
+    return trailing
+
+
+def _find_first_frame(f, start: int, end: int):
+    """Return (offset, frame) of the first frame that is followed by another valid frame."""
+    f.seek(start)
+    window = f.read(min(end - start, 256 * 1024))
+    pos = window.find(b"\xff")
+    while 0 <= pos < len(window) - 4:
+        frame = parse_frame_header(window[pos:pos + 4])
+        if frame:
+            nxt = window[pos + frame["length"]:pos + frame["length"] + 4]
+            if len(nxt) < 4 or parse_frame_header(nxt):
+                return start + pos, frame
+        pos = window.find(b"\xff", pos + 1)
+    return None, None
+
+
+def _count_frames(f, start: int, end: int) -> int:
+    """Count frames by walking headers (used only when a file has no Xing/VBRI header)."""
+    frames = 0
+    pos = start
+    f.seek(start)
+    while pos + 4 <= end:
+        f.seek(pos)
+        frame = parse_frame_header(f.read(4))
+        if frame is None:
+            break
+        frames += 1
+        pos += frame["length"]
+    return frames
+
+
+def scan_mp3(path: str) -> dict:
+    """
+    Locate the audio frames of an MP3 file without decoding it.
+
+    Returns {'path', 'start', 'end', 'frames', 'delay', 'padding', 'frame'}:
+    the byte range of the audio frames (after ID3v2 and any Xing/Info/VBRI
+    frame, before ID3v1/APE tags), the number of audio frames, the LAME
+    encoder delay/padding in samples, and the first frame's header fields.
+    """
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        start = _id3v2_size(f.read(10))
+        end = file_size - _trailing_tags_size(f, file_size)
+
+        offset, frame = _find_first_frame(f, start, end)
+        if frame is None:
+            raise MP3RemuxError(f"No MPEG layer III frames found in {path}")
+
+        f.seek(offset)
+        first = f.read(frame["length"])
+        frames = None
+        delay = padding = 0
+        tag_pos = 4 + side_info_size(frame)
+        tag = first[tag_pos:tag_pos + 4]
+
+        if tag in (b"Xing", b"Info"):
+            flags = struct.unpack(">I", first[tag_pos + 4:tag_pos + 8])[0]
+            pos = tag_pos + 8
+            if flags & 0x01:
+                frames = struct.unpack(">I", first[pos:pos + 4])[0]
+                pos += 4
+            if flags & 0x02:
+                pos += 4
+            if flags & 0x04:
+                pos += 100
+            if flags & 0x08:
+                pos += 4
+            lame = first[pos:pos + 24]
+            if len(lame) == 24 and lame[:4] in (b"LAME", b"Lavc", b"Lavf", b"GOGO"):
+                b0, b1, b2 = lame[21], lame[22], lame[23]
+                delay = (b0 << 4) | (b1 >> 4)
+                padding = ((b1 & 0x0F) << 8) | b2
+            offset += frame["length"]
+        elif first[36:40] == b"VBRI":
+            frames = struct.unpack(">I", first[50:54])[0]
+            offset += frame["length"]
+
+        if frames is None:
+            frames = _count_frames(f, offset, end)
+
+    return {
+        "path": path,
+        "start": offset,
+        "end": end,
+        "frames": frames,
+        "delay": delay,
+        "padding": padding,
+        "frame": frame,
+    }
+
+
+def _crc16(data: bytes) -> int:
+    """CRC-16 (poly 0x8005, reflected) as used by the LAME info tag."""
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+def _build_toc(points: list, total_time: Fraction, total_bytes: int) -> bytes:
+    """
+    Build a 100-entry Xing seek table from (time, byte_offset) points at
+    file boundaries, interpolating linearly inside each file.
+    """
+    toc = bytearray(100)
+    j = 0
+    for i in range(100):
+        t = total_time * i / 100
+        while j + 1 < len(points) - 1 and points[j + 1][0] <= t:
+            j += 1
+        (t0, b0), (t1, b1) = points[j], points[j + 1]
+        pos = b0 if t1 == t0 else b0 + (b1 - b0) * (t - t0) / (t1 - t0)
+        toc[i] = min(255, int(256 * pos / total_bytes))
+    return bytes(toc)
+
+
+def _info_frame_bitrate(template: dict):
+    """Smallest bitrate index whose frame holds the Xing and LAME headers, and that frame's length."""
+    needed = 4 + side_info_size(template) + 120 + 36
+    version = template["version"]
+    coef = 144 if version == 3 else 72
+    for bitrate_idx, kbps in enumerate(BITRATES[version]):
+        length = coef * kbps * 1000 // template["sample_rate"]
+        if kbps and length >= needed:
+            return bitrate_idx, length
+    raise MP3RemuxError("No frame size can hold a Xing header")
+
+
+def build_info_frame(template: dict, frames: int, audio_bytes: int, toc: bytes,
+                     delay: int, padding: int, vbr: bool) -> bytes:
+    """Build a Xing/Info frame with a LAME extension describing the whole joined stream."""
+    side = side_info_size(template)
+    version = template["version"]
+    rate_idx = SAMPLE_RATES[version].index(template["sample_rate"])
+    bitrate_idx, length = _info_frame_bitrate(template)
+
+    header = bytes([
+        0xFF,
+        0xE0 | (version << 3) | (1 << 1) | 1,          # layer III, no CRC
+        (bitrate_idx << 4) | (rate_idx << 2),
+        (template["channel_mode"] << 6),
+    ])
+    frame = bytearray(length)
+    frame[:4] = header
+
+    total_bytes = audio_bytes + length
+    pos = 4 + side
+    frame[pos:pos + 4] = b"Xing" if vbr else b"Info"
+    frame[pos + 4:pos + 8] = struct.pack(">I", 0x0F)
+    frame[pos + 8:pos + 12] = struct.pack(">I", frames)
+    frame[pos + 12:pos + 16] = struct.pack(">I", total_bytes)
+    frame[pos + 16:pos + 116] = toc
+    frame[pos + 116:pos + 120] = struct.pack(">I", 0)     # quality: unknown
+
+    lame = pos + 120
+    frame[lame:lame + 9] = ENCODER_NAME
+    frame[lame + 9] = 0 if vbr else 1                     # tag revision 0, VBR method
+    frame[lame + 21] = (delay >> 4) & 0xFF
+    frame[lame + 22] = ((delay & 0x0F) << 4) | ((padding >> 8) & 0x0F)
+    frame[lame + 23] = padding & 0xFF
+    frame[lame + 28:lame + 32] = struct.pack(">I", total_bytes)
+    # Music CRC (lame + 32) is left at 0: it would require checksumming all audio
+    crc_pos = lame + 34
+    frame[crc_pos:crc_pos + 2] = struct.pack(">H", _crc16(bytes(frame[:crc_pos])))
+    return bytes(frame)
+
+
+def _copy_range(src, dst, start: int, end: int):
+    src.seek(start)
+    remaining = end - start
+    buffer = bytearray(min(COPY_BUFFER_SIZE, max(remaining, 1)))
+    view = memoryview(buffer)
+    while remaining > 0:
+        n = src.readinto(view[:min(len(buffer), remaining)])
+        if not n:
+            break
+        dst.write(view[:n])
+        remaining -= n
+
+
+def _build_tag(metadata: dict, cover_art: str, chapters: list) -> bytes:
+    """Render the complete ID3v2.3 tag (text frames, cover, CHAP/CTOC) of the output, with padding."""
+    tags = ID3()
+    metadata = metadata or {}
+    if metadata.get("title"):
+        tags.add(TIT2(encoding=Encoding.UTF8, text=metadata["title"]))
+    if metadata.get("author"):
+        tags.add(TPE1(encoding=Encoding.UTF8, text=metadata["author"]))
+    if metadata.get("album"):
+        tags.add(TALB(encoding=Encoding.UTF8, text=metadata["album"]))
+    if metadata.get("genre"):
+        tags.add(TCON(encoding=Encoding.UTF8, text=metadata["genre"]))
+    if metadata.get("year"):
+        tags.add(TDRC(encoding=Encoding.UTF8, text=str(metadata["year"])))
+    if metadata.get("comment"):
+        tags.add(COMM(encoding=Encoding.UTF8, lang="eng", desc="", text=metadata["comment"]))
+    if cover_art:
+        mime = "image/jpeg" if cover_art.lower().endswith((".jpg", ".jpeg")) else "image/png"
+        with open(cover_art, "rb") as f:
+            tags.add(APIC(encoding=Encoding.UTF8, mime=mime, type=3, desc="Cover", data=f.read()))
+    if chapters:
+        add_mp3_chapters(tags, chapters)
+    buffer = io.BytesIO()
+    tags.save(buffer, v2_version=3, padding=lambda _: TAG_PADDING)
+    return buffer.getvalue()
+
+
+def remux_mp3(mp3_files: list, output_file: str, metadata: dict = None,
+              chapters: list = None, cover_art: str = None):
+    """
+    Join MP3 files into one MP3 in-process, without FFmpeg.
+
+    Audio frames are copied byte for byte with large buffered reads; each
+    input's ID3v2/ID3v1/APE tags and Xing/Info frame are dropped and a
+    single Xing/Info frame (frame count, byte count, seek table, LAME
+    delay/padding) is written for the combined stream. Tags, cover and ID3
+    CHAP/CTOC chapters are built with mutagen beforehand, so the output is
+    written in a single pass.
+
+    The output is not gapless at the inner seams: the Info frame can only
+    trim the first file's encoder delay and the last file's padding, so
+    the delay and padding of the files in between are played as silence.
+    The chapters count them, and so does the returned record of the
+    stream.
+
+    Returns the exact length of every input in the joined stream on success
+    (Fractions of seconds): all of its frames, less the first file's delay
+    and the last file's padding. The chapters are laid out from them, and
+    the converter verifies the output against them.
+    Raises MP3RemuxError if the inputs do not share MPEG version, sample
+    rate and channel count; the caller should then fall back to FFmpeg.
+    """
+    scans = [scan_mp3(path) for path in mp3_files]
+    template = scans[0]["frame"]
+    for scan in scans[1:]:
+        frame = scan["frame"]
+        if (frame["version"], frame["sample_rate"], frame["channels"]) != \
+                (template["version"], template["sample_rate"], template["channels"]):
+            raise MP3RemuxError(f"{scan['path']} does not match the stream parameters of {scans[0]['path']}")
+
+    sample_rate = template["sample_rate"]
+    spf = template["samples"]
+    total_frames = sum(s["frames"] for s in scans)
+    audio_bytes = sum(s["end"] - s["start"] for s in scans)
+    delay = scans[0]["delay"]
+    padding = scans[-1]["padding"]
+
+    # Exact per-file lengths as played: whole frames, trimmed only at the ends
+    lengths = [Fraction(s["frames"] * spf, sample_rate) for s in scans]
+    lengths[0] -= Fraction(delay, sample_rate)
+    lengths[-1] -= Fraction(padding, sample_rate)
+
+    # Seek table from file boundaries; offsets count from the start of the Xing frame
+    _, info_length = _info_frame_bitrate(template)
+    points = [(Fraction(0), 0)]
+    t, b = Fraction(0), info_length
+    for s in scans:
+        t += Fraction(s["frames"] * spf, sample_rate)
+        b += s["end"] - s["start"]
+        points.append((t, b))
+    # CBR inputs have (almost) exactly frames * frame_length bytes of audio
+    vbr = len({s["frame"]["length"] for s in scans}) > 1 or any(
+        abs((s["end"] - s["start"]) - s["frames"] * s["frame"]["length"]) > s["frames"] for s in scans
+    )
+    toc = _build_toc(points, t, audio_bytes + info_length)
+    info_frame = build_info_frame(template, total_frames, audio_bytes, toc, delay, padding, vbr)
+
+    chapter_times = []
+    position = Fraction(0)
+    for chapter, length in zip(chapters or [], lengths):
+        chapter_times.append({
+            "title": chapter["title"],
+            "file": chapter["file"],
+            "start_time": float(position),
+            "duration": float(length),
+        })
+        position += length
+    tag = _build_tag(metadata, cover_art, chapter_times)
+
+    info(f"Native MP3 remux: {len(scans)} file(s), {total_frames} frames, "
+         f"{audio_bytes / 1_048_576:.1f} MB -> {output_file}")
+    with open(output_file, "wb") as out:
+        out.write(tag)
+        out.write(info_frame)
+        for scan in scans:
+            with open(scan["path"], "rb") as src:
+                _copy_range(src, out, scan["start"], scan["end"])
+
+    return lengths
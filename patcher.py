@@ -0,0 +1,456 @@
+# patcher.py
+import os
+import sys
+import json
+import base64
+import struct
+import argparse
+
+from mutagen.mp4 import MP4, MP4Cover
+from mutagen.id3 import ID3, ID3NoHeaderError, TIT2, TPE1, TALB, TCON, TDRC, COMM, APIC, Encoding
+from mutagen.oggopus import OggOpus
+from mutagen.oggvorbis import OggVorbis
+from mutagen.flac import FLAC, Picture
+
+from logger import info, warning, error
+from chapter_handler import add_mp3_chapters
+from chapter_timeline import read_chapters
+from cover_art import generate_vorbis_picture_tag
+
+# Tag keys per container for the metadata dict used across the pipeline
+MP4_TAGS = {"title": "\xa9nam", "author": "\xa9ART", "album": "\xa9alb", "genre": "\xa9gen",
+            "year": "\xa9day", "comment": "\xa9cmt"}
+VORBIS_TAGS = {"title": "title", "author": "artist", "album": "album", "genre": "genre",
+               "year": "date", "comment": "comment"}
+ID3_TAGS = {"title": TIT2, "author": TPE1, "album": TALB, "genre": TCON, "year": TDRC}
+
+# Nero chapter list (moov/udta/chpl): start times in 100 ns units, at most 255 entries
+CHPL_TIMESCALE = 10_000_000
+CHPL_MAX_CHAPTERS = 255
+
+# MP4 boxes that only hold other boxes
+MP4_CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"stbl", b"udta", b"edts", b"dinf"}
+
+# Text sample modifier FFmpeg (and QuickTime) append to every chapter title sample
+ENCD_UTF8 = struct.pack(">I4sI", 12, b"encd", 0x00000100)
+
+
+class PatchError(Exception):
+    """An output file that cannot be patched in place."""
+
+
+def format_chapter_time(seconds: float) -> str:
+    """Vorbis comment chapter time, HH:MM:SS.mmm."""
+    ms = round(seconds * 1000)
+    return f"{ms // 3_600_000:02d}:{ms // 60_000 % 60:02d}:{ms // 1000 % 60:02d}.{ms % 1000:03d}"
+
+
+def timeline_chapters(timeline: list, rate: int) -> list:
+    """Convert a chapter timeline (see chapter_timeline.build_timeline) to [(start, end, title)] in seconds."""
+    return [(c["start"] / rate, c["end"] / rate, c["title"]) for c in timeline]
+
+
+def _image_mime(path: str) -> str:
+    return "image/jpeg" if path.lower().endswith((".jpg", ".jpeg")) else "image/png"
+
+
+# -------------------------------
+# MP4 / M4B
+# -------------------------------
+
+def _parse_boxes(data: bytes) -> list:
+    """Split MP4 box data into [[type, payload or child list], ...]."""
+    boxes = []
+    pos = 0
+    while pos + 8 <= len(data):
+        size, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[pos + 8:pos + 16])[0]
+            header = 16
+        elif size == 0:
+            size = len(data) - pos
+        if size < header or pos + size > len(data):
+            raise PatchError(f"Corrupt MP4 box '{kind.decode('latin-1')}'")
+        payload = data[pos + header:pos + size]
+        boxes.append([kind, _parse_boxes(payload) if kind in MP4_CONTAINERS else payload])
+        pos += size
+    return boxes
+
+
+def _build_boxes(boxes: list) -> bytes:
+    out = []
+    for kind, payload in boxes:
+        body = _build_boxes(payload) if isinstance(payload, list) else payload
+        if len(body) + 8 > 0xFFFFFFFF:
+            out.append(struct.pack(">I4sQ", 1, kind, len(body) + 16) + body)
+        else:
+            out.append(struct.pack(">I4s", len(body) + 8, kind) + body)
+    return b"".join(out)
+
+
+def _child(boxes: list, *path):
+    """First box at `path` (a sequence of types) below `boxes`, or None."""
+    found = None
+    for kind in path:
+        if not isinstance(boxes, list):
+            return None
+        found = next((b for b in boxes if b[0] == kind), None)
+        if found is None:
+            return None
+        boxes = found[1]
+    return found
+
+
+def _track_id(trak: list) -> int:
+    tkhd = _child(trak[1], b"tkhd")[1]
+    return struct.unpack(">I", tkhd[20:24] if tkhd[0] == 1 else tkhd[12:16])[0]
+
+
+def _top_level_boxes(f, file_size: int) -> list:
+    """[(type, offset, size)] of the top-level boxes of an open MP4 file."""
+    boxes = []
+    pos = 0
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        size, kind = struct.unpack(">I4s", f.read(8))
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+        elif size == 0:
+            size = file_size - pos
+        if size < 8:
+            raise PatchError("Corrupt MP4 file")
+        boxes.append((kind, pos, size))
+        pos += size
+    return boxes
+
+
+def _chpl_box(chapters: list) -> bytes:
+    if len(chapters) > CHPL_MAX_CHAPTERS:
+        warning(f"Nero chapter list holds at most {CHPL_MAX_CHAPTERS} chapters; the rest are only in the chapter track.")
+    body = [struct.pack(">IIB", 0x01000000, 0, min(len(chapters), CHPL_MAX_CHAPTERS))]
+    for start, _, title in chapters[:CHPL_MAX_CHAPTERS]:
+        # Cut long titles without splitting a UTF-8 sequence
+        name = title.encode("utf-8")[:255].decode("utf-8", errors="ignore").encode("utf-8")
+        body.append(struct.pack(">QB", round(start * CHPL_TIMESCALE), len(name)) + name)
+    return b"".join(body)
+
+
+def _set_chapter_track(trak: list, chapters: list, data_offset: int) -> bytes:
+    """
+    Point a QuickTime chapter (text) track at new title samples stored at
+    `data_offset`. The track keeps its length; each sample lasts until the
+    next chapter starts. Returns the sample data to write there.
+    """
+    mdhd = _child(trak[1], b"mdia", b"mdhd")[1]
+    if mdhd[0] == 1:
+        timescale, duration = struct.unpack(">IQ", mdhd[20:32])
+    else:
+        timescale, duration = struct.unpack(">II", mdhd[12:20])
+
+    starts = [min(round(start * timescale), duration) for start, _, _ in chapters]
+    samples = []
+    for _, _, title in chapters:
+        text = title.encode("utf-8")[:0xFFFF]
+        samples.append(struct.pack(">H", len(text)) + text + ENCD_UTF8)
+    deltas = [b - a for a, b in zip(starts, starts[1:] + [duration])]
+
+    stbl = _child(trak[1], b"mdia", b"minf", b"stbl")[1]
+    tables = {
+        b"stts": struct.pack(">II", 0, len(deltas)) + b"".join(struct.pack(">II", 1, d) for d in deltas),
+        b"stsz": struct.pack(">III", 0, 0, len(samples)) + b"".join(struct.pack(">I", len(s)) for s in samples),
+        b"stsc": struct.pack(">IIIII", 0, 1, 1, len(samples), 1),
+    }
+    if data_offset > 0xFFFFFFFF:
+        tables[b"co64"] = struct.pack(">IIQ", 0, 1, data_offset)
+    else:
+        tables[b"stco"] = struct.pack(">III", 0, 1, data_offset)
+    stbl[:] = [box for box in stbl if box[0] not in (b"stts", b"stsz", b"stsc", b"stco", b"co64", b"stss")]
+    stbl.extend([kind, payload] for kind, payload in tables.items())
+    return b"".join(samples)
+
+
+def _patch_mp4_chapters(path: str, chapters: list):
+    """
+    Rewrite the chapter list (moov/udta/chpl) and the titles and times of
+    the QuickTime chapter track. New title samples go into a small mdat box
+    appended to the file; the audio data is never moved. The new moov box
+    replaces the old one in place if it fits (the rest becomes a 'free'
+    box), or is appended with the old one turned into 'free'.
+    """
+    with open(path, "r+b") as f:
+        file_size = os.path.getsize(path)
+        top = _top_level_boxes(f, file_size)
+        moov_entry = next((b for b in top if b[0] == b"moov"), None)
+        if moov_entry is None:
+            raise PatchError("No moov box")
+        _, moov_offset, moov_size = moov_entry
+        f.seek(moov_offset)
+        moov = _parse_boxes(f.read(moov_size))[0]
+
+        udta = _child(moov[1], b"udta")
+        if udta is None:
+            udta = [b"udta", []]
+            moov[1].append(udta)
+        udta[1][:] = [box for box in udta[1] if box[0] != b"chpl"]
+        udta[1].append([b"chpl", _chpl_box(chapters)])
+
+        # QuickTime chapter track: referenced by another track's tref/chap
+        chapter_ids = set()
+        for trak in (b for b in moov[1] if b[0] == b"trak"):
+            tref = _child(trak[1], b"tref")
+            if tref is not None:
+                for kind, payload in _parse_boxes(tref[1]):
+                    if kind == b"chap":
+                        chapter_ids.update(struct.unpack(f">{len(payload) // 4}I", payload))
+        chapter_trak = next((t for t in moov[1] if t[0] == b"trak" and _track_id(t) in chapter_ids), None)
+
+        samples = b""
+        if chapter_trak is not None:
+            samples = _set_chapter_track(chapter_trak, chapters, file_size + 8)
+        else:
+            warning(f"{os.path.basename(path)} has no QuickTime chapter track; only the Nero chapter list was updated.")
+
+        new_moov = _build_boxes([moov])
+        if samples:
+            f.seek(file_size)
+            f.write(struct.pack(">I4s", len(samples) + 8, b"mdat") + samples)
+
+        slack = moov_size - len(new_moov)
+        if slack == 0 or slack >= 8:
+            f.seek(moov_offset)
+            f.write(new_moov)
+            if slack:
+                f.write(struct.pack(">I4s", slack, b"free"))
+        else:
+            f.seek(0, os.SEEK_END)
+            f.write(new_moov)
+            f.seek(moov_offset + 4)
+            f.write(b"free")
+
+
+def patch_mp4(path: str, metadata: dict = None, chapters: list = None, cover_art: str = None):
+    audio = MP4(path)
+    if audio.tags is None:
+        audio.add_tags()
+    for key, value in (metadata or {}).items():
+        if key not in MP4_TAGS or value is None:
+            continue
+        if value == "":
+            audio.tags.pop(MP4_TAGS[key], None)
+        else:
+            audio.tags[MP4_TAGS[key]] = [str(value)]
+    if cover_art:
+        image_format = MP4Cover.FORMAT_JPEG if _image_mime(cover_art) == "image/jpeg" else MP4Cover.FORMAT_PNG
+        with open(cover_art, "rb") as f:
+            audio.tags["covr"] = [MP4Cover(f.read(), imageformat=image_format)]
+    if metadata or cover_art:
+        audio.save()
+    if chapters is not None:
+        _patch_mp4_chapters(path, chapters)
+
+
+# -------------------------------
+# MP3
+# -------------------------------
+
+def patch_mp3(path: str, metadata: dict = None, chapters: list = None, cover_art: str = None):
+    try:
+        tags = ID3(path)
+    except ID3NoHeaderError:
+        tags = ID3()
+    for key, value in (metadata or {}).items():
+        if value is None or (key not in ID3_TAGS and key != "comment"):
+            continue
+        frame_id = "COMM" if key == "comment" else ID3_TAGS[key].__name__
+        tags.delall(frame_id)
+        if value == "":
+            continue
+        if key == "comment":
+            tags.add(COMM(encoding=Encoding.UTF8, lang="eng", desc="", text=str(value)))
+        else:
+            tags.add(ID3_TAGS[key](encoding=Encoding.UTF8, text=str(value)))
+    if cover_art:
+        tags.delall("APIC")
+        with open(cover_art, "rb") as f:
+            tags.add(APIC(encoding=Encoding.UTF8, mime=_image_mime(cover_art), type=3, desc="Cover", data=f.read()))
+    if chapters is not None:
+        add_mp3_chapters(tags, [
+            {"title": title, "file": None, "start_time": start, "duration": end - start}
+            for start, end, title in chapters
+        ])
+    if metadata or cover_art or chapters is not None:
+        tags.save(path, v2_version=3)
+
+
+# -------------------------------
+# Ogg (Opus, Vorbis) and FLAC
+# -------------------------------
+
+def patch_vorbis_comments(path: str, metadata: dict = None, chapters: list = None, cover_art: str = None):
+    """
+    Tags, CHAPTERxxx/CHAPTERxxxNAME comments and the cover of Ogg and FLAC
+    files. Ogg gets the cover as a METADATA_BLOCK_PICTURE comment, FLAC as
+    a picture block.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".flac":
+        audio = FLAC(path)
+    else:
+        try:
+            audio = OggOpus(path)
+        except Exception:
+            audio = OggVorbis(path)
+    if audio.tags is None:
+        audio.add_tags()
+    tags = audio.tags
+
+    for key, value in (metadata or {}).items():
+        if key not in VORBIS_TAGS or value is None:
+            continue
+        if value == "":
+            tags.pop(VORBIS_TAGS[key], None)
+        else:
+            tags[VORBIS_TAGS[key]] = [str(value)]
+
+    if chapters is not None:
+        for key in [k for k in tags.keys() if k.upper().startswith("CHAPTER")]:
+            del tags[key]
+        for idx, (start, _, title) in enumerate(chapters):
+            tags[f"CHAPTER{idx:03d}"] = [format_chapter_time(start)]
+            tags[f"CHAPTER{idx:03d}NAME"] = [title]
+
+    if cover_art:
+        picture_tag = generate_vorbis_picture_tag(cover_art)
+        if not picture_tag:
+            raise PatchError(f"Could not read cover {cover_art}")
+        if isinstance(audio, FLAC):
+            audio.clear_pictures()
+            audio.add_picture(Picture(base64.b64decode(picture_tag)))
+        else:
+            tags["metadata_block_picture"] = [picture_tag]
+
+    audio.save()
+
+
+# -------------------------------
+# Entry points
+# -------------------------------
+
+PATCHERS = {
+    ".m4b": patch_mp4, ".m4a": patch_mp4, ".mp4": patch_mp4,
+    ".mp3": patch_mp3,
+    ".ogg": patch_vorbis_comments, ".opus": patch_vorbis_comments, ".flac": patch_vorbis_comments,
+}
+
+
+def patch_book(path: str, metadata: dict = None, chapters: list = None, cover_art: str = None,
+               titles: list = None) -> bool:
+    """
+    Update the tags, chapters and/or cover of a finished audiobook in place,
+    without touching its audio.
+
+    `metadata` uses the pipeline's keys (title, author, album, genre, year,
+    comment); None values are left alone and "" removes a tag. `chapters`
+    replaces the chapter table ([(start, end, title)] in seconds); `titles`
+    only renames the existing chapters. Returns True on success.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    patcher = PATCHERS.get(ext)
+    if patcher is None:
+        error(f"Cannot patch {ext} files: {path}")
+        return False
+    try:
+        if titles is not None:
+            current = read_chapters(path)
+            if len(titles) != len(current):
+                warning(f"{path} has {len(current)} chapters but {len(titles)} titles were given.")
+            chapters = [(start, end, titles[idx] if idx < len(titles) else title)
+                        for idx, (start, end, title) in enumerate(current)]
+        patcher(path, metadata, chapters, cover_art)
+        info(f"Patched {path}")
+        return True
+    except Exception as e:
+        error(f"Could not patch {path}: {e}")
+        return False
+
+
+def _load_chapters(path: str) -> list:
+    """Chapters from a JSON file: [{"start": seconds, "title": ...}, ...] (an "end" is optional)."""
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    chapters = []
+    for idx, entry in enumerate(entries):
+        end = entry.get("end")
+        if end is None:
+            end = entries[idx + 1]["start"] if idx + 1 < len(entries) else entry["start"]
+        chapters.append((float(entry["start"]), float(end), str(entry["title"])))
+    return chapters
+
+
+def _folder_patch(folder: str, cover_dir: str):
+    """Metadata, chapter titles and cover as a fresh build of `folder` would produce them."""
+    from file_discovery import get_mp3_files
+    from probe import probe_files
+    from chapter_handler import detect_chapters
+    from metadata_manager import extract_metadata_from_mp3s as extract_metadata
+    from cover_art import get_cover_art_for_audiobook, prepare_cover
+
+    files = get_mp3_files(folder)
+    if not files:
+        raise PatchError(f"No audio files in {folder}")
+    probes = probe_files(files)
+    metadata = extract_metadata(files, probes)
+    metadata["title"] = os.path.basename(os.path.normpath(folder))
+    titles = [c["title"] for c in detect_chapters(files, probes)]
+    cover = get_cover_art_for_audiobook(folder)
+    if cover:
+        cover = prepare_cover(cover, cover_dir)
+    return metadata, titles, cover
+
+
+# -------------------------------
+# Main
+# -------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Update tags, chapters or the cover of finished audiobooks without re-encoding.")
+    parser.add_argument("outputs", nargs="+", help="Audiobook file(s) to patch (.m4b, .m4a, .mp3, .ogg, .opus, .flac)")
+    parser.add_argument("--title")
+    parser.add_argument("--author")
+    parser.add_argument("--album")
+    parser.add_argument("--genre")
+    parser.add_argument("--year")
+    parser.add_argument("--comment")
+    parser.add_argument("--cover", metavar="IMAGE", help="Replace the cover image")
+    parser.add_argument("--chapters", metavar="JSON",
+                        help='Replace the chapter table: [{"start": seconds, "title": "..."}, ...]')
+    parser.add_argument("--chapter-titles", metavar="TXT",
+                        help="Rename the existing chapters, one title per line")
+    parser.add_argument("--from-folder", metavar="DIR",
+                        help="Take tags, chapter titles and cover from the book's source folder (one output only)")
+    args = parser.parse_args()
+
+    metadata = {key: getattr(args, key) for key in VORBIS_TAGS if getattr(args, key) is not None}
+    chapters = _load_chapters(args.chapters) if args.chapters else None
+    titles = None
+    if args.chapter_titles:
+        with open(args.chapter_titles, "r", encoding="utf-8") as f:
+            titles = [line.strip() for line in f if line.strip()]
+    cover = args.cover
+
+    if args.from_folder:
+        if len(args.outputs) != 1:
+            parser.error("--from-folder takes exactly one output file")
+        cover_dir = os.path.join(os.path.dirname(os.path.abspath(args.outputs[0])), ".cover_cache")
+        folder_metadata, folder_titles, folder_cover = _folder_patch(args.from_folder, cover_dir)
+        metadata = folder_metadata | metadata
+        titles = titles if titles is not None or chapters is not None else folder_titles
+        cover = cover or folder_cover
+
+    if not (metadata or chapters is not None or titles is not None or cover):
+        parser.error("Nothing to patch")
+
+    ok = all([patch_book(path, metadata or None, chapters, cover, titles) for path in args.outputs])
+    sys.exit(0 if ok else 1)
@@ -1,4 +1,17 @@
 # presets.py
+import os
+import re
+import json
+from logger import info, warning
+from volumes import parse_size
+
+try:
+    import tomllib  # Python 3.11+
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
 
 PRESETS = {
     "Copy / Remux (Fast, Original Container)": {
@@ -11,11 +24,32 @@ PRESETS = {
         "bitrate": "32k",
         "channels": 1
     },
+    "Opus 24kbps Mono (Speech, Silence Trimmed)": {
+        "codec": "libopus",
+        "bitrate": "24k",
+        "channels": 1,
+        "speech": True,
+        "trim_silence": {
+            "threshold_db": -50,
+            "min_silence": 0.5,
+            "keep": 0.25
+        }
+    },
     "AAC 64kbps Mono (Low Bandwidth, Voice)": {
         "codec": "aac",
         "bitrate": "64k",
         "channels": 1
     },
+    "AAC 64kbps Mono (Voice, Normalized -18 LUFS)": {
+        "codec": "aac",
+        "bitrate": "64k",
+        "channels": 1,
+        "loudness": {
+            "target": -18,
+            "true_peak": -1.5,
+            "mode": "chapter"
+        }
+    },
     "AAC 128kbps Stereo (Standard Listening)": {
         "codec": "aac",
         "bitrate": "128k",
@@ -28,6 +62,221 @@ PRESETS = {
     }
 }
 
+# Encoders a preset may name, besides "copy"
+PRESET_CODECS = ["aac", "libfdk_aac", "libopus", "libmp3lame"]
+
+# Known per-encoder options and their allowed values (a list, or a (min, max) range).
+# Other option names are passed through to FFmpeg unchecked.
+ENCODER_OPTIONS = {
+    "libopus": {
+        "application": ["voip", "audio", "lowdelay"],
+        "frame_duration": [2.5, 5, 10, 20, 40, 60, 80, 100, 120],
+        "vbr": ["on", "off", "constrained"],
+        "compression_level": (0, 10),
+        "packet_loss": (0, 100),
+        "cutoff": [0, 4000, 6000, 8000, 12000, 20000],
+    },
+    "aac": {
+        "aac_coder": ["fast", "twoloop", "anmr"],
+        "profile": ["aac_low", "mpeg2_aac_low", "aac_ltp", "aac_main"],
+        "q": (0.1, 2.0),
+        "cutoff": (0, 96000),
+    },
+    "libfdk_aac": {
+        "profile": ["aac_low", "aac_he", "aac_he_v2", "aac_ld", "aac_eld"],
+        "vbr": (0, 5),
+        "afterburner": [0, 1],
+        "cutoff": (0, 96000),
+    },
+    "libmp3lame": {
+        "q": (0, 9),
+        "compression_level": (0, 9),
+        "abr": [0, 1],
+        "joint_stereo": [0, 1],
+    },
+}
+
+SAMPLE_RATES = [8000, 11025, 12000, 16000, 22050, 24000, 32000, 44100, 48000]
+
+BITRATE_PATTERN = re.compile(r"^\d+(\.\d+)?[kKmM]?$")
+OPTION_NAME_PATTERN = re.compile(r"^[a-z][a-z0-9_]*$")
+
+BUILTIN_PRESET_NAMES = list(PRESETS)
+
+
+class PresetError(ValueError):
+    """A preset (or presets file) does not match the schema."""
+
+
+def _check_option(name: str, key: str, value, allowed):
+    if isinstance(allowed, tuple):
+        low, high = allowed
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not low <= value <= high:
+            raise PresetError(f"{name}: encoder option '{key}' must be a number from {low} to {high}")
+    elif value not in allowed:
+        raise PresetError(f"{name}: encoder option '{key}' must be one of {', '.join(map(str, allowed))}")
+
+
+def validate_preset(name: str, preset: dict) -> dict:
+    """
+    Check a preset against the schema and return a normalized copy.
+
+      codec            required; "copy" or one of PRESET_CODECS
+      bitrate          e.g. "64k" (optional)
+      channels         1 or 2 (optional)
+      sample_rate      output sample rate in Hz (optional)
+      encoder_options  {option: value} passed to the encoder as -option value
+      loudness         {"target", "true_peak", "mode"} (see loudness.py)
+      trim_silence     true or {"threshold_db", "min_silence", "keep", "max_scan"}
+      speech           true for the voice-band speech profile
+      volumes          {"max_size": "2G", "max_hours": 20} (see volumes.py)
+
+    Raises PresetError on the first problem found.
+    """
+    if not isinstance(preset, dict):
+        raise PresetError(f"{name}: preset must be a table/object")
+    known = {"codec", "bitrate", "channels", "sample_rate", "encoder_options",
+             "loudness", "trim_silence", "speech", "volumes"}
+    unknown = set(preset) - known
+    if unknown:
+        raise PresetError(f"{name}: unknown field(s) {', '.join(sorted(unknown))}")
+
+    codec = preset.get("codec")
+    if codec != "copy" and codec not in PRESET_CODECS:
+        raise PresetError(f"{name}: codec must be 'copy' or one of {', '.join(PRESET_CODECS)}")
+
+    result = {"codec": codec, "bitrate": preset.get("bitrate"), "channels": preset.get("channels")}
+    if result["bitrate"] is not None:
+        result["bitrate"] = str(result["bitrate"])
+        if not BITRATE_PATTERN.match(result["bitrate"]):
+            raise PresetError(f"{name}: bitrate must look like '64k'")
+    if result["channels"] is not None and result["channels"] not in (1, 2):
+        raise PresetError(f"{name}: channels must be 1 or 2")
+
+    if preset.get("sample_rate") is not None:
+        if preset["sample_rate"] not in SAMPLE_RATES:
+            raise PresetError(f"{name}: sample_rate must be one of {', '.join(map(str, SAMPLE_RATES))}")
+        result["sample_rate"] = preset["sample_rate"]
+
+    options = preset.get("encoder_options")
+    if options:
+        if codec == "copy":
+            raise PresetError(f"{name}: encoder_options cannot be used with codec 'copy'")
+        if not isinstance(options, dict):
+            raise PresetError(f"{name}: encoder_options must be a table/object")
+        known_options = ENCODER_OPTIONS.get(codec, {})
+        for key, value in options.items():
+            if not OPTION_NAME_PATTERN.match(key):
+                raise PresetError(f"{name}: invalid encoder option name '{key}'")
+            if not isinstance(value, (str, int, float, bool)):
+                raise PresetError(f"{name}: encoder option '{key}' must be a string, number or boolean")
+            if key in known_options:
+                _check_option(name, key, value, known_options[key])
+            else:
+                warning(f"{name}: encoder option '{key}' is not known for {codec}; passing it to FFmpeg unchecked.")
+        result["encoder_options"] = dict(options)
+
+    loudness = preset.get("loudness")
+    if loudness:
+        if not isinstance(loudness, dict) or set(loudness) - {"target", "true_peak", "mode"}:
+            raise PresetError(f"{name}: loudness must be a table with target, true_peak and mode")
+        if loudness.get("mode", "book") not in ("book", "chapter"):
+            raise PresetError(f"{name}: loudness mode must be 'book' or 'chapter'")
+        for key in ("target", "true_peak"):
+            if key in loudness and (isinstance(loudness[key], bool) or not isinstance(loudness[key], (int, float))):
+                raise PresetError(f"{name}: loudness {key} must be a number")
+        result["loudness"] = dict(loudness)
+
+    trim = preset.get("trim_silence")
+    if trim:
+        allowed = {"threshold_db", "min_silence", "keep", "max_scan"}
+        if not (trim is True or (isinstance(trim, dict) and not set(trim) - allowed)):
+            raise PresetError(f"{name}: trim_silence must be true or a table with {', '.join(sorted(allowed))}")
+        result["trim_silence"] = trim if trim is True else dict(trim)
+
+    volumes = preset.get("volumes")
+    if volumes:
+        if not isinstance(volumes, dict) or set(volumes) - {"max_size", "max_hours"}:
+            raise PresetError(f"{name}: volumes must be a table with max_size and/or max_hours")
+        if "max_size" in volumes:
+            try:
+                parse_size(volumes["max_size"])
+            except ValueError as e:
+                raise PresetError(f"{name}: volumes {e}")
+        hours = volumes.get("max_hours")
+        if hours is not None and (isinstance(hours, bool) or not isinstance(hours, (int, float)) or hours <= 0):
+            raise PresetError(f"{name}: volumes max_hours must be a positive number")
+        result["volumes"] = dict(volumes)
+
+    if preset.get("speech") is not None:
+        if not isinstance(preset["speech"], bool):
+            raise PresetError(f"{name}: speech must be true or false")
+        if preset["speech"]:
+            result["speech"] = True
+
+    return result
+
+
+def load_presets_file(path: str) -> dict:
+    """
+    Read presets from a TOML or JSON file and validate them.
+    The file holds a "presets" table/object keyed by preset name, e.g.:
+
+        [presets."Opus 20kbps Voice (Fast)"]
+        codec = "libopus"
+        bitrate = "20k"
+        channels = 1
+        encoder_options = { application = "voip", frame_duration = 60 }
+
+    Returns {name: preset}. Raises PresetError if the file is invalid.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    try:
+        if ext == ".toml":
+            if tomllib is None:
+                raise PresetError("TOML presets need Python 3.11+ or the 'tomli' package")
+            with open(path, "rb") as f:
+                data = tomllib.load(f)
+        elif ext == ".json":
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        else:
+            raise PresetError(f"Presets file must be .toml or .json: {path}")
+    except OSError as e:
+        raise PresetError(f"Cannot read presets file {path}: {e}")
+    except ValueError as e:  # JSON and TOML decode errors
+        raise PresetError(f"Invalid presets file {path}: {e}")
+
+    presets = data.get("presets") if isinstance(data, dict) else None
+    if not isinstance(presets, dict) or not presets:
+        raise PresetError(f"{path}: expected a 'presets' table with at least one preset")
+    return {str(name): validate_preset(str(name), preset) for name, preset in presets.items()}
+
+
+def load_user_presets(path: str) -> list:
+    """
+    Load a presets file and merge it into PRESETS. A user preset with the
+    name of a built-in one replaces it. Returns the loaded preset names.
+    """
+    presets = load_presets_file(path)
+    for name in presets:
+        if name in PRESETS:
+            info(f"Preset '{name}' from {path} replaces the built-in preset.")
+    PRESETS.update(presets)
+    info(f"Loaded {len(presets)} preset(s) from {path}")
+    return list(presets)
+
+
+def encoder_args(preset: dict) -> list:
+    """FFmpeg output arguments for the preset's encoder options, e.g. ['-frame_duration', '60']."""
+    args = []
+    for key, value in (preset.get("encoder_options") or {}).items():
+        if isinstance(value, bool):
+            value = int(value)
+        args.extend([f"-{key}", str(value)])
+    return args
+
+
 def get_preset_by_name(name: str):
     """
     Return the preset dictionary for the given name.
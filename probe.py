@@ -0,0 +1,101 @@
+# probe.py
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from logger import info, warning
+from input_formats import get_format
+
+PROBE_WORKERS = 8
+
+# Probe records kept for reuse, least recently used dropped first (the
+# service keeps the cache for its whole lifetime)
+PROBE_CACHE_SIZE = 10000
+
+
+@dataclass(frozen=True)
+class AudioProbe:
+    """Header-level facts about one audio file, read once per run (see input_formats)."""
+    path: str
+    size: int
+    mtime_ns: int
+    duration: float
+    sample_rate: int
+    channels: int
+    bitrate: int                 # bits per second
+    bitrate_mode: str            # "CBR", "VBR", "ABR" or "UNKNOWN"
+    codec: str = "unknown"
+    bits_per_sample: int = 0     # lossless codecs only; 0 if the header has none
+    tags: Dict[str, str] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+_cache: "OrderedDict[tuple, AudioProbe]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _read_probe(path: str, st: os.stat_result) -> AudioProbe:
+    try:
+        fmt = get_format(path)
+        if fmt is None:
+            raise ValueError("unsupported file type")
+        fields = fmt["prober"](path)
+        return AudioProbe(path=path, size=st.st_size, mtime_ns=st.st_mtime_ns, **fields)
+    except Exception as e:
+        warning(f"Failed to probe {path}: {e}")
+        return AudioProbe(
+            path=path, size=st.st_size, mtime_ns=st.st_mtime_ns, duration=0.0,
+            sample_rate=0, channels=0, bitrate=0, bitrate_mode="UNKNOWN", error=str(e),
+        )
+
+
+def probe_file(path: str) -> AudioProbe:
+    """
+    Probe a single file, reusing the cached record if the file's size and
+    mtime are unchanged.
+    """
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _cache.move_to_end(key)
+    if cached is not None:
+        return cached
+
+    probe = _read_probe(path, st)
+    with _cache_lock:
+        _cache[key] = probe
+        _cache.move_to_end(key)
+        while len(_cache) > PROBE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return probe
+
+
+def probe_files(paths: list, max_workers: int = PROBE_WORKERS) -> List[AudioProbe]:
+    """
+    Probe many files in a thread pool (header reads are I/O bound, which
+    matters on network storage). Returns records in the same order as `paths`.
+    """
+    if not paths:
+        return []
+    workers = max(1, min(max_workers, len(paths)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        probes = list(pool.map(probe_file, paths))
+
+    failed = sum(1 for p in probes if not p.ok)
+    total = sum(p.duration for p in probes)
+    info(f"Probed {len(probes)} file(s): {total:.1f}s of audio" +
+         (f", {failed} failed" if failed else ""))
+    return probes
+
+
+def total_duration(probes: List[AudioProbe]) -> float:
+    """Sum of the probed durations in seconds."""
+    return sum(p.duration for p in probes)
@@ -0,0 +1,249 @@
+# scheduler.py
+import os
+import shutil
+import threading
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from logger import info, warning, error
+from file_discovery import get_mp3_files
+
+# Memory assumed for one FFmpeg child when limiting how many run at once
+CHILD_MEMORY_MB = 200
+
+# Share of the available memory FFmpeg children may use together
+MEMORY_SHARE = 0.75
+
+# Seconds between system load checks while a child waits for a slot
+LOAD_POLL_SECONDS = 1.0
+
+IONICE_CLASSES = {"best-effort": "2", "idle": "3"}
+
+
+def cpu_count() -> int:
+    """Cores this process may run on (respects CPU affinity where supported)."""
+    try:
+        return len(os.sched_getaffinity(0)) or 1
+    except (AttributeError, OSError):
+        return os.cpu_count() or 1
+
+
+def available_memory_mb():
+    """Memory available for new processes in MB, or None if unknown."""
+    try:
+        with open("/proc/meminfo", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 1_048_576
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _system_load():
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+class ChildScheduler:
+    """
+    Library-wide budget for FFmpeg child processes.
+
+    Every child takes as many slots as the threads it may use; the total is
+    capped at `load_target` x the number of cores and, on POSIX, also
+    reduced by load from other programs (the 1-minute load average). The
+    number of concurrent children is further capped by available memory.
+    A child that cannot start waits until slots are free, so encodes,
+    split-encode segments and analysis passes of all books share one
+    budget instead of each sizing its own pool.
+
+    Children can run at a lower CPU (`niceness`) and I/O (`ionice`)
+    priority.
+    """
+
+    def __init__(self, load_target: float = 1.0, niceness: int = None, ionice: str = None,
+                 cores: int = None, memory_mb: int = None):
+        self.cores = cores or cpu_count()
+        self.capacity = max(1, round(self.cores * load_target))
+        memory_mb = memory_mb if memory_mb is not None else available_memory_mb()
+        self.max_children = max(1, int(memory_mb * MEMORY_SHARE // CHILD_MEMORY_MB)) if memory_mb else None
+        self.niceness = niceness
+        self.ionice = ionice
+        self.in_use = 0
+        self.children = 0
+        self._cond = threading.Condition()
+
+    def _free_slots(self) -> int:
+        free = self.capacity - self.in_use
+        load = _system_load()
+        if load is not None:
+            # Load average includes our own children; only count the rest
+            free -= max(0, round(load - self.in_use))
+        return free
+
+    @contextmanager
+    def slot(self, threads: int = 1):
+        """Hold `threads` slots (clamped to the capacity) while a child runs."""
+        threads = max(1, min(threads or 1, self.capacity))
+        with self._cond:
+            while self.in_use and (self._free_slots() < threads or
+                                   (self.max_children and self.children >= self.max_children)):
+                self._cond.wait(LOAD_POLL_SECONDS)
+            self.in_use += threads
+            self.children += 1
+        try:
+            yield threads
+        finally:
+            with self._cond:
+                self.in_use -= threads
+                self.children -= 1
+                self._cond.notify_all()
+
+    def command(self, cmd: list) -> list:
+        """Prefix a command with nice/ionice according to the priority settings (POSIX)."""
+        prefix = []
+        if os.name == "posix":
+            if self.ionice and shutil.which("ionice"):
+                prefix += ["ionice", "-c", IONICE_CLASSES[self.ionice]]
+                if self.ionice == "best-effort":
+                    prefix += ["-n", "7"]
+            if self.niceness and shutil.which("nice"):
+                prefix += ["nice", "-n", str(self.niceness)]
+        return prefix + list(cmd)
+
+    def popen_kwargs(self) -> dict:
+        """Extra subprocess arguments for the priority settings (Windows)."""
+        if os.name == "nt" and self.niceness and self.niceness > 0:
+            return {"creationflags": subprocess.BELOW_NORMAL_PRIORITY_CLASS}
+        return {}
+
+    def run(self, cmd: list, threads: int = 1, **kwargs):
+        """subprocess.run() for an FFmpeg child, inside the budget."""
+        with self.slot(threads):
+            return subprocess.run(self.command(cmd), **self.popen_kwargs(), **kwargs)
+
+
+_scheduler = ChildScheduler()
+
+
+def configure(load_target: float = 1.0, niceness: int = None, ionice: str = None):
+    """Replace the library-wide scheduler (call before starting any work)."""
+    global _scheduler
+    _scheduler = ChildScheduler(load_target, niceness, ionice)
+    memory = f", at most {_scheduler.max_children} FFmpeg processes" if _scheduler.max_children else ""
+    info(f"Scheduler: {_scheduler.capacity} thread slot(s) on {_scheduler.cores} core(s){memory}.")
+    return _scheduler
+
+
+def get_scheduler() -> ChildScheduler:
+    return _scheduler
+
+
+def run_child(cmd: list, threads: int = 1, **kwargs):
+    """Run an FFmpeg child through the library-wide scheduler (see ChildScheduler.run)."""
+    return _scheduler.run(cmd, threads, **kwargs)
+
+
+def estimate_book_weight(folder: str, listing: dict = None) -> int:
+    """
+    Rough cost estimate for a book: total size in bytes of its MP3 files.
+    Used to start the longest books first. If the folder's scan_library
+    entry is given, its collected sizes are used instead of stat() calls.
+    """
+    if listing is not None:
+        return sum(listing["stats"][f][0] for f in listing["audio"])
+    total = 0
+    for f in get_mp3_files(folder):
+        try:
+            total += os.path.getsize(f)
+        except OSError:
+            pass
+    return total
+
+
+def threads_per_job(jobs: int, max_threads: int = None) -> int:
+    """
+    Split the total FFmpeg thread budget evenly between concurrent jobs.
+    The default budget is the scheduler's capacity.
+    """
+    total = max_threads or _scheduler.capacity
+    return max(1, total // max(1, jobs))
+
+
+def run_jobs(folders: list, worker, jobs: int = 1, max_threads: int = None,
+             weights: dict = None) -> list:
+    """
+    Run `worker(folder, threads)` for every folder on a pool of `jobs` workers.
+    Folders are started longest-first so the batch finishes sooner;
+    `weights` maps folder -> estimated cost (see estimate_book_weight).
+
+    `worker` must return a result dict (see `process_folder` in main.py).
+    Returns the result dicts in the original folder order.
+    """
+    jobs = max(1, jobs)
+    threads = threads_per_job(jobs, max_threads)
+    weights = weights or {folder: estimate_book_weight(folder) for folder in folders}
+    ordered = sorted(folders, key=lambda folder: weights[folder], reverse=True)
+
+    info(f"Running {len(ordered)} book(s) on {jobs} worker(s), {threads} FFmpeg thread(s) each.")
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(worker, folder, threads): folder for folder in ordered}
+        for future in as_completed(futures):
+            folder = futures[future]
+            try:
+                results[folder] = future.result()
+            except Exception as e:
+                error(f"Unexpected error while processing {folder}: {e}")
+                results[folder] = {
+                    "folder": folder,
+                    "output": None,
+                    "status": "failed",
+                    "seconds": 0.0,
+                }
+
+    return [results[folder] for folder in folders]
+
+
+def print_summary(results: list):
+    """Print a single summary table for a finished batch."""
+    if not results:
+        return
+
+    rows = []
+    for r in results:
+        name = os.path.basename(os.path.normpath(r["folder"]))
+        output = os.path.basename(r["output"]) if r.get("output") else "-"
+        rows.append((name, r["status"], f"{r['seconds']:.1f}s", output))
+
+    headers = ("Book", "Status", "Time", "Output")
+    widths = [max(len(h), *(len(row[i]) for row in rows)) for i, h in enumerate(headers)]
+
+    def fmt(row):
+        return "  ".join(str(col).ljust(widths[i]) for i, col in enumerate(row))
+
+    print()
+    print(fmt(headers))
+    print("  ".join("-" * w for w in widths))
+    for row in rows:
+        print(fmt(row))
+
+    problems = [(r, p) for r in results for p in r.get("problems") or []]
+    if problems:
+        print("\nVerification problems:")
+        for r, problem in problems:
+            print(f"  {os.path.basename(os.path.normpath(r['folder']))}: {problem}")
+
+    done = sum(1 for r in results if r["status"] == "done")
+    failed = sum(1 for r in results if r["status"] == "failed")
+    skipped = len(results) - done - failed
+    print(f"\n{done} done, {failed} failed, {skipped} skipped.\n")
+    if failed:
+        warning(f"{failed} book(s) failed to convert.")
+
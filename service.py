@@ -0,0 +1,598 @@
+# service.py
+import os
+import json
+import time
+import queue
+import signal
+import math
+import argparse
+import threading
+import itertools
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from presets import get_preset_by_name, list_presets, load_user_presets, PresetError
+from file_discovery import scan_library, find_subfolders, DEFAULT_IGNORE
+from build_cache import BuildManifest
+from loudness import LoudnessCache, loudness_settings, LOUDNESS_MODES
+from scheduler import threads_per_job, IONICE_CLASSES
+from main import process_folder, apply_preset_overrides
+from verifier import VERIFY_MODES
+from volumes import parse_size
+from logger import info, warning, error
+import scheduler
+
+DEFAULT_PORT = 8765
+DEFAULT_MAX_QUEUE = 1000
+SPOOL_POLL_SECONDS = 5.0
+
+# Finished jobs kept in memory for GET /jobs
+JOB_HISTORY = 500
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Per-job options a client may set (same meaning as the main.py flags)
+JOB_OPTIONS = {
+    "split_encode", "smart", "use_pipes", "native_mp3", "verify_chapters", "verify", "loudness",
+    "loudness_mode", "trim_silence", "cover_max_size", "cover_quality", "retries", "force",
+    "max_volume_size", "max_volume_hours",
+}
+# Options that are switches (store_true flags in main.py)
+SWITCH_OPTIONS = {"split_encode", "smart", "use_pipes", "native_mp3", "verify_chapters", "trim_silence", "force"}
+
+
+class JobError(ValueError):
+    """A job request that cannot be accepted (bad input or a full queue)."""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+class ConversionService:
+    """
+    Long-running conversion service. Jobs (one per book folder) are put on
+    a bounded queue and converted by a fixed pool of worker threads with
+    process_folder, the same pipeline as a batch run. The build manifest
+    and loudness cache of every library root are shared by all jobs, so
+    unchanged books are skipped just like in main.py.
+
+    Nothing here reads from stdin: unknown presets and bad folders are
+    rejected when the job is submitted.
+    """
+
+    def __init__(self, workers: int = 1, max_threads: int = None, default_preset: str = None,
+                 options: dict = None, max_queue: int = DEFAULT_MAX_QUEUE):
+        self.workers = max(1, workers)
+        self.threads = threads_per_job(self.workers, max_threads)
+        self.default_preset = default_preset
+        self.options = options or {}
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.jobs = {}
+        self.started_at = time.time()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._submit_lock = threading.Lock()
+        self._manifests = {}
+        self._loudness_caches = {}
+        self._threads = []
+        self.totals = {"done": 0, "failed": 0, "skipped": 0, "audio_seconds": 0.0, "busy_seconds": 0.0}
+
+    # --- Submission ---
+
+    def submit(self, request: dict, source: str = "http") -> list:
+        """
+        Queue a job request and return the new (or already queued) job records.
+
+        A request names one book folder or a library root to scan for books:
+            {"folder": "/books/Some Book", "preset": "...", "options": {...}}
+            {"root": "/books", "preset": "..."}
+        Outputs are written to the book folder's parent (for "root" jobs,
+        the root), as in a batch run. "preset" defaults to the service's
+        --preset; "options" takes the JOB_OPTIONS keys (see check_job_options).
+        A book with a queued or running job is not queued twice: the same
+        request returns that job, another preset or options is refused (409).
+        A request is queued whole or not at all: if the queue has no room for
+        all of its new jobs, none are queued (503).
+        """
+        if not isinstance(request, dict):
+            raise JobError("Job request must be a JSON object")
+
+        preset_name = request.get("preset") or self.default_preset
+        if not preset_name:
+            raise JobError("No preset given and the service has no default preset")
+        preset = get_preset_by_name(preset_name)
+        if not preset:
+            raise JobError(f"Unknown preset '{preset_name}'")
+
+        options = dict(self.options)
+        job_options = request.get("options") or {}
+        if not isinstance(job_options, dict):
+            raise JobError("'options' must be a JSON object")
+        unknown = set(job_options) - JOB_OPTIONS
+        if unknown:
+            raise JobError(f"Unknown option(s): {', '.join(sorted(unknown))}")
+        check_job_options(job_options)
+        options.update(job_options)
+        preset = apply_preset_overrides(preset, options)
+
+        if request.get("folder"):
+            folder = os.path.abspath(request["folder"])
+            if not os.path.isdir(folder):
+                raise JobError(f"Folder not found: {folder}")
+            root_dir = os.path.dirname(folder)
+            books = [(folder, root_dir, None)]
+        elif request.get("root"):
+            root_dir = os.path.abspath(request["root"])
+            if not os.path.isdir(root_dir):
+                raise JobError(f"Folder not found: {root_dir}")
+            library = scan_library(root_dir, ignore=DEFAULT_IGNORE)
+            books = [(folder, root_dir, library[folder]) for folder in sorted(find_subfolders(root_dir, library))]
+            if not books:
+                raise JobError(f"No audio folders found in {root_dir}")
+        else:
+            raise JobError("Job request needs a 'folder' or a 'root'")
+
+        with self._submit_lock:
+            # The same request for a book that is already queued or running
+            # joins that job; another preset or options for it is refused, since
+            # both jobs could write the same output file
+            with self._lock:
+                active = {job["folder"]: job for job in self.jobs.values() if job["state"] in (QUEUED, RUNNING)}
+            busy = [folder for folder, _, _ in books if folder in active
+                    and (active[folder]["preset"], active[folder]["options"]) != (preset_name, job_options)]
+            if busy:
+                raise JobError(f"{len(busy)} book(s) already have a queued or running job with another preset "
+                               f"or options (e.g. {busy[0]}); resubmit when it has finished", status=409)
+
+            # Only submit() adds jobs, so room checked here is still there below
+            new = sum(1 for folder, _, _ in books if folder not in active)
+            if self.queue.maxsize and self.queue.maxsize - self.queue.qsize() < new:
+                raise JobError(f"Job queue is full ({new} job(s) to queue, room for "
+                               f"{max(0, self.queue.maxsize - self.queue.qsize())})", status=503)
+
+            records = []
+            for folder, book_root, listing in books:
+                if folder in active:
+                    info(f"Already queued: {folder} (job {active[folder]['id']})")
+                    records.append(active[folder])
+                    continue
+                job = {
+                    "id": str(next(self._ids)),
+                    "folder": folder,
+                    "root": book_root,
+                    "preset": preset_name,
+                    "options": job_options,
+                    "source": source,
+                    "state": QUEUED,
+                    "submitted_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "started_at": None,
+                    "finished_at": None,
+                    "status": None,
+                    "output": None,
+                    "seconds": None,
+                    "audio_seconds": None,
+                    "error": None,
+                }
+                with self._lock:
+                    self.jobs[job["id"]] = job
+                self.queue.put_nowait((job, preset, options, listing))
+                info(f"Queued job {job['id']}: {folder} ({preset_name})")
+                records.append(job)
+        return [dict(job) for job in records]
+
+    # --- Workers ---
+
+    def start(self):
+        for idx in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"worker-{idx + 1}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        info(f"Service: {self.workers} worker(s), {self.threads} FFmpeg thread(s) each.")
+
+    def stop(self, wait: bool = True):
+        """Let running jobs finish and stop the workers. Queued jobs are dropped."""
+        while True:
+            try:
+                job, _, _, _ = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self.jobs.pop(job["id"], None)
+        for _ in self._threads:
+            self.queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _shared(self, root_dir: str, preset: dict):
+        """The build manifest and loudness cache of a library root."""
+        with self._lock:
+            manifest = self._manifests.get(root_dir)
+            if manifest is None:
+                manifest = self._manifests[root_dir] = BuildManifest(root_dir)
+            cache = None
+            if loudness_settings(preset):
+                cache = self._loudness_caches.get(root_dir)
+                if cache is None:
+                    cache = self._loudness_caches[root_dir] = LoudnessCache(root_dir)
+        return manifest, cache
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            job, preset, options, listing = item
+            self._run_job(job, preset, options, listing)
+
+    def _run_job(self, job: dict, preset: dict, options: dict, listing: dict):
+        with self._lock:
+            job["state"] = RUNNING
+            job["started_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        start = time.perf_counter()
+        result = {"status": "failed", "output": None}
+        try:
+            manifest, cache = self._shared(job["root"], preset)
+            result = process_folder(job["folder"], job["root"], preset, self.threads, options, manifest,
+                                    None, listing, cache)
+        except Exception as e:
+            error(f"Job {job['id']} failed: {e}")
+            job["error"] = str(e)
+        seconds = time.perf_counter() - start
+
+        with self._lock:
+            job["state"] = FAILED if result["status"] == "failed" else DONE
+            job["status"] = result["status"]
+            job["output"] = result.get("output")
+            job["seconds"] = round(seconds, 3)
+            job["audio_seconds"] = result.get("audio_seconds")
+            job["finished_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+            if result["status"] == "done":
+                self.totals["done"] += 1
+                self.totals["audio_seconds"] += result.get("audio_seconds") or 0.0
+                self.totals["busy_seconds"] += seconds
+            elif result["status"] == "failed":
+                self.totals["failed"] += 1
+            else:
+                self.totals["skipped"] += 1
+            self._trim_history()
+        info(f"Job {job['id']} {job['status']} in {seconds:.1f}s: {job['folder']}")
+
+    def _trim_history(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job["state"] in (DONE, FAILED)]
+        for job_id in finished[:max(0, len(finished) - JOB_HISTORY)]:
+            del self.jobs[job_id]
+
+    # --- Reporting ---
+
+    def job(self, job_id: str) -> dict:
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list_jobs(self, state: str = None) -> list:
+        with self._lock:
+            return [dict(job) for job in self.jobs.values() if state is None or job["state"] == state]
+
+    def is_idle(self, job_ids: list) -> bool:
+        """True when none of the given jobs is queued or running."""
+        with self._lock:
+            return all(self.jobs.get(job_id, {}).get("state") not in (QUEUED, RUNNING) for job_id in job_ids)
+
+    def status(self) -> dict:
+        """Queue sizes and throughput since the service started."""
+        with self._lock:
+            states = [job["state"] for job in self.jobs.values()]
+            totals = dict(self.totals)
+        uptime = time.time() - self.started_at
+        busy = totals["busy_seconds"]
+        return {
+            "uptime_seconds": round(uptime, 1),
+            "workers": self.workers,
+            "threads_per_job": self.threads,
+            "queued": states.count(QUEUED),
+            "running": states.count(RUNNING),
+            "done": totals["done"],
+            "failed": totals["failed"],
+            "skipped": totals["skipped"],
+            "audio_hours_converted": round(totals["audio_seconds"] / 3600, 3),
+            "books_per_hour": round(totals["done"] * 3600 / uptime, 2) if uptime else None,
+            # Audio seconds converted per second a worker spent converting
+            "realtime_factor": round(totals["audio_seconds"] / busy, 1) if busy else None,
+        }
+
+
+def check_job_options(options: dict):
+    """
+    Check the values of a job's options the way main.py's argument parser
+    checks the matching flags. Raises JobError for a bad value.
+    """
+    def number(key, value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise JobError(f"Option '{key}' must be a number, not {value!r}")
+
+    for key, value in options.items():
+        if value is None:
+            continue
+        if key in SWITCH_OPTIONS:
+            if not isinstance(value, bool):
+                raise JobError(f"Option '{key}' must be true or false, not {value!r}")
+        elif key == "verify":
+            if value not in VERIFY_MODES:
+                raise JobError(f"Option 'verify' must be one of {', '.join(VERIFY_MODES)}")
+        elif key == "loudness_mode":
+            if value not in LOUDNESS_MODES:
+                raise JobError(f"Option 'loudness_mode' must be one of {', '.join(LOUDNESS_MODES)}")
+        elif key == "loudness":
+            number(key, value)
+        elif key == "max_volume_hours":
+            number(key, value)
+            if value <= 0:
+                raise JobError("Option 'max_volume_hours' must be positive")
+        elif key == "max_volume_size":
+            try:
+                if parse_size(value) <= 0:
+                    raise ValueError(f"Volume size must be positive, not '{value}'")
+            except ValueError as e:
+                raise JobError(str(e))
+        elif key in ("retries", "cover_max_size", "cover_quality"):
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise JobError(f"Option '{key}' must be an integer, not {value!r}")
+            if value < (0 if key == "retries" else 1):
+                raise JobError(f"Option '{key}' is out of range: {value}")
+
+
+# -------------------------------
+# Spool directory
+# -------------------------------
+
+class SpoolWatcher:
+    """
+    Picks up job requests dropped into a spool directory as *.json files
+    (same format as POST /jobs). A file is moved to 'done/' or 'failed/'
+    once all its books are finished, with the job records appended, and to
+    'rejected/' if it cannot be queued. Files still in the spool when the
+    service stops are picked up again on the next start.
+
+    Write the file under another name and rename it to *.json, so a
+    half-written request is never read.
+    """
+
+    def __init__(self, service: ConversionService, spool_dir: str, interval: float = SPOOL_POLL_SECONDS):
+        self.service = service
+        self.spool_dir = os.path.abspath(spool_dir)
+        self.interval = interval
+        self.pending = {}  # file name -> job ids
+        self._stop = threading.Event()
+        self._thread = None
+        for name in ("done", "failed", "rejected"):
+            os.makedirs(os.path.join(self.spool_dir, name), exist_ok=True)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="spool", daemon=True)
+        self._thread.start()
+        info(f"Watching spool directory: {self.spool_dir}")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                error(f"Spool scan failed: {e}")
+            self._stop.wait(self.interval)
+
+    def _move(self, name: str, subdir: str, report: dict):
+        path = os.path.join(self.spool_dir, name)
+        target = os.path.join(self.spool_dir, subdir, name)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                request = json.load(f)
+        except (OSError, ValueError):
+            request = None
+        tmp_path = target + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"request": request} | report, f, indent=2)
+            os.replace(tmp_path, target)
+            os.remove(path)
+        except OSError as e:
+            warning(f"Could not move spool file {name}: {e}")
+
+    def poll(self):
+        """Queue new spool files and file away the finished ones."""
+        names = sorted(n for n in os.listdir(self.spool_dir)
+                       if n.lower().endswith(".json") and os.path.isfile(os.path.join(self.spool_dir, n)))
+        for name in names:
+            if name in self.pending:
+                continue
+            path = os.path.join(self.spool_dir, name)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    request = json.load(f)
+                jobs = self.service.submit(request, source=f"spool:{name}")
+            except JobError as e:
+                if e.status == 503:
+                    return  # queue full; try again on the next scan
+                warning(f"Rejected spool file {name}: {e}")
+                self._move(name, "rejected", {"error": str(e)})
+                continue
+            except (OSError, ValueError) as e:
+                warning(f"Rejected spool file {name}: {e}")
+                self._move(name, "rejected", {"error": str(e)})
+                continue
+            self.pending[name] = [job["id"] for job in jobs]
+
+        for name, job_ids in list(self.pending.items()):
+            if not self.service.is_idle(job_ids):
+                continue
+            jobs = [self.service.job(job_id) for job_id in job_ids]
+            failed = any(job and job["state"] == FAILED for job in jobs)
+            self._move(name, "failed" if failed else "done", {"jobs": [job for job in jobs if job]})
+            del self.pending[name]
+
+
+# -------------------------------
+# HTTP API
+# -------------------------------
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    Local JSON API:
+        POST /jobs          queue a job request (202, {"jobs": [...]})
+        GET  /jobs          all known jobs (?state=queued|running|done|failed)
+        GET  /jobs/<id>     one job
+        GET  /status        queue sizes and throughput
+        GET  /presets       available preset names
+    """
+
+    service = None  # set by serve()
+    max_body = 1024 * 1024
+
+    def _send(self, status: int, body):
+        data = json.dumps(body, indent=2).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        if parts == ["status"]:
+            self._send(200, self.service.status())
+        elif parts == ["presets"]:
+            self._send(200, {"presets": list_presets(), "default": self.service.default_preset})
+        elif parts == ["jobs"]:
+            state = parse_qs(url.query).get("state", [None])[0]
+            self._send(200, {"jobs": self.service.list_jobs(state)})
+        elif len(parts) == 2 and parts[0] == "jobs":
+            job = self.service.job(parts[1])
+            if job:
+                self._send(200, job)
+            else:
+                self._send(404, {"error": f"No job {parts[1]}"})
+        else:
+            self._send(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip("/") != "/jobs":
+            self._send(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > self.max_body:
+                raise JobError("Request body too large", status=413)
+            request = json.loads(self.rfile.read(length) or b"null")
+            jobs = self.service.submit(request)
+        except JobError as e:
+            self._send(e.status, {"error": str(e)})
+            return
+        except ValueError as e:
+            self._send(400, {"error": f"Invalid JSON: {e}"})
+            return
+        self._send(202, {"jobs": jobs})
+
+    def log_message(self, format, *args):
+        info(f"HTTP {self.address_string()} {format % args}")
+
+
+def serve(service: ConversionService, host: str, port: int, spool_dir: str = None):
+    """Run the HTTP API (and spool watcher) until SIGINT/SIGTERM."""
+    service.start()
+    watcher = SpoolWatcher(service, spool_dir) if spool_dir else None
+    if watcher:
+        watcher.start()
+
+    ServiceHandler.service = service
+    httpd = ThreadingHTTPServer((host, port), ServiceHandler)
+    httpd.daemon_threads = True
+
+    def shut_down(signum, frame):
+        info("Shutting down: finishing running jobs...")
+        # shutdown() waits for serve_forever(), so it cannot run on this thread
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGINT, shut_down)
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, shut_down)
+
+    info(f"Listening on http://{host}:{httpd.server_address[1]}")
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        if watcher:
+            watcher.stop()
+        service.stop()
+        info("Service stopped.")
+
+
+# -------------------------------
+# Main
+# -------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the audiobook converter as a service with a job queue.")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Address to listen on (default: 127.0.0.1, local only)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help=f"Port of the HTTP API (default: {DEFAULT_PORT})")
+    parser.add_argument("--spool", metavar="DIR",
+                        help="Also take job requests from *.json files dropped into this directory")
+    parser.add_argument("-p", "--preset",
+                        help="Preset for jobs that do not name one")
+    parser.add_argument("--presets-file", metavar="PATH",
+                        help="Load extra presets from a TOML or JSON file")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Books converted at the same time (default: 1)")
+    parser.add_argument("--max-threads", type=int, default=None,
+                        help="Total FFmpeg threads shared by all workers (default: CPU count)")
+    parser.add_argument("--max-queue", type=int, default=DEFAULT_MAX_QUEUE,
+                        help=f"Reject new jobs while this many are waiting (default: {DEFAULT_MAX_QUEUE})")
+    parser.add_argument("--load-target", type=float, default=1.0,
+                        help="Keep total FFmpeg load at this multiple of the CPU cores (default: 1.0)")
+    parser.add_argument("--nice", type=int, default=None, metavar="N",
+                        help="Run FFmpeg at this nice level (lower CPU priority)")
+    parser.add_argument("--ionice", choices=list(IONICE_CLASSES), default=None,
+                        help="Run FFmpeg in this I/O priority class (Linux)")
+    parser.add_argument("--split-encode", action="store_true",
+                        help="Default for jobs: encode AAC chapters in parallel (see main.py)")
+    parser.add_argument("--smart", action="store_true",
+                        help="Default for jobs: stream-copy books that already fit the preset")
+    parser.add_argument("--retries", type=int, default=0,
+                        help="Default for jobs: retry a failed conversion up to N times")
+    parser.add_argument("--verify", nargs="?", const="headers", choices=VERIFY_MODES, default=None,
+                        help="Default for jobs: check every new output before it is moved into place (see main.py)")
+    args = parser.parse_args()
+
+    if args.presets_file:
+        try:
+            load_user_presets(args.presets_file)
+        except PresetError as e:
+            parser.error(str(e))
+    if args.preset and not get_preset_by_name(args.preset):
+        parser.error(f"Unknown preset '{args.preset}'")
+
+    scheduler.configure(load_target=args.load_target, niceness=args.nice, ionice=args.ionice)
+
+    service = ConversionService(
+        workers=args.workers,
+        max_threads=args.max_threads,
+        default_preset=args.preset,
+        options={"split_encode": args.split_encode, "smart": args.smart, "retries": args.retries,
+                 "verify": args.verify},
+        max_queue=args.max_queue,
+    )
+    serve(service, args.host, args.port, args.spool)
@@ -0,0 +1,155 @@
+# silence_trim.py
+import os
+import sys
+import math
+import array
+import subprocess
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor
+from logger import info, error
+from scheduler import run_child
+
+try:
+    import numpy as np
+except ImportError:  # the pure-Python scan is used instead
+    np = None
+
+# Edges are decoded to mono 16-bit PCM at this rate; plenty for an RMS level
+ANALYSIS_RATE = 8000
+WINDOW_SECONDS = 0.02
+
+# Defaults for a preset's "trim_silence" entry
+DEFAULT_THRESHOLD_DB = -50.0   # windows quieter than this (dBFS RMS) are silence
+DEFAULT_MIN_SILENCE = 0.5      # only trim runs of silence at least this long (s)
+DEFAULT_KEEP = 0.25            # leave this much silence at each trimmed edge (s)
+DEFAULT_MAX_SCAN = 15.0        # look at most this far into each edge (s)
+
+# FFmpeg filters of the speech profile: drop rumble and content above the voice band
+SPEECH_FILTERS = ["highpass=f=80", "lowpass=f=8000"]
+
+
+def trim_settings(preset: dict):
+    """
+    Return the normalized "trim_silence" settings of a preset, or None.
+    A preset enables it with {"trim_silence": true} or a dict overriding
+    threshold_db, min_silence, keep and max_scan.
+    """
+    settings = preset.get("trim_silence")
+    if not settings:
+        return None
+    settings = settings if isinstance(settings, dict) else {}
+    return {
+        "threshold_db": float(settings.get("threshold_db", DEFAULT_THRESHOLD_DB)),
+        "min_silence": float(settings.get("min_silence", DEFAULT_MIN_SILENCE)),
+        "keep": float(settings.get("keep", DEFAULT_KEEP)),
+        "max_scan": float(settings.get("max_scan", DEFAULT_MAX_SCAN)),
+    }
+
+
+def speech_filters(preset: dict) -> list:
+    """FFmpeg audio filters of the preset's speech profile (empty if not enabled)."""
+    return list(SPEECH_FILTERS) if preset.get("speech") else []
+
+
+def decode_edge(path: str, seconds: float, tail: bool = False) -> bytes:
+    """Decode only the first (or last) `seconds` of a file to mono s16le PCM."""
+    cmd = ["ffmpeg", "-v", "error", "-threads", "1"]
+    if tail:
+        cmd.extend(["-sseof", f"-{seconds}"])
+    cmd.extend(["-i", path, "-vn", "-t", str(seconds),
+                "-ac", "1", "-ar", str(ANALYSIS_RATE), "-f", "s16le", "-"])
+    return run_child(cmd, threads=1, check=True, capture_output=True).stdout
+
+
+def window_levels(pcm: bytes, window: int) -> list:
+    """RMS level (dBFS) of consecutive `window`-sample windows of s16le PCM."""
+    count = len(pcm) // 2 // window
+    if not count:
+        return []
+    if np is not None:
+        samples = np.frombuffer(pcm, dtype="<i2", count=count * window).astype(np.float64)
+        rms = np.sqrt(np.mean(samples.reshape(count, window) ** 2, axis=1)) / 32768.0
+        return (20 * np.log10(np.maximum(rms, 1e-10))).tolist()
+
+    samples = array.array("h")
+    samples.frombytes(pcm[:count * window * 2])
+    if sys.byteorder == "big":
+        samples.byteswap()
+    levels = []
+    for i in range(0, count * window, window):
+        power = sum(s * s for s in samples[i:i + window]) / window
+        levels.append(20 * math.log10(max(math.sqrt(power) / 32768.0, 1e-10)))
+    return levels
+
+
+def _silent_run(levels: list, threshold_db: float) -> int:
+    """Number of leading windows below the threshold."""
+    run = 0
+    for level in levels:
+        if level >= threshold_db:
+            break
+        run += 1
+    return run
+
+
+def find_edges(path: str, duration: float, settings: dict):
+    """
+    Find leading and trailing silence of one file.
+    Returns (inpoint, outpoint) in seconds of the file; outpoint is None
+    when the end is kept.
+    """
+    window = int(ANALYSIS_RATE * WINDOW_SECONDS)
+    scan = min(settings["max_scan"], duration / 2) if duration else settings["max_scan"]
+    try:
+        head = window_levels(decode_edge(path, scan), window)
+        tail = window_levels(decode_edge(path, scan, tail=True), window)
+    except subprocess.CalledProcessError as e:
+        error(f"Silence scan failed for {path}: {e}")
+        return 0.0, None
+
+    lead = _silent_run(head, settings["threshold_db"]) * WINDOW_SECONDS
+    trail = _silent_run(reversed(tail), settings["threshold_db"]) * WINDOW_SECONDS
+
+    inpoint = lead - settings["keep"] if lead >= settings["min_silence"] else 0.0
+    outpoint = None
+    if duration and trail >= settings["min_silence"]:
+        outpoint = duration - trail + settings["keep"]
+
+    inpoint = max(0.0, inpoint)
+    if outpoint is not None and outpoint - inpoint < settings["min_silence"]:
+        return 0.0, None  # (almost) entirely silent; leave it alone
+    return inpoint, outpoint
+
+
+def find_book_edges(paths: list, probes: list, settings: dict, jobs: int = None) -> list:
+    """
+    Scan the edges of every file in parallel and return one (inpoint,
+    outpoint) per file, aligned to whole samples of the file's sample rate.
+    """
+    jobs = jobs or os.cpu_count() or 1
+
+    def scan(pair):
+        path, probe = pair
+        inpoint, outpoint = find_edges(path, probe.duration, settings)
+        rate = probe.sample_rate or 1000
+        inpoint = Fraction(round(inpoint * rate), rate)
+        outpoint = Fraction(round(outpoint * rate), rate) if outpoint is not None else None
+        return inpoint, outpoint
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        trims = list(pool.map(scan, zip(paths, probes)))
+
+    removed = sum(float(start) + (probe.duration - float(end) if end is not None else 0.0)
+                  for (start, end), probe in zip(trims, probes))
+    info(f"Silence trim: removing {removed:.1f}s from {len(paths)} file(s) "
+         f"({'numpy' if np is not None else 'pure Python'} scan).")
+    return trims
+
+
+def trimmed_lengths(lengths: list, trims: list) -> list:
+    """Chapter lengths (Fractions of seconds) after trimming each file to its (inpoint, outpoint)."""
+    result = []
+    for length, (inpoint, outpoint) in zip(lengths, trims):
+        end = min(length, outpoint) if outpoint is not None else length
+        result.append(max(Fraction(0), end - inpoint))
+    return result
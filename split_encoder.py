@@ -0,0 +1,187 @@
+# split_encoder.py
+import os
+import subprocess
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from itertools import accumulate
+from logger import info, warning, error
+from scheduler import run_child
+from presets import encoder_args
+
+# ADTS sampling frequency index table (ISO/IEC 14496-3)
+ADTS_SAMPLE_RATES = [
+    96000, 88200, 64000, 48000, 44100, 32000,
+    24000, 22050, 16000, 12000, 11025, 8000, 7350
+]
+
+SAMPLES_PER_FRAME = 1024
+
+# Audio of the neighbouring segments encoded on either side of a segment
+# (whole frames), so its first and last kept frames overlap real audio
+SEGMENT_OVERLAP = 2 * SAMPLES_PER_FRAME
+
+SPLIT_CODECS = ["aac"]
+
+
+def supports_split_encode(preset: dict) -> bool:
+    """Return True if the preset's encoder can be split-encoded and stitched."""
+    return preset.get("codec") in SPLIT_CODECS
+
+
+def read_adts_frames(path: str):
+    """
+    Read an ADTS (.aac) file and return (frames, sample_rate), one bytes
+    object per frame. Only whole, valid frames are kept.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    pos = 0
+    frames = []
+    sample_rate = None
+    end = len(data)
+    while pos + 7 <= end:
+        if data[pos] != 0xFF or (data[pos + 1] & 0xF6) != 0xF0:
+            raise ValueError(f"Lost ADTS sync at byte {pos} in {path}")
+        sr_index = (data[pos + 2] >> 2) & 0x0F
+        frame_len = ((data[pos + 3] & 0x03) << 11) | (data[pos + 4] << 3) | (data[pos + 5] >> 5)
+        if data[pos + 6] & 0x03:
+            raise ValueError(f"Multiple raw data blocks per frame in {path}")
+        if frame_len < 7 or pos + frame_len > end:
+            break
+        if sample_rate is None:
+            sample_rate = ADTS_SAMPLE_RATES[sr_index]
+        frames.append(data[pos:pos + frame_len])
+        pos += frame_len
+
+    return frames, sample_rate
+
+
+def plan_segments(lengths: list, sample_rate: int):
+    """
+    Cut the joined stream of files with `lengths` (seconds) into one segment
+    per file, each boundary moved to the nearest frame boundary at
+    `sample_rate`. Returns [(start, end)] in output samples; files shorter
+    than the move are left to their neighbours.
+    """
+    bounds = [round(pos * sample_rate) for pos in accumulate(lengths)]
+    total = bounds[-1]
+    cuts = [0] + [min(total, round(pos / SAMPLES_PER_FRAME) * SAMPLES_PER_FRAME) for pos in bounds[:-1]] + [total]
+    return [(start, end) for start, end in zip(cuts, cuts[1:]) if end > start]
+
+
+def encode_segment(list_path: str, dst: str, preset: dict, sample_rate: int, audio_filters: list) -> bool:
+    """
+    Encode the concat list at `list_path` through `audio_filters` to a raw
+    ADTS segment with a single-threaded encoder.
+    """
+    cmd = ["ffmpeg", "-y", "-v", "error", "-threads", "1", "-f", "concat", "-safe", "0", "-i", list_path, "-vn"]
+    cmd.extend(["-af", ",".join(audio_filters)])
+    cmd.extend(["-c:a", preset["codec"]])
+    if preset.get("bitrate"):
+        cmd.extend(["-b:a", preset["bitrate"]])
+    if preset.get("channels"):
+        cmd.extend(["-ac", str(preset["channels"])])
+    cmd.extend(["-ar", str(sample_rate)])
+    cmd.extend(encoder_args(preset))
+    cmd.extend(["-f", "adts", dst])
+
+    try:
+        run_child(cmd, threads=1, check=True)
+        return True
+    except subprocess.CalledProcessError as e:
+        error(f"Segment encode failed for {dst}: {e}")
+        return False
+
+
+def split_encode(lengths: list, segment_input, preset: dict, scratch_dir: str, jobs: int = None,
+                 sample_rate: int = None):
+    """
+    Encode the joined stream in segments in parallel, then stitch the
+    segments frame-by-frame into a single ADTS stream.
+
+    The joined stream (files with `lengths` in seconds) is cut into one
+    segment per file on frame boundaries. Every segment is encoded with
+    SEGMENT_OVERLAP samples of its neighbours on either side, and only the
+    frames decoding to its own range are kept: the encoder's priming and
+    padding are dropped, and the frames on both sides of a seam decode from
+    the same audio, so the stitched stream plays the joined audio sample for
+    sample and the chapters use the same lengths as a single encode. The
+    first frame kept is the stream's priming frame.
+
+    `segment_input(first, end)` returns (concat_list, filters) decoding
+    files[first:end] from zero, with their trims and loudness gains.
+
+    Returns (stitched_path, timestamps), where `timestamps` is the setts
+    bitstream filter giving the stitched packets their times (priming before
+    zero, last frame cut to the stream's length), or (None, None) on failure.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    starts = list(accumulate([Fraction(0)] + lengths[:-1]))
+    segments = plan_segments(lengths, sample_rate)
+    total = segments[-1][1]
+
+    jobs_args = []
+    for seg_idx, (start, end) in enumerate(segments):
+        region_start = max(0, start - SEGMENT_OVERLAP)
+        region_end = min(total, end + SEGMENT_OVERLAP)
+        first = bisect_right(starts, Fraction(region_start, sample_rate)) - 1
+        last = bisect_left(starts, Fraction(region_end, sample_rate))
+        concat_list, filters = segment_input(first, last)
+        offset = round((Fraction(region_start, sample_rate) - starts[first]) * sample_rate)
+        filters = filters + [
+            f"aresample={sample_rate}",
+            f"atrim=start_sample={offset}:end_sample={offset + region_end - region_start}",
+            "asetpts=N/SR/TB",
+        ]
+        # Silence before the first segment stands in for the overlap
+        if region_start > start - SEGMENT_OVERLAP:
+            filters.append(f"adelay=delays={region_start - start + SEGMENT_OVERLAP}S:all=1")
+
+        list_path = os.path.join(scratch_dir, f"segment_{seg_idx:04d}.txt")
+        with open(list_path, "w", encoding="utf-8") as f:
+            f.write(concat_list)
+        jobs_args.append((list_path, os.path.join(scratch_dir, f"segment_{seg_idx:04d}.aac"), filters))
+
+    info(f"Split-encoding {len(segments)} segment(s) on {jobs} worker(s).")
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(
+            lambda args: encode_segment(args[0], args[1], preset, sample_rate, args[2]),
+            jobs_args
+        ))
+
+    if not all(results):
+        return None, None
+
+    # Frame j of a segment decodes its input from (j - 1) * 1024 on
+    skip = SEGMENT_OVERLAP // SAMPLES_PER_FRAME + 1
+    stitched_path = os.path.join(scratch_dir, "stitched.aac")
+    packets = 0
+    try:
+        with open(stitched_path, "wb") as out:
+            for seg_idx, ((start, end), (list_path, path, _)) in enumerate(zip(segments, jobs_args)):
+                frames, rate = read_adts_frames(path)
+                if rate != sample_rate:
+                    warning(f"Segment {path} has sample rate {rate}, expected {sample_rate}.")
+                    return None, None
+                keep = skip - 1 if seg_idx == 0 else skip
+                count = skip + -(-(end - start) // SAMPLES_PER_FRAME)
+                if len(frames) < count:
+                    raise ValueError(f"Segment {path} is {len(frames)} frames, expected at least {count}")
+                out.write(b"".join(frames[keep:count]))
+                packets += count - keep
+                os.remove(path)
+                os.remove(list_path)
+    except (OSError, ValueError) as e:
+        error(f"Failed to stitch encoded segments: {e}")
+        return None, None
+
+    # setts times are in the stream time base; ',' separates bitstream filters
+    frame = f"{SAMPLES_PER_FRAME}/({sample_rate}*TB)"
+    last = total - (packets - 2) * SAMPLES_PER_FRAME
+    timestamps = (f"setts=ts=(N-1)*{frame}:"
+                  f"duration=if(eq(N\\,{packets - 1})\\,{last}/({sample_rate}*TB)\\,{frame})")
+
+    info(f"Stitched {len(segments)} segment(s) into {stitched_path}")
+    return stitched_path, timestamps
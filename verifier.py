@@ -0,0 +1,199 @@
+# verifier.py
+import os
+import struct
+import subprocess
+import mutagen
+from mutagen.mp4 import MP4
+from mutagen.flac import FLAC
+from mutagen.id3 import ID3
+
+from logger import info, warning, error
+from chapter_timeline import read_chapters
+from scheduler import run_child
+
+# "headers" only reads container headers; "sample" also decodes a few
+# seconds around every chapter boundary and at the end of the file
+VERIFY_MODES = ["headers", "sample"]
+
+# Container duration may differ from the inputs by encoder delay/padding
+DURATION_TOLERANCE = 0.5        # seconds
+DURATION_TOLERANCE_RATIO = 0.001
+# Chapter starts may move by a frame or so (e.g. split-encode aligns them to AAC frames)
+CHAPTER_TOLERANCE = 0.25        # seconds
+
+SAMPLE_SECONDS = 2.0
+# Boundaries decoded per FFmpeg process
+SAMPLES_PER_RUN = 32
+
+# Tags the converter writes, per container, keyed like the pipeline's metadata dict
+MP4_TAGS = {"title": "\xa9nam", "author": "\xa9ART"}
+ID3_TAGS = {"title": "TIT2", "author": "TPE1"}
+VORBIS_TAGS = {"title": "title", "author": "artist"}
+
+
+def read_output(path: str) -> dict:
+    """
+    Header-level facts about a finished audiobook, without decoding it:
+    {'duration', 'tags' (title/author), 'cover' (bool), 'truncated' (bool)}.
+    """
+    audio = mutagen.File(path)
+    if audio is None or audio.info is None:
+        raise ValueError("unrecognised audio file")
+
+    tags = {}
+    cover = False
+    truncated = False
+    if isinstance(audio, MP4):
+        for key, atom in MP4_TAGS.items():
+            if audio.tags and audio.tags.get(atom):
+                tags[key] = str(audio.tags[atom][0])
+        cover = bool(audio.tags and audio.tags.get("covr"))
+        truncated = _mp4_truncated(path)
+    elif isinstance(audio.tags, ID3):
+        for key, frame in ID3_TAGS.items():
+            if audio.tags.get(frame):
+                tags[key] = str(audio.tags[frame].text[0])
+        cover = bool(audio.tags.getall("APIC"))
+    else:
+        for key, name in VORBIS_TAGS.items():
+            if audio.tags and audio.tags.get(name):
+                tags[key] = str(audio.tags[name][0])
+        if isinstance(audio, FLAC):
+            cover = bool(audio.pictures)
+        else:
+            cover = bool(audio.tags and audio.tags.get("metadata_block_picture"))
+
+    return {"duration": audio.info.length, "tags": tags, "cover": cover, "truncated": truncated}
+
+
+def _mp4_truncated(path: str) -> bool:
+    """True if a top-level MP4 box (usually mdat) runs past the end of the file."""
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        pos = 0
+        while pos + 8 <= file_size:
+            f.seek(pos)
+            size, _ = struct.unpack(">I4s", f.read(8))
+            if size == 1:
+                size = struct.unpack(">Q", f.read(8))[0]
+            elif size == 0:
+                return False  # box extends to the end of the file by definition
+            if size < 8:
+                return True
+            pos += size
+    return pos > file_size
+
+
+def sample_boundaries(path: str, positions: list) -> list:
+    """
+    Decode SAMPLE_SECONDS around each position (seconds) and return the
+    positions FFmpeg could not decode cleanly.
+    """
+    failed = []
+    half = SAMPLE_SECONDS / 2
+    for i in range(0, len(positions), SAMPLES_PER_RUN):
+        batch = positions[i:i + SAMPLES_PER_RUN]
+        cmd = ["ffmpeg", "-v", "error", "-xerror", "-threads", "1"]
+        for position in batch:
+            cmd.extend(["-ss", f"{max(0.0, position - half):.3f}", "-t", str(SAMPLE_SECONDS), "-i", path])
+        for idx in range(len(batch)):
+            cmd.extend(["-map", f"{idx}:a"])
+        cmd.extend(["-f", "null", "-"])
+        try:
+            proc = run_child(cmd, threads=1, capture_output=True, text=True, encoding="utf-8", errors="replace")
+        except OSError as e:
+            error(f"Could not run FFmpeg to sample {path}: {e}")
+            return list(positions)
+        # -xerror stops at decode errors; demuxer errors (e.g. Ogg CRC
+        # mismatches) are only logged. The null muxer's own timestamp
+        # complaints say nothing about the audio.
+        damage = [line for line in proc.stderr.splitlines()
+                  if line.strip() and not line.startswith("[null @") and "Last message repeated" not in line]
+        if proc.returncode or damage:
+            if len(batch) == 1:
+                failed.extend(batch)
+            else:
+                # Narrow the failure down to the broken boundaries
+                failed.extend(p for p in batch if sample_boundaries(path, [p]))
+    return failed
+
+
+def _chapter_problems(name: str, chapters: list, timeline: list, rate: int) -> list:
+    """Compare a chapter table read from a file with the expected timeline."""
+    if len(chapters) != len(timeline):
+        return [f"{name}: {len(chapters)} chapters, expected {len(timeline)}"]
+    problems = []
+    starts = [start for start, _, _ in chapters]
+    if any(b <= a for a, b in zip(starts, starts[1:])):
+        problems.append(f"{name}: chapter starts are out of order")
+    for expected, start in zip(timeline, starts):
+        if abs(start - expected["start"] / rate) > CHAPTER_TOLERANCE:
+            problems.append(f"{name}: chapter '{expected['title']}' starts at {start:.2f}s, "
+                            f"expected {expected['start'] / rate:.2f}s")
+            break
+    if [title for _, _, title in chapters] != [c["title"] for c in timeline]:
+        problems.append(f"{name}: chapter titles differ from the source files")
+    return problems
+
+
+def verify_output(path: str, duration: float = None, timeline: list = None, rate: int = None,
+                  metadata: dict = None, cover_art: str = None, sample: bool = False, name: str = None) -> list:
+    """
+    Check a finished audiobook against what the build put into it: the
+    container duration against `duration` (seconds of audio the conversion
+    wrote), the chapter table against `timeline` (the one the conversion
+    wrote, see chapter_timeline.build_timeline; timebase 1/`rate`), title and author against `metadata`, and that a
+    cover is present if `cover_art` was given. Only headers are read unless
+    `sample` is set. Problems are reported under `name` (default: the file
+    name). Returns a list of problems (empty if the file passed).
+    """
+    name = name or os.path.basename(path)
+    if not os.path.isfile(path) or not os.path.getsize(path):
+        return [f"{name}: output is missing or empty"]
+
+    problems = []
+    try:
+        facts = read_output(path)
+    except Exception as e:
+        return [f"{name}: cannot read headers ({e})"]
+
+    if facts["truncated"]:
+        problems.append(f"{name}: file is truncated")
+    if duration:
+        tolerance = max(DURATION_TOLERANCE, duration * DURATION_TOLERANCE_RATIO)
+        if abs(facts["duration"] - duration) > tolerance:
+            problems.append(f"{name}: duration {facts['duration']:.1f}s, expected {duration:.1f}s")
+
+    chapters = []
+    if timeline:
+        try:
+            chapters = read_chapters(path)
+        except (OSError, subprocess.CalledProcessError) as e:
+            problems.append(f"{name}: cannot read chapters ({e})")
+        else:
+            problems.extend(_chapter_problems(name, chapters, timeline, rate))
+
+    for key in ("title", "author"):
+        expected = (metadata or {}).get(key)
+        if expected and facts["tags"].get(key) != str(expected):
+            problems.append(f"{name}: {key} tag is {facts['tags'].get(key)!r}, expected {expected!r}")
+    if cover_art and not facts["cover"]:
+        problems.append(f"{name}: cover art is missing")
+
+    sampled = 0
+    if sample and not problems:
+        positions = [start for start, _, _ in chapters[1:]]
+        positions.append(max(0.0, facts["duration"] - SAMPLE_SECONDS / 2))
+        broken = sample_boundaries(path, positions)
+        sampled = len(positions)
+        if broken:
+            problems.append(f"{name}: audio does not decode at " +
+                            ", ".join(f"{p:.1f}s" for p in broken[:5]) +
+                            (f" and {len(broken) - 5} more" if len(broken) > 5 else ""))
+
+    if problems:
+        for problem in problems:
+            warning(f"Verification failed: {problem}")
+    else:
+        info(f"Verified {name}" + (f" ({sampled} positions decoded)" if sampled else ""))
+    return problems
@@ -0,0 +1,162 @@
+# volumes.py
+import os
+import re
+from logger import info, warning
+from ffmpeg_runner import format_eta
+
+# Container overhead (sample tables, chapter track, tags) on top of the audio bitrate
+CONTAINER_OVERHEAD = 0.02
+
+# Bit rates assumed for encoders without a fixed -b:a (bits per second per channel)
+LOSSLESS_BITS_PER_CHANNEL = {"flac": 500_000, "alac": 550_000}
+
+SIZE_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$", re.IGNORECASE)
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+
+
+def parse_size(text) -> int:
+    """Parse a size such as "2G", "700M" or "1500000" (bytes) into bytes."""
+    match = SIZE_PATTERN.match(str(text))
+    if not match:
+        raise ValueError(f"Invalid size '{text}' (use e.g. 700M or 2G)")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+def volume_settings(preset: dict):
+    """
+    Return the normalized "volumes" settings of a preset, or None.
+    A preset enables splitting with {"volumes": {"max_size": "2G"}} and/or
+    {"volumes": {"max_hours": 20}}; a book longer or larger than that is
+    written as several volumes.
+    """
+    settings = preset.get("volumes")
+    if not settings:
+        return None
+    max_bytes = parse_size(settings["max_size"]) if settings.get("max_size") else None
+    max_seconds = float(settings["max_hours"]) * 3600 if settings.get("max_hours") else None
+    if not max_bytes and not max_seconds:
+        return None
+    return {"max_bytes": max_bytes, "max_seconds": max_seconds}
+
+
+def _bitrate(preset: dict):
+    """The preset's audio bit rate in bits per second, or None."""
+    bitrate = str(preset.get("bitrate") or "").strip().lower()
+    if not bitrate:
+        return None
+    scale = 1000 if bitrate.endswith("k") else 1_000_000 if bitrate.endswith("m") else 1
+    return int(float(bitrate.rstrip("km")) * scale)
+
+
+def estimate_sizes(probes: list, preset: dict) -> list:
+    """
+    Estimated output bytes of every input file: the preset's bit rate times
+    the probed duration, or the file size itself for a stream copy.
+    """
+    codec = preset.get("codec")
+    bitrate = _bitrate(preset)
+    sizes = []
+    for probe in probes:
+        if codec == "copy":
+            size = probe.size
+        else:
+            rate = bitrate
+            if rate is None and codec in LOSSLESS_BITS_PER_CHANNEL:
+                rate = LOSSLESS_BITS_PER_CHANNEL[codec] * (preset.get("channels") or probe.channels or 2)
+            if rate is None:
+                rate = probe.bitrate or 128_000
+            size = probe.duration * rate / 8
+        sizes.append(size * (1 + CONTAINER_OVERHEAD))
+    return sizes
+
+
+def plan_volumes(probes: list, preset: dict, settings: dict, extra_bytes: int = 0) -> list:
+    """
+    Split a book at chapter (file) boundaries into as few volumes as the
+    limits allow, with boundaries placed so the volumes come out about
+    equally long. `extra_bytes` (e.g. the cover) is added to every volume.
+    Returns [(first, end), ...] index ranges into the files; a single range
+    if the book fits. A chapter bigger than a limit gets a volume of its own.
+    """
+    sizes = estimate_sizes(probes, preset)
+    max_bytes = settings.get("max_bytes")
+    max_seconds = settings.get("max_seconds")
+
+    # Running totals, so any range's size and length is one subtraction
+    size_at = [0.0]
+    time_at = [0.0]
+    for size, probe in zip(sizes, probes):
+        size_at.append(size_at[-1] + size)
+        time_at.append(time_at[-1] + probe.duration)
+
+    def too_big(first, end):
+        return bool(max_bytes and size_at[end] - size_at[first] + extra_bytes > max_bytes
+                    or max_seconds and time_at[end] - time_at[first] > max_seconds)
+
+    def fits(first, end):
+        return end - first <= 1 or not too_big(first, end)
+
+    # Fewest volumes: fill each one greedily
+    greedy = []
+    first = 0
+    while first < len(probes):
+        end = first + 1
+        while end < len(probes) and fits(first, end + 1):
+            end += 1
+        greedy.append((first, end))
+        first = end
+    count = len(greedy)
+    if count <= 1:
+        return [(0, len(probes))]
+
+    # Same number of volumes, each ending at the boundary closest to an
+    # equal share of the remaining audio that still fits
+    volumes = []
+    first = 0
+    for remaining in range(count, 1, -1):
+        target = time_at[first] + (time_at[-1] - time_at[first]) / remaining
+        best = first + 1
+        end = first + 1
+        while end < len(probes) - (remaining - 1) and fits(first, end + 1):
+            end += 1
+            if abs(time_at[end] - target) <= abs(time_at[best] - target):
+                best = end
+        volumes.append((first, best))
+        first = best
+    volumes.append((first, len(probes)))
+
+    # Balancing must not push the last volume over a limit
+    if not fits(*volumes[-1]):
+        volumes = greedy
+
+    oversized = [probes[first].path for first, end in volumes if too_big(first, end)]
+    if oversized:
+        warning(f"{len(oversized)} chapter(s) alone exceed the volume limit and get a volume of their own "
+                f"(e.g. {os.path.basename(oversized[0])}).")
+    return volumes
+
+
+def volume_path(output_file: str, number: int) -> str:
+    """File name of volume `number` (1-based) of an output: 'Book - Part 2.m4b'."""
+    base, ext = os.path.splitext(output_file)
+    return f"{base} - Part {number}{ext}"
+
+
+def volume_metadata(metadata: dict, number: int) -> dict:
+    """Tags of one volume: 'Book - Part N' as title, the book as album (so players group the parts)."""
+    result = dict(metadata)
+    result["album"] = metadata.get("album") or metadata.get("title")
+    result["title"] = f"{metadata.get('title')} - Part {number}"
+    return result
+
+
+def log_volumes(book: str, volumes: list, probes: list, preset: dict):
+    """Log the planned volumes of a book."""
+    if len(volumes) <= 1:
+        return
+    sizes = estimate_sizes(probes, preset)
+    info(f"Splitting {book} into {len(volumes)} volumes:")
+    for number, (first, end) in enumerate(volumes, start=1):
+        seconds = sum(p.duration for p in probes[first:end])
+        megabytes = sum(sizes[first:end]) / 1024 ** 2
+        info(f"  Part {number}: chapters {first + 1}-{end}, {format_eta(seconds)}, ~{megabytes:.1f} MB")